@@ -1,17 +1,43 @@
-import requests
+import argparse
 import json
 import os
+import queue
 import time
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import base64
+import binascii
+import itertools
+import random
 import re
 import hashlib
+import heapq
+import io
 import sys
 import logging
+import mmap
+import atexit
+import shutil
+import sqlite3
+import tempfile
+import threading
+import wave
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger("FishTTS")
 
 # 配置文件路径
 CONFIG_FILE = "Fish_tts_config.json"
 
+# 历史记录数据库路径
+HISTORY_FILE = "Fish_tts_history.db"
+
+# 批量任务日志数据库路径
+JOURNAL_FILE = "Fish_tts_jobs.db"
+
+# 各后端观测到的吞吐（自适应超时的状态）文件路径
+TIMEOUTS_FILE = "Fish_tts_timeouts.json"
+
 # API基础URL
 API_BASE_URL = "https://pkc-proxy.98tt.me/v1"
 
@@ -35,292 +61,3924 @@ DEFAULT_CONFIG = {
     },
     "format_options": ["mp3", "wav", "ogg", "flac", "pcm"],
     "backend_options": ["speech-1.6", "speech-1.5", "s1"],
-    "history": [],
+    "cache": {
+        "enabled": True,
+        "dir": "tts_cache",
+        "max_mb": 500
+    },
+    "http": {
+        "pool_size": 10,
+        "keep_alive": True,
+        "warm_up": False,
+        "stream": True,
+        "chunk_size": 65536
+    },
+    "batch": {
+        "concurrency": 4
+    },
+    "async": {
+        "concurrency": 32
+    },
+    "segment": {
+        "enabled": True,
+        "concurrency": 4
+    },
+    "pipeline": {
+        "enabled": True,
+        "writers": 2,
+        "queue_size": 8
+    },
+    "scheduler": {
+        "workers": 4,
+        "interactive_reserve": 1,
+        "deadline_policy": "demote",
+        "stats_window": 1000
+    },
+    "timeouts": {
+        "connect": 3.05,
+        "probe": 5.0,
+        "read_min": 5.0,
+        "read_max": 300.0,
+        "safety_factor": 3.0,
+        "margin": 5.0,
+        "retry_growth": 1.5,
+        "alpha": 0.2,
+        "backends": {
+            "speech-1.6": {"overhead": 1.0, "seconds_per_char": 0.02},
+            "speech-1.5": {"overhead": 0.8, "seconds_per_char": 0.015},
+            "s1": {"overhead": 1.5, "seconds_per_char": 0.04}
+        }
+    },
+    "retry": {
+        "max_attempts": 3,
+        "base_delay": 0.5,
+        "max_delay": 30.0,
+        "retry_statuses": [429, 500, 502, 503, 504]
+    },
+    "circuit_breaker": {
+        "failure_threshold": 5,
+        "reset_timeout": 30.0
+    },
+    "routing": {
+        "endpoints": [],
+        "api_keys": [],
+        "latency_alpha": 0.2,
+        "throttle_cooldown": 5.0,
+        "rejected_cooldown": 600.0
+    },
+    "rate_limit": {
+        "enabled": True,
+        "rate": 5.0,
+        "burst": 10,
+        "max_rate": 50.0,
+        "initial_concurrency": 4,
+        "max_concurrency": 32,
+        "latency_factor": 3.0
+    },
+    "metrics": {
+        "window": 1000,
+        "export_path": "Fish_tts_metrics.prom"
+    },
+    "postprocess": {
+        "enabled": False,
+        "target_dbfs": -20.0,
+        "match_prosody_volume": True,
+        "trim_silence": True,
+        "silence_threshold_db": -50.0,
+        "pad_ms": 100,
+        "sample_rate": None,
+        "pcm_sample_rate": 44100,
+        "peak_limit": 0.99,
+        "batch_size": 64
+    },
+    "output_layout": {
+        "hash_length": 10,
+        "shard_depth": 0,
+        "shard_width": 2
+    },
+    "pack": {
+        "enabled": False,
+        "path": "Fish_tts_clips.pack"
+    },
+    "journal": {
+        "enabled": True,
+        "path": JOURNAL_FILE
+    },
+    "config_flush_interval": 2.0,
     "last_used": {
         "voice": "default",
         "output": "default"
     }
 }
 
-class TTSManager:
-    def __init__(self):
-        self.config = self.load_config()
-        # 确保"last_used"字典中有"output"键
-        self.current_voice = self.config["last_used"].get("voice", "default")
-        self.current_output_path = self.config["last_used"].get("output", "default")
+# 常见音频格式的文件头签名
+AUDIO_SIGNATURES = [
+    (b"RIFF", "wav"),
+    (b"ID3", "mp3"),
+    (b"OggS", "ogg"),
+    (b"fLaC", "flac")
+]
+
+def sniff_audio_format(head, content_type="", expected_format=None):
+    """根据Content-Type和文件头判断响应体类型
+
+    返回音频格式名、"json"（需要Base64解码）或None（无法识别）
+    """
+    content_type = (content_type or "").lower()
+    if "json" in content_type:
+        return "json"
+    for signature, format in AUDIO_SIGNATURES:
+        if head.startswith(signature):
+            return format
+    # 原始PCM没有文件头，只能依据请求的格式和Content-Type判断
+    if expected_format == "pcm" and not content_type.startswith("text/"):
+        return "pcm"
+    # 不带ID3标签的MP3以帧同步字开头（11位全为1）
+    if len(head) >= 2 and head[0] == 0xFF and (head[1] & 0xE0) == 0xE0:
+        return "mp3"
+    if head.lstrip()[:1] == b"{":
+        return "json"
+    return None
+
+def write_file_atomic(path, chunks, timings=None):
+    """把数据块写入临时文件后原子重命名到目标路径，返回写入的字节数
+
+    传入 timings 字典时，把写文件耗时累加到 timings["write"]。
+    """
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+    size = 0
+    write_time = 0.0
+    try:
+        with open(tmp_path, "wb") as f:
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                started = time.monotonic()
+                f.write(chunk)
+                if size == 0:
+                    # 尽快让首个数据块落盘
+                    f.flush()
+                write_time += time.monotonic() - started
+                size += len(chunk)
+        started = time.monotonic()
+        os.replace(tmp_path, path)
+        write_time += time.monotonic() - started
+        if timings is not None:
+            timings["write"] = timings.get("write", 0.0) + write_time
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    return size
+
+# 句末标点（中英文）及其后紧跟的引号、括号
+SENTENCE_END_RE = re.compile(r'''([。！？!?；;…]+[”’"'」』）)]*|\.(?=\s)|\n+)''')
+# 句内停顿标点，用于继续切分过长的句子
+CLAUSE_END_RE = re.compile(r'([，,、：:]+|\s+)')
+
+def create_exclusive(path):
+    """以独占方式创建空文件占位，名称已存在时依次尝试 name-1、name-2……，返回实际路径"""
+    base, ext = os.path.splitext(path)
+    for attempt in itertools.count():
+        candidate = path if attempt == 0 else f"{base}-{attempt}{ext}"
+        try:
+            os.close(os.open(candidate, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644))
+            return candidate
+        except FileExistsError:
+            continue
+
+def create_exclusive_dir(path):
+    """独占创建目录，名称已存在时依次尝试 name-1、name-2……，返回实际路径"""
+    parent = os.path.dirname(path)
+    if parent:
+        os.makedirs(parent, exist_ok=True)
+    for attempt in itertools.count():
+        candidate = path if attempt == 0 else f"{path}-{attempt}"
+        try:
+            os.mkdir(candidate)
+            return candidate
+        except FileExistsError:
+            continue
+
+def discard_placeholder(path):
+    """删除生成失败后留下的空占位文件"""
+    try:
+        if path and os.path.getsize(path) == 0:
+            os.remove(path)
+    except OSError:
+        pass
+
+def _split_keep(pattern, text):
+    """按正则切分文本，分隔符保留在前一段末尾"""
+    pieces = pattern.split(text)
+    # split带捕获组时，奇数位置是分隔符
+    return ["".join(pieces[i:i + 2]) for i in range(0, len(pieces), 2)]
+
+def _pack_pieces(pieces, max_length):
+    """把相邻的短片段合并，每段不超过max_length个字符"""
+    segments = []
+    current = ""
+    for piece in pieces:
+        if current and len(current) + len(piece) > max_length:
+            segments.append(current)
+            current = ""
+        current += piece
+    segments.append(current)
+    return segments
+
+def split_sentences(text, max_length=200, merge=True):
+    """按句子和标点边界切分文本，每段不超过max_length个字符
+
+    先按句末标点切分，过长的句子再按逗号等停顿切分，仍然过长则硬切；
+    merge=True 时相邻的短句会合并，尽量让每段接近max_length，
+    merge=False 时每句单独成段（便于按句比对修改）。
+    """
+    max_length = max(1, int(max_length))
+    sentences = []
+    for sentence in _split_keep(SENTENCE_END_RE, text):
+        if len(sentence) <= max_length:
+            sentences.append([sentence])
+            continue
+        pieces = []
+        for clause in _split_keep(CLAUSE_END_RE, sentence):
+            while len(clause) > max_length:
+                pieces.append(clause[:max_length])
+                clause = clause[max_length:]
+            pieces.append(clause)
+        sentences.append(pieces)
     
-    def load_config(self):
-        """加载配置文件"""
-        if os.path.exists(CONFIG_FILE):
+    if merge:
+        segments = _pack_pieces([piece for pieces in sentences for piece in pieces], max_length)
+    else:
+        segments = [segment for pieces in sentences for segment in _pack_pieces(pieces, max_length)]
+    return [segment.strip() for segment in segments if segment.strip()]
+
+# 支持客户端分段拼接的格式（FLAC无法直接拼接）
+JOINABLE_FORMATS = ("mp3", "wav", "pcm", "ogg")
+
+# MPEG音频帧头中的比特率表（kbps），按 (是否MPEG1, 层) 索引
+MP3_BITRATES = {
+    (True, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (True, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (True, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (False, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (False, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (False, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160]
+}
+MP3_SAMPLE_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+
+def mp3_frame_length(header):
+    """解析4字节MPEG帧头，返回整帧长度；不是有效帧头时返回None"""
+    if len(header) < 4 or header[0] != 0xFF or (header[1] & 0xE0) != 0xE0:
+        return None
+    version = (header[1] >> 3) & 0x03
+    layer = 4 - ((header[1] >> 1) & 0x03)
+    bitrate_index = header[2] >> 4
+    sample_rate_index = (header[2] >> 2) & 0x03
+    padding = (header[2] >> 1) & 0x01
+    if version == 1 or layer == 4 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+    bitrate = MP3_BITRATES[(version == 3, layer)][bitrate_index] * 1000
+    sample_rate = MP3_SAMPLE_RATES[version][sample_rate_index]
+    if layer == 1:
+        return (12 * bitrate // sample_rate + padding) * 4
+    if layer == 3 and version != 3:
+        return 72 * bitrate // sample_rate + padding
+    return 144 * bitrate // sample_rate + padding
+
+def id3v2_length(head):
+    """返回MP3开头ID3v2标签的总长度（无标签时为0）；不足10字节时返回None"""
+    if len(head) < 10:
+        return None
+    if not head.startswith(b"ID3"):
+        return 0
+    tag_size = (head[6] & 0x7F) << 21 | (head[7] & 0x7F) << 14 | (head[8] & 0x7F) << 7 | (head[9] & 0x7F)
+    return 10 + tag_size + (10 if head[5] & 0x10 else 0)
+
+def mp3_audio_range(path):
+    """返回MP3文件中音频帧的 (起始偏移, 结束偏移)
+
+    跳过ID3v2标签、Xing/Info/VBRI信息帧和末尾的ID3v1标签，
+    保证拼接时每个文件都从完整的帧开始。
+    """
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        start = id3v2_length(f.read(10)) or 0
+        f.seek(start)
+        window = f.read(64 * 1024)
+        offset = 0
+        while offset + 4 <= len(window):
+            frame_length = mp3_frame_length(window[offset:offset + 4])
+            if frame_length:
+                break
+            offset += 1
+        else:
+            raise ValueError(f"未找到MP3音频帧: {path}")
+        start += offset
+        
+        # 首帧若是VBR信息帧则跳过，拼接后其中的帧数和时长已不正确
+        frame = window[offset:offset + frame_length]
+        if b"Xing" in frame[:48] or b"Info" in frame[:48] or frame[36:40] == b"VBRI":
+            start += frame_length
+        
+        end = size
+        if size >= 128:
+            f.seek(size - 128)
+            if f.read(3) == b"TAG":
+                end = size - 128
+    return start, end
+
+def _copy_range(src, dst, start, end, block_size=64 * 1024):
+    """从已打开的文件src复制 [start, end) 区间到dst"""
+    src.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        block = src.read(min(block_size, remaining))
+        if not block:
+            break
+        dst.write(block)
+        remaining -= len(block)
+
+def join_audio_files(paths, output_path, format):
+    """按顺序拼接多个音频文件
+
+    WAV重写RIFF/data头中的长度，MP3只拼接完整的音频帧，
+    PCM直接拼接，OGG拼接为合法的链式流。
+    """
+    tmp_path = f"{output_path}.{os.getpid()}.{threading.get_ident()}.part"
+    try:
+        if format == "wav":
+            params = None
+            out = wave.open(tmp_path, "wb")
             try:
-                with open(CONFIG_FILE, "r") as f:
-                    config = json.load(f)
-                    # 添加缺失字段
-                    config.setdefault("output_paths", DEFAULT_CONFIG["output_paths"].copy())
-                    config.setdefault("format_options", DEFAULT_CONFIG["format_options"].copy())
-                    config.setdefault("backend_options", DEFAULT_CONFIG["backend_options"].copy())
-                    config.setdefault("history", [])
-                    config.setdefault("last_used", DEFAULT_CONFIG["last_used"].copy())
-                    
-                    # 确保"last_used"字典中有"voice"和"output"键
-                    config["last_used"].setdefault("voice", "default")
-                    config["last_used"].setdefault("output", "default")
-                    
-                    # 确保每个声音配置都有voice_id字段
-                    for name, profile in config["voices"].items():
-                        profile.setdefault("voice_id", "default")
-                    
-                    return config
-            except:
-                return DEFAULT_CONFIG.copy()
-        return DEFAULT_CONFIG.copy()
+                for path in paths:
+                    with wave.open(path, "rb") as part:
+                        part_params = part.getparams()[:3]
+                        if params is None:
+                            params = part_params
+                            out.setnchannels(params[0])
+                            out.setsampwidth(params[1])
+                            out.setframerate(params[2])
+                        elif part_params != params:
+                            raise ValueError(f"WAV参数不一致，无法拼接: {path}")
+                        while True:
+                            frames = part.readframes(16384)
+                            if not frames:
+                                break
+                            out.writeframesraw(frames)
+            finally:
+                # close时会按实际写入的帧数回写文件头
+                out.close()
+        else:
+            with open(tmp_path, "wb") as out:
+                for path in paths:
+                    with open(path, "rb") as part:
+                        if format == "mp3":
+                            start, end = mp3_audio_range(path)
+                        else:
+                            start, end = 0, os.path.getsize(path)
+                        _copy_range(part, out, start, end)
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def wav_data_offset(head):
+    """返回WAV数据中PCM采样的起始偏移；文件头尚未读全时返回None"""
+    if len(head) < 12:
+        return None
+    if head[:4] != b"RIFF" or head[8:12] != b"WAVE":
+        raise ValueError("不是有效的WAV数据")
+    offset = 12
+    while offset + 8 <= len(head):
+        chunk_size = int.from_bytes(head[offset + 4:offset + 8], "little")
+        if head[offset:offset + 4] == b"data":
+            return offset + 8
+        offset += 8 + chunk_size + (chunk_size & 1)
+    return None
+
+def decode_json_audio(body):
+    """解析JSON响应中的Base64音频，返回 (音频数据, 错误信息)"""
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return None, f"❌ 无效响应: {body[:200].decode('utf-8', 'replace')}"
     
-    def save_config(self):
-        """保存配置文件"""
-        # 更新最后使用配置
-        self.config["last_used"] = {
-            "voice": self.current_voice,
-            "output": self.current_output_path
-        }
+    # 获取音频数据
+    if not isinstance(data, dict) or "audio" not in data:
+        return None, "❌ 响应中未包含音频数据"
+    try:
+        return base64.b64decode(data["audio"]), None
+    except (binascii.Error, TypeError, ValueError):
+        return None, "❌ 音频数据不是有效的Base64编码"
+
+class AudioStreamWriter:
+    """把多段音频按顺序写成一条可以直接播放的流
+
+    WAV只输出一次文件头（长度字段写为0xFFFFFFFF，表示长度未知），后续分段
+    只写PCM数据；MP3去掉后续分段的ID3v2标签；PCM等格式原样拼接。
+    每块数据写出后立即flush，并记录首个音频数据写出的时间（TTFA）。
+    """
+
+    def __init__(self, sink, format, started=None):
+        self.sink = sink
+        self.format = format
+        self.started = time.monotonic() if started is None else started
+        self.first_audio = None
+        self.bytes_written = 0
+        self.segments = 0
+
+    @property
+    def ttfa(self):
+        """首个音频数据写出距开始的秒数，尚未写出时为None"""
+        return None if self.first_audio is None else self.first_audio - self.started
+
+    def _header_length(self, head, first):
+        """分段开头需要跳过的字节数；需要更多数据才能判断时返回None"""
+        if self.format == "wav":
+            return wav_data_offset(head)
+        if self.format == "mp3" and not first:
+            return id3v2_length(head)
+        return 0
+
+    def _write(self, data):
+        if self.first_audio is None:
+            self.first_audio = time.monotonic()
+        self.sink.write(data)
+        self.sink.flush()
+        self.bytes_written += len(data)
+
+    def write_segment(self, chunks):
+        """写入一个分段（可迭代的数据块，边收边写）"""
+        first = self.segments == 0
+        self.segments += 1
+        pending = b""
+        skip = None
+        for chunk in chunks:
+            if skip is None:
+                pending += chunk
+                skip = self._header_length(pending, first)
+                if skip is None:
+                    continue
+                if first and self.format == "wav":
+                    header = bytearray(pending[:skip])
+                    header[4:8] = header[-4:] = b"\xff\xff\xff\xff"
+                    self._write(bytes(header))
+                chunk, pending = pending, b""
+            if skip:
+                dropped = min(skip, len(chunk))
+                chunk = chunk[dropped:]
+                skip -= dropped
+            if chunk:
+                self._write(chunk)
+        if skip is None and pending:
+            raise ValueError("音频数据不完整，无法解析文件头")
+
+POSTPROCESS_FORMATS = ("wav", "pcm")
+
+class AudioPostProcessor:
+    """基于 NumPy 的音频后处理：静音裁剪、重采样、响度归一化和首尾补静音
+
+    只支持 WAV 和 16 位单声道 PCM（MP3 等压缩格式需要解码器，直接跳过）。
+    一批文件的响度和峰值用 reduceat 一次算出，静音检测按 10ms 帧整体计算，
+    都不逐采样循环。target_dbfs 为 None 时以这一批的响度中位数为目标；
+    match_prosody_volume 时目标响度再加上声音配置的 prosody_volume（dB）。
+    """
+
+    def __init__(self, settings):
+        try:
+            import numpy
+        except ImportError:
+            raise RuntimeError("音频后处理需要安装 numpy: pip install numpy")
+        self.np = numpy
+        self.settings = settings
+
+    def load(self, path, format):
+        """读取音频，返回 (float32 采样数组 [帧数, 声道数], 采样率)"""
+        np = self.np
+        if format == "pcm":
+            with open(path, "rb") as f:
+                data = f.read()
+            samples = np.frombuffer(data, dtype="<i2", count=len(data) // 2).reshape(-1, 1)
+            return samples.astype(np.float32) / 32768.0, int(self.settings.get("pcm_sample_rate", 44100))
+        
+        with wave.open(path, "rb") as f:
+            channels, width, rate = f.getnchannels(), f.getsampwidth(), f.getframerate()
+            data = f.readframes(f.getnframes())
+        if width == 1:
+            samples = (np.frombuffer(data, dtype=np.uint8).astype(np.float32) - 128.0) / 128.0
+        elif width == 2:
+            samples = np.frombuffer(data, dtype="<i2").astype(np.float32) / 32768.0
+        elif width == 4:
+            samples = np.frombuffer(data, dtype="<i4").astype(np.float32) / 2147483648.0
+        else:
+            raise ValueError(f"不支持的WAV采样位数: {width * 8}")
+        return samples.reshape(-1, channels), rate
+
+    def save(self, path, samples, rate, format):
+        """以16位采样原子写回文件"""
+        np = self.np
+        data = (np.clip(samples, -1.0, 1.0) * 32767.0).astype("<i2").tobytes()
+        if format == "wav":
+            buffer = io.BytesIO()
+            with wave.open(buffer, "wb") as out:
+                out.setnchannels(samples.shape[1])
+                out.setsampwidth(2)
+                out.setframerate(rate)
+                out.writeframes(data)
+            data = buffer.getvalue()
+        write_file_atomic(path, [data])
+
+    def trim(self, samples, rate):
+        """去掉首尾低于阈值的静音（按10ms帧的RMS判断）"""
+        np = self.np
+        frame = max(1, rate // 100)
+        count = len(samples) // frame
+        if count == 0:
+            return samples
+        frames = samples[:count * frame].reshape(count, -1)
+        energy = np.sqrt(np.mean(frames * frames, axis=1))
+        threshold = 10 ** (self.settings.get("silence_threshold_db", -50.0) / 20)
+        loud = np.flatnonzero(energy > threshold)
+        if loud.size == 0:
+            return samples[:0]
+        end = len(samples) if loud[-1] == count - 1 else (loud[-1] + 1) * frame
+        return samples[loud[0] * frame:end]
+
+    def resample(self, samples, rate, target):
+        """线性插值重采样"""
+        np = self.np
+        if not target or target == rate or len(samples) < 2:
+            return samples
+        positions = np.arange(int(round(len(samples) * target / rate))) * (rate / target)
+        left = np.minimum(positions.astype(np.int64), len(samples) - 1)
+        right = np.minimum(left + 1, len(samples) - 1)
+        fraction = (positions - left).astype(np.float32)[:, None]
+        return samples[left] * (1 - fraction) + samples[right] * fraction
+
+    def gains(self, clips, volumes):
+        """整批计算每段音频的增益（线性倍数）"""
+        np = self.np
+        lengths = np.array([len(clip) for clip in clips])
+        gains = np.ones(len(clips), dtype=np.float64)
+        nonempty = np.flatnonzero(lengths > 0)
+        if nonempty.size == 0:
+            return gains
+        
+        # 所有片段的逐帧能量和峰值拼成一维数组，用 reduceat 按片段汇总
+        energy = np.concatenate([np.mean(clips[i] * clips[i], axis=1) for i in nonempty])
+        peaks = np.concatenate([np.max(np.abs(clips[i]), axis=1) for i in nonempty])
+        offsets = np.concatenate(([0], np.cumsum(lengths[nonempty])[:-1]))
+        loudness = 10 * np.log10(np.add.reduceat(energy, offsets) / lengths[nonempty] + 1e-12)
+        peak = np.maximum.reduceat(peaks, offsets)
         
-        # 确保输出目录存在
-        for path in self.config["output_paths"].values():
-            os.makedirs(path, exist_ok=True)
+        target = self.settings.get("target_dbfs", -20.0)
+        if target is None:
+            target = float(np.median(loudness))
+        targets = np.full(nonempty.size, float(target))
+        if self.settings.get("match_prosody_volume", True):
+            targets += np.asarray(volumes, dtype=np.float64)[nonempty]
+        selected = 10 ** ((targets - loudness) / 20)
+        # 限制增益，避免峰值削波
+        limit = self.settings.get("peak_limit", 0.99) / np.maximum(peak, 1e-9)
+        gains[nonempty] = np.minimum(selected, limit)
+        return gains
+
+    def process(self, items):
+        """处理一批文件，items 为 (路径, 格式, prosody_volume) 列表
+
+        返回 {"processed": 处理的文件数, "skipped": 跳过的文件列表}
+        """
+        np = self.np
+        settings = self.settings
+        supported = [item for item in items if item[1] in POSTPROCESS_FORMATS]
+        summary = {"processed": 0, "skipped": [item[0] for item in items if item[1] not in POSTPROCESS_FORMATS]}
+        batch_size = max(1, int(settings.get("batch_size", 64)))
+        for start in range(0, len(supported), batch_size):
+            batch = supported[start:start + batch_size]
+            clips, rates = [], []
+            for path, format, _ in batch:
+                samples, rate = self.load(path, format)
+                if settings.get("trim_silence", True):
+                    samples = self.trim(samples, rate)
+                target_rate = settings.get("sample_rate")
+                if target_rate:
+                    samples, rate = self.resample(samples, rate, int(target_rate)), int(target_rate)
+                clips.append(samples)
+                rates.append(rate)
+            
+            gains = self.gains(clips, [volume or 0.0 for _, _, volume in batch])
+            for (path, format, _), samples, rate, gain in zip(batch, clips, rates, gains):
+                pad = int(rate * settings.get("pad_ms", 0) / 1000)
+                samples = np.pad(samples * np.float32(gain), ((pad, pad), (0, 0)))
+                self.save(path, samples, rate, format)
+                summary["processed"] += 1
+        return summary
+
+def make_result(**fields):
+    """创建结构化的生成结果
+
+    status 取值: ok、not_found、http_error、timeout、connection_error、
+    invalid_response、circuit_open、deadline_exceeded、error
+    """
+    result = {
+        "ok": False,
+        "status": "error",
+        "message": "",
+        "error": None,
+        "filename": None,
+        "cached": False,
+        "status_code": None,
+        "attempts": 0,
+        "coalesced": False
+    }
+    result.update(fields)
+    return result
+
+def fail_result(result, message, status="error"):
+    """把结果标记为失败"""
+    result.update(ok=False, status=status, message=message, error=message)
+    return result
+
+def parse_retry_after(value):
+    """解析Retry-After响应头（秒数或HTTP日期），返回需要等待的秒数"""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    import email.utils
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+class InFlightCall:
+    """一次进行中的上游请求；相同请求的并发调用方登记输出文件后等待共享结果"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.followers = []
+        self.results = []
+
+    def join(self, filename):
+        """登记一个等待方（需在持有管理器的 _inflight_lock 时调用），返回结果序号"""
+        self.followers.append(filename)
+        return len(self.followers) - 1
+
+    def wait(self, index):
+        self.done.wait()
+        return self.results[index]
+
+    def finish(self, result):
+        """把首个调用方的结果复制给所有等待方，然后唤醒它们
+
+        文件复制在唤醒前完成，避免首个调用方随后移动或删除文件造成竞争。
+        """
+        for filename in self.followers:
+            shared = dict(result) if result else fail_result(make_result(), "❌ 发生错误: 合并的请求异常中止")
+            shared.update(filename=filename, coalesced=True)
+            if shared["ok"] and filename != result["filename"]:
+                try:
+                    shutil.copyfile(result["filename"], filename)
+                except OSError as e:
+                    fail_result(shared, f"❌ 写入文件失败: {str(e)}")
+            self.results.append(shared)
+        self.done.set()
+
+class BoundedPipeline:
+    """由有界队列连接的后台处理阶段
+
+    上游线程通过 put() 提交任务，队列满时阻塞（背压），从而限制内存中
+    等待处理的音频数量；workers 个线程依次执行任务。close() 会等待队列清空。
+    """
+
+    def __init__(self, workers=2, queue_size=8):
+        self._queue = queue.Queue(maxsize=max(1, int(queue_size)))
+        self._lock = threading.Lock()
+        self.max_depth = 0
+        self.blocked = 0.0
+        self._threads = [threading.Thread(target=self._run, daemon=True)
+                         for _ in range(max(1, int(workers)))]
+        for thread in self._threads:
+            thread.start()
+
+    def put(self, fn, *args):
+        """提交任务 fn(*args)；队列已满时阻塞直到有空位"""
+        started = time.monotonic()
+        self._queue.put((fn, args))
+        with self._lock:
+            self.blocked += time.monotonic() - started
+            self.max_depth = max(self.max_depth, self._queue.qsize())
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            fn, args = job
+            try:
+                fn(*args)
+            except Exception:
+                logger.exception("流水线任务执行失败")
+
+    def close(self):
+        """等待已提交的任务完成并结束工作线程"""
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "writers": len(self._threads),
+                "queue_size": self._queue.maxsize,
+                "max_depth": self.max_depth,
+                "blocked": round(self.blocked, 3)
+            }
+
+# 多配置对比（fan-out）时可以组成参数网格的参数
+FANOUT_PARAMS = ("temperature", "top_p", "speed")
+
+# 调度优先级，靠前的优先
+PRIORITY_CLASSES = ("interactive", "bulk")
+
+class ScheduledJob:
+    """调度队列中的一个合成任务"""
+
+    __slots__ = ("priority", "deadline", "submitted", "estimate", "text", "options", "future", "dedupe_key")
+
+    def __init__(self, priority, deadline, text, options, estimate, dedupe_key=None):
+        from concurrent.futures import Future
         
-        with open(CONFIG_FILE, "w") as f:
-            json.dump(self.config, f, indent=2)
+        self.dedupe_key = dedupe_key
+        self.priority = priority
+        self.deadline = deadline
+        self.submitted = time.monotonic()
+        self.estimate = estimate
+        self.text = text
+        self.options = options
+        self.future = Future()
+
+class SynthesisScheduler:
+    """TTSManager 前的优先级调度器
+
+    interactive 任务总是排在尚未开始的 bulk 任务之前，并保留 interactive_reserve 个
+    只处理 interactive 任务的工作线程，批量任务占满时交互请求也不必排队。
+    带截止时间的任务在提交和出队时按历史耗时估算能否按时完成，来不及时按
+    deadline_policy 丢弃（drop，结果状态为 deadline_exceeded）或降级为不限时的
+    bulk 任务（demote）。
+    与排队中或执行中的任务完全相同（请求内容、use_cache 和输出位置都相同）的任务
+    不再单独排队，直接共享已有任务的 Future，突发的重复请求只占一个工作线程。
+    """
+
+    def __init__(self, manager, workers=4, interactive_reserve=1, deadline_policy="demote", window=1000):
+        if deadline_policy not in ("drop", "demote"):
+            raise ValueError(f"未知的截止时间策略: {deadline_policy}")
+        self.manager = manager
+        self.deadline_policy = deadline_policy
+        # 每个字符的平均合成耗时（秒），用于估算任务耗时
+        self.seconds_per_char = None
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._closed = False
+        # 去重键 -> 尚未完成的任务
+        self._pending = {}
+        self._stats = {
+            name: {"submitted": 0, "completed": 0, "dropped": 0, "demoted": 0, "deduplicated": 0,
+                   "depth": 0, "max_depth": 0, "waits": deque(maxlen=window)}
+            for name in PRIORITY_CLASSES
+        }
+        workers = max(1, int(workers))
+        reserve = min(max(0, int(interactive_reserve)), workers - 1)
+        self.workers = workers
+        self._threads = [
+            threading.Thread(target=self._run, args=(index < reserve,), daemon=True)
+            for index in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def estimate(self, text):
+        """按历史吞吐估算合成一段文本需要的秒数，尚无样本时返回0"""
+        return (self.seconds_per_char or 0.0) * len(text)
+
+    def submit(self, text, priority="bulk", deadline=None, **options):
+        """提交合成任务，返回 Future，结果为 TTSManager.synthesize 的结果字典
+
+        deadline 为从现在起允许的最长秒数；其余参数原样传给 synthesize。
+        """
+        if priority not in PRIORITY_CLASSES:
+            raise ValueError(f"未知的优先级: {priority}")
+        job = ScheduledJob(priority, None, text, options, self.estimate(text), self._dedupe_key(text, options))
+        if deadline is not None:
+            job.deadline = job.submitted + float(deadline)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("调度器已关闭")
+            self._stats[priority]["submitted"] += 1
+            existing = self._pending.get(job.dedupe_key) if job.dedupe_key is not None else None
+            if existing is not None and self._can_share(existing, job):
+                self._stats[priority]["deduplicated"] += 1
+                return existing.future
+            if job.deadline is not None and job.submitted + self._expected_wait(job) + job.estimate > job.deadline:
+                if not self._miss(job):
+                    return job.future
+            if job.dedupe_key is not None:
+                self._pending[job.dedupe_key] = job
+            self._push(job)
+        return job.future
+
+    def _can_share(self, existing, job):
+        """新任务能否直接共享已有任务的结果（调用方持有锁）
+
+        已开始执行的任务总能共享；排队中的任务要不比新任务晚执行（优先级和截止时间），
+        且在 drop 策略下不能是可能被丢弃的限时任务，否则新任务照常排队。
+        """
+        if existing.future.running():
+            return True
+        if self.deadline_policy == "drop" and existing.deadline is not None:
+            return False
+        return self._key(existing) <= self._key(job)
+
+    def _dedupe_key(self, text, options):
+        """任务的去重键：请求体哈希加上影响结果的选项；无法构造请求体时返回None（不去重）"""
+        try:
+            voice_profile = self.manager.get_voice_profile(options.get("voice_profile_name"))[1]
+            if not voice_profile:
+                return None
+            payload = self.manager.build_payload(text, voice_profile, options.get("speed", 1.0))
+        except (KeyError, TypeError, ValueError):
+            return None
+        return (AudioCache.make_key(payload), bool(options.get("use_cache", True)),
+                options.get("output_name"), options.get("output_file"))
+
+    def _forget(self, job):
+        """任务结束（完成、丢弃或取消）后不再接受共享（调用方持有锁）"""
+        if job.dedupe_key is not None and self._pending.get(job.dedupe_key) is job:
+            del self._pending[job.dedupe_key]
+
+    def _key(self, job):
+        deadline = job.deadline if job.deadline is not None else float("inf")
+        return (PRIORITY_CLASSES.index(job.priority), deadline)
+
+    def _expected_wait(self, job):
+        """排在该任务之前的任务预计占用的时间（按工作线程数均摊）"""
+        key = self._key(job)
+        ahead = sum(entry[-1].estimate for entry in self._heap if entry[:2] <= key)
+        return ahead / self.workers
+
+    def _push(self, job):
+        heapq.heappush(self._heap, self._key(job) + (next(self._seq), job))
+        stats = self._stats[job.priority]
+        stats["depth"] += 1
+        stats["max_depth"] = max(stats["max_depth"], stats["depth"])
+        self._cond.notify_all()
+
+    def _miss(self, job):
+        """处理来不及完成的任务：降级时返回True（需重新入队），丢弃时返回False"""
+        stats = self._stats[job.priority]
+        if self.deadline_policy == "demote":
+            stats["demoted"] += 1
+            job.priority = "bulk"
+            job.deadline = None
+            return True
+        stats["dropped"] += 1
+        self._forget(job)
+        if job.future.set_running_or_notify_cancel():
+            job.future.set_result(make_result(
+                status="deadline_exceeded", error="❌ 无法在截止时间前完成，已放弃",
+                message="❌ 无法在截止时间前完成，已放弃"
+            ))
+        return False
+
+    def _next_job(self, interactive_only):
+        with self._cond:
+            while True:
+                if self._heap and (not interactive_only or self._heap[0][0] == 0):
+                    job = heapq.heappop(self._heap)[-1]
+                    self._stats[job.priority]["depth"] -= 1
+                    now = time.monotonic()
+                    if job.deadline is not None and now + job.estimate > job.deadline:
+                        if self._miss(job):
+                            self._push(job)
+                        continue
+                    if not job.future.set_running_or_notify_cancel():
+                        self._forget(job)
+                        continue
+                    self._stats[job.priority]["waits"].append(now - job.submitted)
+                    return job
+                if self._closed:
+                    return None
+                self._cond.wait()
+
+    def _run(self, interactive_only):
+        while True:
+            job = self._next_job(interactive_only)
+            if job is None:
+                return
+            started = time.monotonic()
+            try:
+                result = self.manager.synthesize(job.text, **job.options)
+            except Exception as e:
+                with self._cond:
+                    self._forget(job)
+                job.future.set_exception(e)
+                continue
+            elapsed = time.monotonic() - started
+            with self._cond:
+                self._forget(job)
+                self._stats[job.priority]["completed"] += 1
+                # 缓存命中的耗时不代表合成速度
+                if result["ok"] and not result["cached"] and job.text:
+                    sample = elapsed / len(job.text)
+                    if self.seconds_per_char is None:
+                        self.seconds_per_char = sample
+                    else:
+                        self.seconds_per_char += (sample - self.seconds_per_char) * 0.2
+            job.future.set_result(result)
+
+    def stats(self):
+        """各优先级的排队深度、等待时间分位数和丢弃/降级次数"""
+        with self._cond:
+            snapshot = {}
+            for name, stats in self._stats.items():
+                waits = sorted(stats["waits"])
+                entry = {key: value for key, value in stats.items() if key != "waits"}
+                for q in (50, 95):
+                    value = percentile(waits, q)
+                    entry[f"wait_p{q}"] = round(value, 4) if value is not None else None
+                entry["wait_max"] = round(waits[-1], 4) if waits else None
+                snapshot[name] = entry
+            snapshot["seconds_per_char"] = (round(self.seconds_per_char, 5)
+                                            if self.seconds_per_char is not None else None)
+            return snapshot
+
+    def shutdown(self, wait=True, cancel_pending=False):
+        """停止接收任务；cancel_pending 时取消尚未开始的任务，否则处理完再退出"""
+        with self._cond:
+            self._closed = True
+            if cancel_pending:
+                while self._heap:
+                    job = heapq.heappop(self._heap)[-1]
+                    self._stats[job.priority]["depth"] -= 1
+                    self._forget(job)
+                    job.future.cancel()
+            self._cond.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+class CircuitBreaker:
+    """熔断器：连续失败达到阈值后进入熔断状态，冷却期内直接拒绝请求
+
+    冷却期结束后放行一个探测请求（半开状态），成功则恢复，失败则重新熔断。
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """判断当前是否允许发出请求"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    return False
+                self.state = self.HALF_OPEN
+                self._probe_in_flight = False
+            # 半开状态只放行一个探测请求
+            if self._probe_in_flight:
+                return False
+            self._probe_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+            self._probe_in_flight = False
+
+    def retry_in(self):
+        """熔断状态下距离允许探测还需等待的秒数"""
+        with self._lock:
+            if self.state != self.OPEN:
+                return 0.0
+            return max(0.0, self.reset_timeout - (time.monotonic() - self._opened_at))
+
+class AdaptiveRateLimiter:
+    """自适应限流器：令牌桶限制每秒请求数，AIMD 调整同时进行的请求数
+
+    请求成功且延迟正常时并发上限和速率加性增长；遇到429、超时或延迟
+    明显高于基线时乘性下降，从而逐步逼近服务端的真实容量。
+    """
+
+    # 速率下限（每秒请求数），等待令牌的时间按 1/rate 计算，速率不能为0
+    RATE_FLOOR = 0.01
+
+    def __init__(self, rate=5.0, burst=10, max_rate=50.0, initial_concurrency=4,
+                 max_concurrency=32, latency_factor=3.0, min_rate=0.2, decrease_factor=0.5):
+        self.rate = max(self.RATE_FLOOR, float(rate))
+        self.min_rate = max(self.RATE_FLOOR, float(min_rate))
+        if self.min_rate > self.rate:
+            raise ValueError(f"限流配置无效: min_rate ({min_rate}) 不能大于 rate ({rate})")
+        self.burst = max(1.0, float(burst))
+        self.max_rate = max(self.rate, float(max_rate))
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.concurrency_limit = float(min(max(1, initial_concurrency), self.max_concurrency))
+        self.latency_factor = latency_factor
+        self.decrease_factor = decrease_factor
+        self.in_flight = 0
+        self.tokens = self.burst
+        self.latency_baseline = None
+        self.throttled = 0
+        self.completed = 0
+        self._last_refill = time.monotonic()
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def try_acquire(self):
+        """尝试获取一个请求许可，成功返回0，否则返回建议等待的秒数"""
+        with self._cond:
+            self._refill()
+            if self.in_flight >= int(self.concurrency_limit):
+                return 0.05
+            if self.tokens < 1:
+                return (1 - self.tokens) / self.rate
+            self.tokens -= 1
+            self.in_flight += 1
+            return 0
+
+    def acquire(self):
+        """阻塞直到获得请求许可"""
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            with self._cond:
+                self._cond.wait(wait)
+
+    def release(self, latency=None, throttled=False):
+        """归还许可，并根据本次请求的结果调整速率和并发上限"""
+        with self._cond:
+            self.in_flight = max(0, self.in_flight - 1)
+            now = time.monotonic()
+            if latency is not None and not throttled:
+                self.completed += 1
+                if self.latency_baseline is None:
+                    self.latency_baseline = latency
+                else:
+                    # 基线跟随较低的延迟，避免被拥塞期间的慢请求拉高
+                    weight = 0.2 if latency < self.latency_baseline else 0.02
+                    self.latency_baseline += (latency - self.latency_baseline) * weight
+                congested = latency > self.latency_baseline * self.latency_factor
+            else:
+                congested = throttled
+            if throttled:
+                self.throttled += 1
+            
+            if congested:
+                # 每个观测周期最多下降一次，避免一批并发请求同时触发连续下降
+                window = max(1.0, self.latency_baseline or 0.0)
+                if now - self._last_decrease >= window:
+                    self._last_decrease = now
+                    self.concurrency_limit = max(1.0, self.concurrency_limit * self.decrease_factor)
+                    self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+            elif latency is not None:
+                # 加性增长：每完成约一个并发窗口的请求，上限加1
+                self.concurrency_limit = min(self.max_concurrency,
+                                             self.concurrency_limit + 1.0 / self.concurrency_limit)
+                self.rate = min(self.max_rate, self.rate + 1.0 / max(1.0, self.rate))
+            self._cond.notify_all()
+
+    def snapshot(self):
+        """返回限流器当前状态"""
+        with self._cond:
+            self._refill()
+            return {
+                "rate": round(self.rate, 3),
+                "tokens": round(self.tokens, 3),
+                "concurrency_limit": int(self.concurrency_limit),
+                "in_flight": self.in_flight,
+                "latency_baseline": round(self.latency_baseline, 4) if self.latency_baseline else None,
+                "completed": self.completed,
+                "throttled": self.throttled
+            }
+
+class AdaptiveTimeouts:
+    """按文本长度、后端和观测到的吞吐计算请求超时
+
+    每个后端维护两项指数滑动平均：固定开销（短文本的首字节时间）和每字符耗时，
+    尚无观测时取 backends 中的经验值。读超时 = safety_factor × 预计首字节时间 + margin，
+    限制在 [read_min, read_max] 内，同一请求每次读超时后重试时放宽 retry_growth 倍；
+    连接超时单独固定为 connect，服务不可达时很快失败。
+    观测值保存在单独的状态文件中（见 load/save），不随配置文件写盘。
+    """
+
+    # 不超过这个字符数的文本用来估计固定开销
+    SHORT_TEXT = 20
+
+    def __init__(self, settings):
+        self.connect = float(settings.get("connect", 3.05))
+        self.probe = float(settings.get("probe", 5.0))
+        self.read_min = float(settings.get("read_min", 5.0))
+        self.read_max = max(self.read_min, float(settings.get("read_max", 300.0)))
+        self.safety_factor = float(settings.get("safety_factor", 3.0))
+        self.margin = float(settings.get("margin", 5.0))
+        self.retry_growth = float(settings.get("retry_growth", 1.5))
+        self.alpha = float(settings.get("alpha", 0.2))
+        self.priors = settings.get("backends") or {}
+        # 旧版把观测值写在配置的 timeouts.observed 中，仅作为初始值
+        self._observed = {backend: dict(values) for backend, values in (settings.get("observed") or {}).items()}
+        # 本进程内有新观测的后端，保存时只覆盖这些
+        self._dirty = set()
+        self._lock = threading.Lock()
+
+    def _model(self, backend):
+        observed = self._observed.get(backend)
+        if observed:
+            return observed["overhead"], observed["seconds_per_char"]
+        prior = self.priors.get(backend, {})
+        return prior.get("overhead", 1.0), prior.get("seconds_per_char", 0.03)
+
+    def expected(self, backend, chars):
+        """预计的首字节时间（秒）"""
+        with self._lock:
+            overhead, seconds_per_char = self._model(backend)
+        return overhead + seconds_per_char * chars
+
+    def for_request(self, backend, chars, read_timeouts=0):
+        """返回 requests 使用的 (连接超时, 读超时)；read_timeouts 为该请求此前读超时的次数"""
+        read = self.safety_factor * self.expected(backend, chars) + self.margin
+        read = min(self.read_max, max(self.read_min, read) * self.retry_growth ** read_timeouts)
+        return self.connect, round(read, 3)
+
+    def probe_timeout(self):
+        """连通性测试和连接预热使用的超时"""
+        return self.connect, self.probe
+
+    def observe(self, backend, chars, ttfb):
+        """记录一次成功请求的首字节时间"""
+        with self._lock:
+            overhead, seconds_per_char = self._model(backend)
+            observed = self._observed.setdefault(backend, {
+                "overhead": overhead, "seconds_per_char": seconds_per_char, "samples": 0
+            })
+            if chars <= self.SHORT_TEXT:
+                observed["overhead"] += (ttfb - overhead) * self.alpha
+            else:
+                sample = max(0.0, ttfb - overhead) / chars
+                observed["seconds_per_char"] += (sample - seconds_per_char) * self.alpha
+            observed["samples"] += 1
+            self._dirty.add(backend)
+
+    @staticmethod
+    def _read_state(path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return state if isinstance(state, dict) else {}
+
+    def load(self, path):
+        """读取状态文件中保存的观测值"""
+        state = self._read_state(path)
+        with self._lock:
+            for backend, values in state.items():
+                if backend not in self._dirty:
+                    self._observed[backend] = dict(values)
+
+    def save(self, path):
+        """把本进程内更新过的观测值合并写入状态文件，没有新观测时不写
+
+        先读回文件再只覆盖本进程观测过的后端，多个进程共用状态文件时互不抹掉对方的结果。
+        """
+        with self._lock:
+            if not self._dirty:
+                return False
+            dirty = set(self._dirty)
+        state = self._read_state(path)
+        state.update({backend: values for backend, values in self.snapshot().items() if backend in dirty})
+        write_file_atomic(path, [json.dumps(state, ensure_ascii=False, indent=2).encode("utf-8")])
+        with self._lock:
+            self._dirty -= dirty
+        return True
+
+    def snapshot(self):
+        """各后端当前使用的观测值（保存到状态文件，下次启动继续使用）"""
+        with self._lock:
+            return {
+                backend: {
+                    "overhead": round(values["overhead"], 4),
+                    "seconds_per_char": round(values["seconds_per_char"], 6),
+                    "samples": values["samples"]
+                }
+                for backend, values in self._observed.items()
+            }
+
+# 同一进程内使用同一API密钥的管理器共享限流器
+_shared_limiters = {}
+_shared_limiters_lock = threading.Lock()
+
+def get_shared_limiter(api_key, settings):
+    """获取（必要时创建）指定API密钥共享的限流器"""
+    with _shared_limiters_lock:
+        limiter = _shared_limiters.get(api_key)
+        if limiter is None:
+            options = {key: value for key, value in settings.items() if key != "enabled"}
+            limiter = _shared_limiters[api_key] = AdaptiveRateLimiter(**options)
+        return limiter
+
+# 说明API密钥被拒绝（无效、欠费或无权限）的状态码，换用其他密钥重试
+KEY_REJECTED_STATUSES = (401, 402, 403)
+
+class Endpoint:
+    """一个上游地址：独立的熔断器，以及延迟和错误率的指数滑动平均"""
+
+    def __init__(self, url, weight=1.0, failure_threshold=5, reset_timeout=30.0):
+        self.url = url.rstrip("/")
+        self.weight = max(0.01, float(weight))
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.latency = None
+        self.error_rate = 0.0
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+
+    def score(self):
+        """路由评分，越小越优先：延迟 × 排队数 × 错误惩罚 / 权重；尚无延迟样本的地址优先探测"""
+        latency = self.latency if self.latency is not None else 0.0
+        return (latency + 0.01) * (1 + self.in_flight) * (1 + 4 * self.error_rate) / self.weight
+
+class ApiKeyState:
+    """一个API密钥：权重、每分钟配额和被限流/拒绝后的冷却时间"""
+
+    def __init__(self, key, weight=1.0, quota_per_minute=None):
+        self.key = key
+        self.weight = max(0.01, float(weight))
+        self.quota = int(quota_per_minute) if quota_per_minute else None
+        self.current = 0.0
+        self.cooldown_until = 0.0
+        self.requests = 0
+        self._used = deque()
+
+    def wait_time(self, now):
+        """距离该密钥可用还需等待的秒数，0表示现在可用"""
+        while self._used and now - self._used[0] >= 60.0:
+            self._used.popleft()
+        wait = max(0.0, self.cooldown_until - now)
+        if self.quota is not None and len(self._used) >= self.quota:
+            wait = max(wait, 60.0 - (now - self._used[0]))
+        return wait
+
+    def masked(self):
+        return f"{self.key[:4]}…{self.key[-4:]}" if len(self.key) > 8 else "***"
+
+class Route:
+    """一次请求选用的上游地址和API密钥"""
+
+    __slots__ = ("endpoint", "key")
+
+    def __init__(self, endpoint, key):
+        self.endpoint = endpoint
+        self.key = key
+
+class EndpointRouter:
+    """多上游地址、多API密钥的请求路由
+
+    地址按最近的延迟、错误率、进行中的请求数和权重选择，熔断的地址自动跳过；
+    密钥按权重平滑轮转，跳过超出每分钟配额、被限流或被拒绝后仍在冷却中的密钥。
+    """
+
+    def __init__(self, endpoints, keys, breaker_settings=None, latency_alpha=0.2,
+                 throttle_cooldown=5.0, rejected_cooldown=600.0):
+        breaker_settings = breaker_settings or {}
+        self.endpoints = [Endpoint(url, weight, **breaker_settings) for url, weight in endpoints]
+        self.keys = [ApiKeyState(*key) for key in keys]
+        self.latency_alpha = latency_alpha
+        self.throttle_cooldown = throttle_cooldown
+        self.rejected_cooldown = rejected_cooldown
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config, default_url):
+        """按 routing 配置创建；未配置地址或密钥时使用 API_BASE_URL 和 api_key"""
+        routing = config["routing"]
+        endpoints = []
+        for entry in routing.get("endpoints") or [default_url]:
+            if isinstance(entry, str):
+                entry = {"url": entry}
+            endpoints.append((entry["url"], entry.get("weight", 1.0)))
+        keys = []
+        for entry in routing.get("api_keys") or [config["api_key"]]:
+            if isinstance(entry, str):
+                entry = {"key": entry}
+            keys.append((entry["key"], entry.get("weight", 1.0), entry.get("quota_per_minute")))
+        breaker = config["circuit_breaker"]
+        return cls(
+            endpoints, keys,
+            {"failure_threshold": breaker["failure_threshold"], "reset_timeout": breaker["reset_timeout"]},
+            routing.get("latency_alpha", 0.2), routing.get("throttle_cooldown", 5.0),
+            routing.get("rejected_cooldown", 600.0)
+        )
+
+    def select(self):
+        """选择地址和密钥，返回 (Route, 0)；没有可用地址时返回 (None, 0)，
+        密钥都在冷却或超出配额时返回 (None, 需等待的秒数)"""
+        with self._lock:
+            now = time.monotonic()
+            ready = [key for key in self.keys if not key.wait_time(now)]
+            endpoints = [endpoint for endpoint in self.endpoints if endpoint.breaker.state != CircuitBreaker.OPEN
+                         or not endpoint.breaker.retry_in()]
+            if not endpoints:
+                return None, 0
+            if not ready:
+                return None, min(key.wait_time(now) for key in self.keys)
+            endpoints.sort(key=Endpoint.score)
+            # 熔断器半开时 allow() 只放行一个探测请求，依次尝试下一个地址
+            endpoint = next((endpoint for endpoint in endpoints if endpoint.breaker.allow()), None)
+            if endpoint is None:
+                return None, 0
+            # 平滑加权轮转
+            total = sum(key.weight for key in ready)
+            for key in ready:
+                key.current += key.weight
+            key = max(ready, key=lambda item: item.current)
+            key.current -= total
+            key._used.append(now)
+            key.requests += 1
+            endpoint.in_flight += 1
+            endpoint.requests += 1
+            return Route(endpoint, key), 0
+
+    def release(self, route, outcome, latency=None, retry_after=None):
+        """记录一次请求的结果
+
+        outcome: ok（含客户端错误，说明服务可用）、error（5xx、超时、连接失败）、
+        throttled（429）、rejected（密钥被拒绝）
+        """
+        endpoint, key = route.endpoint, route.key
+        with self._lock:
+            endpoint.in_flight = max(0, endpoint.in_flight - 1)
+            failed = outcome == "error"
+            endpoint.error_rate += ((1.0 if failed else 0.0) - endpoint.error_rate) * self.latency_alpha
+            if failed:
+                endpoint.failures += 1
+            elif latency is not None:
+                if endpoint.latency is None:
+                    endpoint.latency = latency
+                else:
+                    endpoint.latency += (latency - endpoint.latency) * self.latency_alpha
+            now = time.monotonic()
+            if outcome == "throttled" and (retry_after is not None or len(self.keys) > 1):
+                # 只有一个密钥且服务端未给出等待时间时，交给重试退避和限流器处理
+                key.cooldown_until = now + (retry_after if retry_after is not None else self.throttle_cooldown)
+            elif outcome == "rejected":
+                key.cooldown_until = now + self.rejected_cooldown
+        if failed:
+            endpoint.breaker.record_failure()
+        else:
+            endpoint.breaker.record_success()
+
+    def has_spare_key(self, route):
+        """除本次使用的密钥外是否还有可用的密钥"""
+        with self._lock:
+            now = time.monotonic()
+            return any(key is not route.key and not key.wait_time(now) for key in self.keys)
+
+    def can_fail_over(self, route, outcome):
+        """失败后能否立即换用其他地址（服务端错误）或其他密钥（限流、拒绝）重试"""
+        if outcome in ("throttled", "rejected"):
+            return self.has_spare_key(route)
+        if outcome == "error":
+            return any(endpoint is not route.endpoint and endpoint.breaker.state == CircuitBreaker.CLOSED
+                       for endpoint in self.endpoints)
+        return False
+
+    def retry_in(self):
+        """所有地址都熔断时，距离最早可探测的秒数"""
+        return min(endpoint.breaker.retry_in() for endpoint in self.endpoints)
+
+    @property
+    def state(self):
+        """整体熔断状态：有任一地址可用即为 closed"""
+        states = {endpoint.breaker.state for endpoint in self.endpoints}
+        for state in (CircuitBreaker.CLOSED, CircuitBreaker.HALF_OPEN):
+            if state in states:
+                return state
+        return CircuitBreaker.OPEN
+
+    def snapshot(self):
+        """各地址和密钥的当前状态"""
+        with self._lock:
+            now = time.monotonic()
+            return {
+                "endpoints": [{
+                    "url": endpoint.url,
+                    "weight": endpoint.weight,
+                    "state": endpoint.breaker.state,
+                    "latency": round(endpoint.latency, 4) if endpoint.latency is not None else None,
+                    "error_rate": round(endpoint.error_rate, 3),
+                    "in_flight": endpoint.in_flight,
+                    "requests": endpoint.requests,
+                    "failures": endpoint.failures
+                } for endpoint in self.endpoints],
+                "api_keys": [{
+                    "key": key.masked(),
+                    "weight": key.weight,
+                    "quota_per_minute": key.quota,
+                    "wait": round(key.wait_time(now), 3),
+                    "requests": key.requests
+                } for key in self.keys]
+            }
+
+# 每个请求记录的耗时阶段（秒）
+METRIC_PHASES = ("queue", "connect", "ttfb", "download", "decode", "write", "total")
+
+# 统计建立新连接（TCP+TLS握手）耗时，按线程记录，供当前请求读取
+_connect_timing = threading.local()
+
+def _timed_pool_classes():
+    """构造在建立连接时计时的urllib3连接池类"""
+    from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+    
+    def timed(connection_cls):
+        class TimedConnection(connection_cls):
+            def connect(self):
+                started = time.monotonic()
+                try:
+                    return super().connect()
+                finally:
+                    _connect_timing.seconds = (
+                        getattr(_connect_timing, "seconds", 0.0) + time.monotonic() - started
+                    )
+        return TimedConnection
+    
+    class TimedHTTPConnectionPool(HTTPConnectionPool):
+        ConnectionCls = timed(HTTPConnectionPool.ConnectionCls)
     
-    def get_headers(self):
-        """获取API请求头"""
+    class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+        ConnectionCls = timed(HTTPSConnectionPool.ConnectionCls)
+    
+    return {"http": TimedHTTPConnectionPool, "https": TimedHTTPSConnectionPool}
+
+def percentile(sorted_values, q):
+    """最近秩法计算分位数，sorted_values 需已排序"""
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(q / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+class RequestMetrics:
+    """请求耗时和字节数统计
+
+    每个 (阶段, 声音配置, 后端) 保留最近 window 个样本，用于计算滚动的
+    p50/p95/p99；请求数和字节数为累计值。可导出为JSON或Prometheus文本格式。
+    """
+
+    QUANTILES = (50, 95, 99)
+
+    def __init__(self, window=1000):
+        self.window = max(1, int(window))
+        self._samples = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def record(self, profile, backend, status, timings, payload_bytes=0, audio_bytes=0):
+        """记录一次请求的各阶段耗时和字节数"""
+        labels = (profile, backend)
+        with self._lock:
+            for phase in METRIC_PHASES:
+                if timings.get(phase) is not None:
+                    samples = self._samples.get((phase,) + labels)
+                    if samples is None:
+                        samples = self._samples[(phase,) + labels] = deque(maxlen=self.window)
+                    samples.append(timings[phase])
+            for name, amount in (("requests", 1), ("payload_bytes", payload_bytes),
+                                 ("audio_bytes", audio_bytes)):
+                key = (name, status) + labels if name == "requests" else (name,) + labels
+                self._counters[key] = self._counters.get(key, 0) + amount
+        logger.debug(
+            "TTS请求 profile=%s backend=%s status=%s payload=%dB audio=%dB %s",
+            profile, backend, status, payload_bytes, audio_bytes,
+            " ".join(f"{phase}={timings[phase]:.3f}s" for phase in METRIC_PHASES
+                     if timings.get(phase) is not None)
+        )
+
+    def count(self, name, status=None, profile=None, backend=None):
+        """汇总计数器，可按状态、声音配置和后端过滤"""
+        total = 0
+        with self._lock:
+            for key, value in self._counters.items():
+                if key[0] != name:
+                    continue
+                labels = key[2:] if name == "requests" else key[1:]
+                if name == "requests" and status is not None and key[1] != status:
+                    continue
+                if profile is not None and labels[0] != profile:
+                    continue
+                if backend is not None and labels[1] != backend:
+                    continue
+                total += value
+        return total
+
+    def snapshot(self):
+        """返回当前统计的快照（可直接序列化为JSON）"""
+        with self._lock:
+            samples = {key: sorted(values) for key, values in self._samples.items()}
+            counters = dict(self._counters)
+        
+        phases = []
+        for (phase, profile, backend), values in sorted(samples.items()):
+            entry = {"phase": phase, "profile": profile, "backend": backend, "count": len(values)}
+            for q in self.QUANTILES:
+                entry[f"p{q}"] = round(percentile(values, q), 4)
+            phases.append(entry)
+        
+        totals = []
+        for key, value in sorted(counters.items()):
+            if key[0] == "requests":
+                totals.append({"name": "requests", "status": key[1],
+                               "profile": key[2], "backend": key[3], "value": value})
+            else:
+                totals.append({"name": key[0], "profile": key[1], "backend": key[2], "value": value})
+        return {"generated_at": datetime.now().isoformat(), "phases": phases, "counters": totals}
+
+    def to_prometheus(self):
+        """导出为Prometheus文本格式"""
+        snapshot = self.snapshot()
+        lines = [
+            "# HELP fish_tts_phase_seconds Per-request latency by phase (rolling window)",
+            "# TYPE fish_tts_phase_seconds summary"
+        ]
+        for entry in snapshot["phases"]:
+            labels = f'phase="{entry["phase"]}",profile="{entry["profile"]}",backend="{entry["backend"]}"'
+            for q in self.QUANTILES:
+                lines.append(f'fish_tts_phase_seconds{{{labels},quantile="{q / 100}"}} {entry[f"p{q}"]}')
+            lines.append(f"fish_tts_phase_seconds_count{{{labels}}} {entry['count']}")
+        
+        helps = {
+            "requests": "Total /tts requests by status",
+            "payload_bytes": "Total request payload bytes sent",
+            "audio_bytes": "Total audio bytes written"
+        }
+        for name, help_text in helps.items():
+            lines.append(f"# HELP fish_tts_{name}_total {help_text}")
+            lines.append(f"# TYPE fish_tts_{name}_total counter")
+            for entry in snapshot["counters"]:
+                if entry["name"] != name:
+                    continue
+                labels = f'profile="{entry["profile"]}",backend="{entry["backend"]}"'
+                if name == "requests":
+                    labels = f'status="{entry["status"]}",' + labels
+                lines.append(f"fish_tts_{name}_total{{{labels}}} {entry['value']}")
+        return "\n".join(lines) + "\n"
+
+    def export(self, path):
+        """导出统计到文件：.json 为JSON快照，其他扩展名为Prometheus文本格式"""
+        if path.lower().endswith(".json"):
+            data = json.dumps(self.snapshot(), ensure_ascii=False, indent=2)
+        else:
+            data = self.to_prometheus()
+        write_file_atomic(path, [data.encode("utf-8")])
+        return path
+
+class AudioCache:
+    """按请求内容哈希寻址的磁盘音频缓存（按总大小做LRU淘汰）"""
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # 文件名 -> 文件大小，越靠后越是最近使用
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self._load_index()
+
+    @staticmethod
+    def make_key(payload):
+        """根据完整请求体计算缓存键"""
+        raw = json.dumps(payload, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _load_index(self):
+        """扫描缓存目录，按修改时间恢复LRU顺序"""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        found = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                st = entry.stat()
+                found.append((st.st_mtime, entry.name, st.st_size))
+        for _, name, size in sorted(found):
+            self._entries[name] = size
+            self._total_bytes += size
+
+    def _path(self, name):
+        return os.path.join(self.cache_dir, name)
+
+    def get(self, key, format, count=True):
+        """查找缓存，命中时返回缓存文件路径；count=False 时不计入命中统计"""
+        name = f"{key}.{format}"
+        with self._lock:
+            if name not in self._entries:
+                self.misses += count
+                return None
+            self._entries.move_to_end(name)
+            self.hits += count
+        path = self._path(name)
+        try:
+            # 更新修改时间，重启后仍能保持LRU顺序
+            os.utime(path, None)
+        except OSError:
+            # 缓存文件被外部删除
+            with self._lock:
+                self._total_bytes -= self._entries.pop(name, 0)
+                self.hits -= count
+                self.misses += count
+            return None
+        return path
+
+    def record_miss(self):
+        """记一次未命中（调用方先用 count=False 探测过缓存时使用）"""
+        with self._lock:
+            self.misses += 1
+
+    def put_file(self, key, format, src_path):
+        """把已生成的音频文件复制进缓存"""
+        name = f"{key}.{format}"
+        path = self._path(name)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        shutil.copyfile(src_path, tmp_path)
+        os.replace(tmp_path, path)
+        size = os.path.getsize(path)
+        with self._lock:
+            self._total_bytes -= self._entries.pop(name, 0)
+            self._entries[name] = size
+            self._total_bytes += size
+            self._evict()
+
+    def _evict(self):
+        """淘汰最久未使用的条目直到总大小不超过上限（调用方持有锁）"""
+        while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+            name, size = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            try:
+                os.remove(self._path(name))
+            except OSError:
+                pass
+
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            for name in self._entries:
+                try:
+                    os.remove(self._path(name))
+                except OSError:
+                    pass
+            self._entries.clear()
+            self._total_bytes = 0
+
+    def stats(self):
+        """返回缓存统计信息"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
+
+class HistoryStore:
+    """基于SQLite的生成历史记录（只追加，带索引，不限条数）"""
+
+    COLUMNS = ("id", "timestamp", "text", "voice_profile", "backend", "speed", "filename")
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            # WAL模式下追加写入不会阻塞读取
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS history (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    timestamp TEXT NOT NULL,
+                    text TEXT NOT NULL,
+                    voice_profile TEXT,
+                    backend TEXT,
+                    speed REAL,
+                    filename TEXT
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_history_timestamp ON history (timestamp)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_history_profile ON history (voice_profile)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_history_backend ON history (backend)")
+
+    def append(self, record):
+        """追加一条历史记录"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO history (timestamp, text, voice_profile, backend, speed, filename) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (record["timestamp"], record["text"], record.get("voice_profile"),
+                 record.get("backend"), record.get("speed"), record.get("filename"))
+            )
+
+    def _where(self, text=None, profile=None, backend=None, since=None, until=None):
+        """构造查询条件；since/until 为ISO格式时间，until不包含在内"""
+        clauses, params = [], []
+        if text:
+            clauses.append("text LIKE ?")
+            params.append(f"%{text}%")
+        if profile:
+            clauses.append("voice_profile = ?")
+            params.append(profile)
+        if backend:
+            clauses.append("backend = ?")
+            params.append(backend)
+        if since:
+            clauses.append("timestamp >= ?")
+            params.append(since)
+        if until:
+            clauses.append("timestamp < ?")
+            params.append(until)
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        return where, params
+
+    def search(self, text=None, profile=None, backend=None, since=None, until=None,
+               page=1, page_size=10):
+        """分页查询历史记录（按时间倒序），page从1开始"""
+        where, params = self._where(text, profile, backend, since, until)
+        offset = (max(1, page) - 1) * page_size
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {', '.join(self.COLUMNS)} FROM history{where} "
+                "ORDER BY timestamp DESC, id DESC LIMIT ? OFFSET ?",
+                params + [page_size, offset]
+            ).fetchall()
+        return [dict(zip(self.COLUMNS, row)) for row in rows]
+
+    def count(self, text=None, profile=None, backend=None, since=None, until=None):
+        """统计符合条件的记录数"""
+        where, params = self._where(text, profile, backend, since, until)
+        with self._lock:
+            return self._conn.execute(f"SELECT COUNT(*) FROM history{where}", params).fetchone()[0]
+
+    def clear(self):
+        """清空历史记录"""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM history")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+class JobJournal:
+    """批量任务的预写日志（SQLite）
+
+    每条任务按 pending -> inflight -> done/failed 记录状态，完成时记下输出位置和大小。
+    进程中途退出后重新运行同一清单，只重新请求未完成或输出文件已丢失的任务。
+    """
+
+    COLUMNS = ("run", "job", "idx", "payload_hash", "state", "output", "size", "attempts", "error", "updated")
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            # 每次状态变化都落盘，崩溃后不会丢失已完成的记录
+            self._conn.execute("PRAGMA synchronous=FULL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    run TEXT NOT NULL,
+                    job TEXT NOT NULL,
+                    idx INTEGER,
+                    payload_hash TEXT,
+                    state TEXT NOT NULL,
+                    output TEXT,
+                    size INTEGER,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    error TEXT,
+                    updated TEXT,
+                    PRIMARY KEY (run, job)
+                )
+            """)
+
+    def begin(self, run, jobs):
+        """登记一批任务（已有记录保持原状态），返回 job -> 已有记录"""
+        now = datetime.now().isoformat()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO jobs (run, job, idx, payload_hash, state, updated) VALUES (?, ?, ?, ?, 'pending', ?) "
+                "ON CONFLICT (run, job) DO UPDATE SET idx = excluded.idx",
+                [(run, job["job"], job["index"], job["payload_hash"], now) for job in jobs]
+            )
+            rows = self._conn.execute(
+                f"SELECT {', '.join(self.COLUMNS)} FROM jobs WHERE run = ?", (run,)
+            ).fetchall()
+        return {row[1]: dict(zip(self.COLUMNS, row)) for row in rows}
+
+    def mark(self, run, job, state, output=None, size=None, error=None):
+        """更新任务状态；进入 inflight 时累加尝试次数"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE jobs SET state = ?, output = COALESCE(?, output), size = COALESCE(?, size), error = ?, "
+                "attempts = attempts + ?, updated = ? WHERE run = ? AND job = ?",
+                (state, output, size, error, 1 if state == "inflight" else 0,
+                 datetime.now().isoformat(), run, job)
+            )
+
+    @staticmethod
+    def output_size(output, pack=None):
+        """输出文件（或归档片段）的当前大小，不存在时返回 None
+
+        归档片段通过 pack 的索引查找；没有传入对应的归档时视为不存在。
+        """
+        locator = parse_pack_locator(output or "")
+        if locator:
+            path, key = locator
+            if pack is None or os.path.abspath(path) != os.path.abspath(pack.path):
+                return None
+            entry = pack.get(key)
+            return entry["length"] if entry else None
+        try:
+            return os.path.getsize(output)
+        except (OSError, TypeError):
+            return None
+
+    @classmethod
+    def verify(cls, row, pack=None):
+        """已完成的任务输出是否仍然存在且大小与记录一致"""
+        return (row is not None and row["state"] == "done" and bool(row["size"])
+                and cls.output_size(row["output"], pack) == row["size"])
+
+    def counts(self, run):
+        """按状态统计某次运行的任务数"""
+        with self._lock:
+            rows = self._conn.execute("SELECT state, COUNT(*) FROM jobs WHERE run = ? GROUP BY state", (run,))
+            return dict(rows.fetchall())
+
+    def reset(self, run):
+        """丢弃某次运行的全部记录"""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM jobs WHERE run = ?", (run,))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+PACK_LOCATOR_RE = re.compile(r"^(?P<path>.+)#(?P<key>[0-9a-f]{64})$")
+
+def pack_locator(path, key):
+    """归档中片段的位置字符串（记录在历史中代替文件路径）
+
+    只记录key，偏移和长度每次通过索引查找，compact() 之后位置依然有效。
+    """
+    return f"{path}#{key}"
+
+def parse_pack_locator(value):
+    """解析 pack_locator 生成的字符串，返回 (归档路径, key)；不是归档位置时返回None"""
+    match = PACK_LOCATOR_RE.match(value or "")
+    if not match:
+        return None
+    return match.group("path"), match.group("key")
+
+class ClipPack:
+    """把大量音频片段追加写入单个归档文件，避免产生海量小文件
+
+    数据文件 <path> 只追加；索引 <path>.idx 每行一条JSON记录
+    （key、offset、length、format、meta），删除写入墓碑记录，打开时重放。
+    读取通过 mmap 随机访问，compact() 重写归档以回收已删除片段的空间。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.index_path = path + ".idx"
+        self._lock = threading.RLock()
+        self._entries = {}
+        self._map = None
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._recover_compaction()
+        self._data = open(path, "ab")
+        self._load_index()
+        self._index = open(self.index_path, "a", encoding="utf-8")
+
+    def _recover_compaction(self):
+        """处理 compact 中途崩溃留下的文件
+
+        新数据文件尚未替换时丢弃新文件；数据已替换而索引未替换时补上索引替换。
+        """
+        if os.path.exists(self.path + ".compact"):
+            os.remove(self.path + ".compact")
+            if os.path.exists(self.index_path + ".new"):
+                os.remove(self.index_path + ".new")
+        elif os.path.exists(self.index_path + ".new"):
+            os.replace(self.index_path + ".new", self.index_path)
+
+    def _load_index(self):
+        """重放索引；数据不完整的条目（写数据后、写索引前崩溃）直接忽略"""
+        if not os.path.exists(self.index_path):
+            return
+        size = os.path.getsize(self.path)
+        with open(self.index_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry.get("deleted"):
+                    self._entries.pop(entry["key"], None)
+                elif entry["offset"] + entry["length"] <= size:
+                    self._entries[entry["key"]] = entry
+
+    def _append_index(self, entry):
+        self._index.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._index.flush()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def get(self, key):
+        """返回片段的索引记录，不存在时返回None"""
+        with self._lock:
+            return self._entries.get(key)
+
+    def entries(self):
+        with self._lock:
+            return list(self._entries.values())
+
+    def add_file(self, key, src_path, format, meta=None):
+        """把音频文件追加进归档并返回索引记录；相同key已存在时直接返回已有记录"""
+        with self._lock:
+            if key in self._entries:
+                return self._entries[key]
+            offset = self._data.seek(0, os.SEEK_END)
+            with open(src_path, "rb") as src:
+                shutil.copyfileobj(src, self._data, 64 * 1024)
+            self._data.flush()
+            entry = {"key": key, "offset": offset, "length": self._data.tell() - offset,
+                     "format": format, "meta": meta or {}}
+            self._append_index(entry)
+            self._entries[key] = entry
+            return entry
+
+    def remove(self, key):
+        """删除片段（空间在 compact 时回收）"""
+        with self._lock:
+            if self._entries.pop(key, None) is None:
+                return False
+            self._append_index({"key": key, "deleted": True})
+            return True
+
+    def _view(self, offset, length):
+        """返回归档 [offset, offset+length) 区间的内存映射视图（调用方持有锁）"""
+        end = offset + length
+        if length == 0:
+            return memoryview(b"")
+        if self._map is None or len(self._map) < end:
+            if self._map is not None:
+                self._map.close()
+            self._data.flush()
+            with open(self.path, "rb") as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._map) < end:
+            raise ValueError(f"归档数据不完整: {self.path}")
+        return memoryview(self._map)[offset:end]
+
+    def read(self, key=None, offset=None, length=None):
+        """按key或 (offset, length) 读取片段数据"""
+        with self._lock:
+            if key is not None:
+                entry = self._entries.get(key)
+                if entry is None:
+                    raise KeyError(key)
+                offset, length = entry["offset"], entry["length"]
+            with self._view(offset, length) as view:
+                return view.tobytes()
+
+    def extract(self, key, dest_path):
+        """把片段导出为独立文件"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                raise KeyError(key)
+            directory = os.path.dirname(dest_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with self._view(entry["offset"], entry["length"]) as view:
+                write_file_atomic(dest_path, [view])
+        return dest_path
+
+    def compact(self):
+        """重写归档和索引，只保留有效片段；返回回收的字节数"""
+        with self._lock:
+            before = os.path.getsize(self.path)
+            tmp_path = self.path + ".compact"
+            entries = sorted(self._entries.values(), key=lambda entry: entry["offset"])
+            compacted = {}
+            with open(tmp_path, "wb") as out:
+                for entry in entries:
+                    with self._view(entry["offset"], entry["length"]) as view:
+                        compacted[entry["key"]] = dict(entry, offset=out.tell())
+                        out.write(view)
+                out.flush()
+                os.fsync(out.fileno())
+            index_data = "".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in compacted.values())
+            
+            # 先写好新索引再依次替换数据和索引，中途崩溃由 _recover_compaction 收尾
+            self._close_files()
+            write_file_atomic(self.index_path + ".new", [index_data.encode("utf-8")])
+            os.replace(tmp_path, self.path)
+            os.replace(self.index_path + ".new", self.index_path)
+            self._entries = compacted
+            self._data = open(self.path, "ab")
+            self._index = open(self.index_path, "a", encoding="utf-8")
+            return before - os.path.getsize(self.path)
+
+    def stats(self):
+        with self._lock:
+            live = sum(entry["length"] for entry in self._entries.values())
+            size = os.path.getsize(self.path)
+            return {"entries": len(self._entries), "bytes": size, "live_bytes": live, "garbage_bytes": size - live}
+
+    def _close_files(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._data.close()
+        self._index.close()
+
+    def close(self):
+        with self._lock:
+            self._close_files()
+
+class TTSManager:
+    def __init__(self):
+        # 批量并发生成时保护配置和历史记录的写入
+        self._lock = threading.RLock()
+        # 配置延迟写盘：记录上次写入的内容，只在内容变化时合并写入
+        self._saved_snapshot = None
+        self._flush_timer = None
+        self._flush_lock = threading.Lock()
+        self.config = self.load_config()
+        # 确保"last_used"字典中有"output"键
+        self.current_voice = self.config["last_used"].get("voice", "default")
+        self.current_output_path = self.config["last_used"].get("output", "default")
+        self.timeouts = AdaptiveTimeouts(self.config["timeouts"])
+        self.timeouts.load(TIMEOUTS_FILE)
+        # 观测值已改存状态文件，不再写回配置
+        self.config["timeouts"].pop("observed", None)
+        if os.path.exists(CONFIG_FILE):
+            self._saved_snapshot = self._serialize_config()
+        # 磁盘缓存（要扫描整个缓存目录）和历史数据库在首次使用时打开，
+        # 不需要它们的命令（如 profiles）启动时不必付出这部分开销
+        self._cache = None
+        self._cache_lock = threading.Lock()
+        self._history = None
+        self._history_lock = threading.Lock()
+        # 上游地址和密钥的路由（含各地址的熔断器）在首次请求时创建
+        self._router = None
+        self._router_lock = threading.Lock()
+        self.metrics = RequestMetrics(self.config["metrics"].get("window", 1000))
+        # 长连接池在首次请求时创建，请求头在密钥变化时才重建
+        self._session = None
+        self._session_lock = threading.Lock()
+        self._headers = {}
+        # 进行中的上游请求（按请求内容键），用于合并相同的并发请求
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+        # 片段归档在首次使用时打开
+        self._pack = None
+        self._pack_lock = threading.Lock()
+        # 批量任务日志在首次批量生成时打开
+        self._journal = None
+        self._journal_lock = threading.Lock()
+        # 优先级调度器在首次使用时启动工作线程
+        self._scheduler = None
+        self._scheduler_lock = threading.Lock()
+        # 退出时写入尚未保存的配置和超时观测值
+        atexit.register(self.flush_config)
+        atexit.register(self.save_timeouts)
+    
+    def load_config(self):
+        """加载配置文件"""
+        if os.path.exists(CONFIG_FILE):
+            try:
+                with open(CONFIG_FILE, "r") as f:
+                    config = json.load(f)
+                    # 添加缺失字段
+                    config.setdefault("output_paths", DEFAULT_CONFIG["output_paths"].copy())
+                    config.setdefault("format_options", DEFAULT_CONFIG["format_options"].copy())
+                    config.setdefault("backend_options", DEFAULT_CONFIG["backend_options"].copy())
+                    config.setdefault("cache", DEFAULT_CONFIG["cache"].copy())
+                    config.setdefault("http", DEFAULT_CONFIG["http"].copy())
+                    config.setdefault("batch", DEFAULT_CONFIG["batch"].copy())
+                    config.setdefault("async", DEFAULT_CONFIG["async"].copy())
+                    config.setdefault("segment", DEFAULT_CONFIG["segment"].copy())
+                    config.setdefault("pipeline", DEFAULT_CONFIG["pipeline"].copy())
+                    config.setdefault("scheduler", DEFAULT_CONFIG["scheduler"].copy())
+                    config.setdefault("timeouts", DEFAULT_CONFIG["timeouts"].copy())
+                    config.setdefault("retry", DEFAULT_CONFIG["retry"].copy())
+                    config.setdefault("circuit_breaker", DEFAULT_CONFIG["circuit_breaker"].copy())
+                    config.setdefault("routing", DEFAULT_CONFIG["routing"].copy())
+                    config.setdefault("rate_limit", DEFAULT_CONFIG["rate_limit"].copy())
+                    config.setdefault("metrics", DEFAULT_CONFIG["metrics"].copy())
+                    config.setdefault("postprocess", DEFAULT_CONFIG["postprocess"].copy())
+                    config.setdefault("pack", DEFAULT_CONFIG["pack"].copy())
+                    config.setdefault("output_layout", DEFAULT_CONFIG["output_layout"].copy())
+                    config.setdefault("journal", DEFAULT_CONFIG["journal"].copy())
+                    config.setdefault("config_flush_interval", DEFAULT_CONFIG["config_flush_interval"])
+                    config.setdefault("last_used", DEFAULT_CONFIG["last_used"].copy())
+                    
+                    # 确保"last_used"字典中有"voice"和"output"键
+                    config["last_used"].setdefault("voice", "default")
+                    config["last_used"].setdefault("output", "default")
+                    
+                    # 确保每个声音配置都有voice_id字段
+                    for name, profile in config["voices"].items():
+                        profile.setdefault("voice_id", "default")
+                    
+                    return config
+            except:
+                return DEFAULT_CONFIG.copy()
+        return DEFAULT_CONFIG.copy()
+    
+    def _migrate_history(self, history):
+        """把旧版保存在配置文件中的历史记录迁移到历史数据库"""
+        old_history = self.config.pop("history", None)
+        if not old_history:
+            return
+        # 旧记录按时间倒序保存，按先后顺序写入
+        for record in reversed(old_history):
+            history.append(record)
+        self.save_config()
+
+    def _serialize_config(self):
+        """把当前配置序列化为待写入的JSON文本"""
+        # 更新最后使用配置
+        self.config["last_used"] = {
+            "voice": self.current_voice,
+            "output": self.current_output_path
+        }
+        return json.dumps(self.config, indent=2)
+
+    def save_config(self):
+        """保存配置文件
+
+        不会立即写盘：在 config_flush_interval 秒内的多次保存会合并为一次写入，
+        程序退出时也会写入尚未保存的修改。间隔为0时立即写入。
+        """
+        interval = self.config.get("config_flush_interval", 2.0)
+        if interval <= 0:
+            self.flush_config()
+            return
+        with self._lock:
+            if self._flush_timer is None:
+                self._flush_timer = threading.Timer(interval, self.flush_config)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+    def flush_config(self):
+        """立即写入配置文件（内容未变化时跳过），先写临时文件再原子重命名"""
+        # 写盘时不持有配置锁，避免慢速存储阻塞正在生成的任务
+        with self._flush_lock:
+            with self._lock:
+                if self._flush_timer is not None:
+                    self._flush_timer.cancel()
+                    self._flush_timer = None
+                data = self._serialize_config()
+            if data == self._saved_snapshot:
+                return False
+            write_file_atomic(CONFIG_FILE, [data.encode("utf-8")])
+            self._saved_snapshot = data
+            return True
+
+    def save_timeouts(self):
+        """写入观测到的各后端吞吐，下次启动时直接用于估算超时（没有新观测时跳过）"""
+        try:
+            return self.timeouts.save(TIMEOUTS_FILE)
+        except OSError as e:
+            logger.warning(f"保存超时观测值失败: {e}")
+            return False
+    
+    def get_headers(self, api_key=None):
+        """获取API请求头（每个密钥只构造一次），默认使用配置中的 api_key"""
+        if api_key is None:
+            api_key = self.config["api_key"]
+        headers = self._headers.get(api_key)
+        if headers is None:
+            headers = self._headers[api_key] = {
+                "Authorization": f"Bearer {api_key}",
+                "Content-Type": "application/json",
+                "User-Agent": "FishAudioTTS/2.0"
+            }
+        return headers
+
+    @property
+    def router(self):
+        """上游地址和密钥的路由（懒加载，见 routing 配置）"""
+        if self._router is None:
+            with self._router_lock:
+                if self._router is None:
+                    self._router = EndpointRouter.from_config(self.config, API_BASE_URL)
+        return self._router
+
+    @property
+    def limiter(self):
+        """当前API密钥共享的限流器，未启用限流时为None"""
+        return self.limiter_for(self.config["api_key"])
+
+    def limiter_for(self, api_key):
+        """指定API密钥共享的限流器，未启用限流时为None"""
+        settings = self.config["rate_limit"]
+        if not settings.get("enabled", True):
+            return None
+        return get_shared_limiter(api_key, settings)
+
+    def rate_limit_state(self):
+        """返回限流器当前状态（未启用时为None）"""
+        limiter = self.limiter
+        return limiter.snapshot() if limiter else None
+
+    @property
+    def cache(self):
+        """磁盘音频缓存（懒加载）"""
+        if self._cache is None:
+            with self._cache_lock:
+                if self._cache is None:
+                    cache_config = self.config["cache"]
+                    self._cache = AudioCache(cache_config["dir"], int(cache_config["max_mb"] * 1024 * 1024))
+        return self._cache
+
+    @property
+    def history(self):
+        """历史记录数据库（懒加载，首次打开时迁移旧版配置中的历史）"""
+        if self._history is None:
+            with self._history_lock:
+                if self._history is None:
+                    history = HistoryStore(HISTORY_FILE)
+                    self._migrate_history(history)
+                    self._history = history
+        return self._history
+
+    @property
+    def pack(self):
+        """片段归档（懒加载）"""
+        if self._pack is None:
+            with self._pack_lock:
+                if self._pack is None:
+                    self._pack = ClipPack(self.config["pack"].get("path", "Fish_tts_clips.pack"))
+        return self._pack
+
+    @property
+    def scheduler(self):
+        """优先级调度器（懒加载，见 scheduler 配置）"""
+        if self._scheduler is None:
+            with self._scheduler_lock:
+                if self._scheduler is None:
+                    settings = self.config["scheduler"]
+                    self._scheduler = SynthesisScheduler(
+                        self, settings.get("workers", 4), settings.get("interactive_reserve", 1),
+                        settings.get("deadline_policy", "demote"), settings.get("stats_window", 1000)
+                    )
+        return self._scheduler
+
+    @property
+    def journal(self):
+        """批量任务日志（懒加载），未启用时为 None"""
+        if self._journal is None and self.config["journal"].get("enabled", True):
+            with self._journal_lock:
+                if self._journal is None:
+                    self._journal = JobJournal(self.config["journal"].get("path", JOURNAL_FILE))
+        return self._journal
+
+    def _archive_output(self, filename, text, profile_name, voice_profile, speed):
+        """启用归档输出时把生成的文件移入归档，返回历史中记录的位置；未启用时返回原文件名"""
+        if not self.config["pack"].get("enabled", False):
+            return filename
+        payload = self.build_payload(text, voice_profile, speed)
+        entry = self.pack.add_file(AudioCache.make_key(payload), filename, voice_profile["format"], {
+            "text": text[:100],
+            "profile": profile_name,
+            "created": datetime.now().isoformat()
+        })
+        os.remove(filename)
+        return pack_locator(self.pack.path, entry["key"])
+
+    def read_clip(self, location):
+        """读取音频数据：location 可以是文件路径、归档位置（见 pack_locator）或归档中的key"""
+        locator = parse_pack_locator(location)
+        if locator:
+            path, key = locator
+            if os.path.abspath(path) == os.path.abspath(self.pack.path):
+                return self.pack.read(key)
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"归档不存在: {path}")
+            pack = ClipPack(path)
+            try:
+                return pack.read(key)
+            finally:
+                pack.close()
+        if location in self.pack:
+            return self.pack.read(location)
+        with open(location, "rb") as f:
+            return f.read()
+
+    @property
+    def session(self):
+        """获取共享的长连接HTTP会话（懒加载）"""
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    self._session = self._create_session()
+        return self._session
+
+    def _create_session(self):
+        """创建带连接池的HTTP会话"""
+        import requests
+        from requests.adapters import HTTPAdapter
+        
+        http_config = self.config["http"]
+        pool_size = max(1, int(http_config.get("pool_size", 10)))
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        # 替换连接池类，以便统计新建连接的耗时
+        adapter.poolmanager.pool_classes_by_scheme = _timed_pool_classes()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        if not http_config.get("keep_alive", True):
+            session.headers["Connection"] = "close"
+        return session
+
+    def warm_up(self, connections=None):
+        """预热连接池：并发发起轻量请求，提前完成TCP+TLS握手"""
+        if connections is None:
+            connections = self.config["http"].get("pool_size", 10)
+        connections = max(1, int(connections))
+        
+        # 连接分摊到各个上游地址
+        urls = [endpoint.url for endpoint in self.router.endpoints]
+        
+        def ping(index):
+            try:
+                self.session.head(f"{urls[index % len(urls)]}/voices", headers=self.get_headers(),
+                                  timeout=self.timeouts.probe_timeout())
+                return True
+            except Exception:
+                return False
+        
+        with ThreadPoolExecutor(max_workers=connections) as executor:
+            return sum(executor.map(ping, range(connections)))
+
+    def close(self):
+        """关闭连接池和历史数据库，并写入未保存的配置和超时观测值"""
+        if self._scheduler is not None:
+            self._scheduler.shutdown(cancel_pending=True)
+        self.flush_config()
+        self.save_timeouts()
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+        if self._pack is not None:
+            self._pack.close()
+        if self._journal is not None:
+            self._journal.close()
+        if self._history is not None:
+            self._history.close()
+    
+    def set_api_key(self, key):
+        """设置API密钥"""
+        self.config["api_key"] = key
+        self.save_config()
+        # 未单独配置 routing.api_keys 时路由使用这个密钥，下次请求时重建
+        with self._router_lock:
+            self._router = None
+        return "🔑 API密钥已保存！"
+    
+    def create_voice_profile(self, name, voice_id="default", backend="speech-1.6", format="mp3", temperature=0.7, 
+                            top_p=0.7, chunk_length=200, normalize=True, 
+                            prosody_volume=0.0):
+        """创建自定义声音配置"""
+        # 检查名称是否已存在
+        if name in self.config["voices"]:
+            return "⚠️ 配置名称已存在！"
+        
+        self.config["voices"][name] = {
+            "voice_id": voice_id,
+            "backend": backend,
+            "format": format,
+            "temperature": temperature,
+            "top_p": top_p,
+            "chunk_length": chunk_length,
+            "normalize": normalize,
+            "prosody_volume": prosody_volume
+        }
+        self.save_config()
+        return f"🎶 声音配置 '{name}' 已创建！"
+    
+    def edit_voice_profile(self, name, voice_id=None, backend=None, format=None, temperature=None, 
+                          top_p=None, chunk_length=None, normalize=None, 
+                          prosody_volume=None):
+        """编辑现有声音配置"""
+        if name not in self.config["voices"]:
+            return "⚠️ 配置不存在"
+        
+        profile = self.config["voices"][name]
+        if voice_id: profile["voice_id"] = voice_id
+        if backend: profile["backend"] = backend
+        if format: profile["format"] = format
+        if temperature: profile["temperature"] = temperature
+        if top_p: profile["top_p"] = top_p
+        if chunk_length: profile["chunk_length"] = chunk_length
+        if normalize is not None: profile["normalize"] = normalize
+        if prosody_volume: profile["prosody_volume"] = prosody_volume
+        
+        self.save_config()
+        return f"🎛️ 声音配置 '{name}' 已更新！"
+    
+    def delete_voice_profile(self, name):
+        """删除声音配置"""
+        if name == "default":
+            return "❌ 不能删除默认配置"
+            
+        if name in self.config["voices"]:
+            del self.config["voices"][name]
+            # 如果删除的是当前配置，重置为默认
+            if self.current_voice == name:
+                self.current_voice = "default"
+            self.save_config()
+            return f"🗑️ 声音配置 '{name}' 已删除！"
+        return "⚠️ 配置不存在"
+    
+    def add_output_path(self, name, path):
+        """添加输出路径配置"""
+        if name in self.config["output_paths"]:
+            return "⚠️ 路径名称已存在"
+        
+        # 创建目录
+        os.makedirs(path, exist_ok=True)
+        self.config["output_paths"][name] = path
+        self.save_config()
+        return f"📁 输出路径 '{name}' 已添加"
+    
+    def clear_history(self):
+        """清空历史记录"""
+        self.history.clear()
+        return "✅ 历史记录已清空！"
+    
+    def select_from_menu(self, title, options, current_value=None):
+        """显示选择菜单并获取用户选择"""
+        print(f"\n\033[1;36m{title}:\033[0m")
+        for i, option in enumerate(options, 1):
+            indicator = " (当前)" if current_value == option else ""
+            print(f"{i}. {option}{indicator}")
+        
+        choice = input("\n请选择: ")
+        if choice.strip() == "":
+            return current_value
+            
+        try:
+            index = int(choice) - 1
+            if 0 <= index < len(options):
+                return options[index]
+        except:
+            pass
+        return current_value if current_value else options[0]
+
+    def format_filename(self, text, format, content_key=None):
+        """根据文本生成文件名：文本前20个字符 + 时间戳 + 内容哈希
+
+        content_key 为请求内容的哈希（见 AudioCache.make_key），省略时按文本计算。
+        """
+        # 提取前20个字符作为文件名
+        clean_text = re.sub(r'[^a-zA-Z0-9\u4e00-\u9fa5]', '_', text[:20])
+        if not clean_text:
+            clean_text = "tts_audio"
+        timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+        if content_key is None:
+            content_key = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        digest = content_key[:max(4, int(self.config["output_layout"].get("hash_length", 10)))]
+        return f"{clean_text}_{timestamp}_{digest}.{format}"
+
+    def shard_dir(self, output_dir, content_key):
+        """按内容哈希前缀划分子目录（shard_depth 为0时不分目录）"""
+        layout = self.config["output_layout"]
+        depth = int(layout.get("shard_depth", 0))
+        width = max(1, int(layout.get("shard_width", 2)))
+        parts = [content_key[i * width:(i + 1) * width] for i in range(depth)]
+        return os.path.join(output_dir, *parts)
+
+    def test_api_connection(self):
+        """测试API连接状态：配置了多个上游地址时逐个测试，任一可用即成功"""
+        print("\n测试API连接...")
+        endpoints = self.router.endpoints
+        reachable = False
+        for endpoint in endpoints:
+            prefix = f"{endpoint.url}: " if len(endpoints) > 1 else ""
+            try:
+                response = self.session.head(
+                    f"{endpoint.url}/voices",
+                    headers=self.get_headers(),
+                    timeout=self.timeouts.probe_timeout()
+                )
+                if response.status_code == 200:
+                    if prefix:
+                        print(f"{prefix}✅")
+                    reachable = True
+                else:
+                    print(f"{prefix}❌ API响应异常 (状态码 {response.status_code})")
+            except Exception as e:
+                print(f"{prefix}❌ 无法连接到API: {str(e)}")
+        return reachable
+
+    def get_voice_profile(self, voice_profile_name=None):
+        """获取声音配置，返回 (配置名称, 配置内容)"""
+        # 如果没有指定声音配置，使用当前配置
+        profile_name = voice_profile_name if voice_profile_name is not None else self.current_voice
+        return profile_name, self.config["voices"].get(profile_name, {})
+
+    def build_payload(self, text, voice_profile, speed=1.0):
+        """根据文档构造请求体"""
+        return {
+            "text": text,
+            "reference_id": voice_profile["voice_id"],
+            "backend": voice_profile["backend"],
+            "format": voice_profile["format"],
+            "temperature": voice_profile["temperature"],
+            "top_p": voice_profile["top_p"],
+            "chunk_length": voice_profile["chunk_length"],
+            "normalize": voice_profile["normalize"],
+            "speed": speed,
+            "volume": voice_profile["prosody_volume"]
+        }
+
+    def add_history(self, text, profile_name, voice_profile, filename, speed):
+        """保存历史记录 - 使用配置名称而不是声音ID"""
+        self.history.append({
+            "text": text,
+            "voice_profile": profile_name,  # 使用配置名称
+            "backend": voice_profile["backend"],
+            "timestamp": datetime.now().isoformat(),
+            "filename": filename,
+            "speed": speed
+        })
+
+    def save_response_audio(self, response, filename, expected_format, timings=None):
+        """把音频响应写入文件，失败时返回错误信息
+
+        原始音频按块写入临时文件后原子重命名，内存占用与音频长度无关；
+        JSON响应需要完整读取后做一次Base64解码。
+        传入 timings 字典时记录 download、decode、write 耗时和 audio_bytes。
+        """
+        if timings is None:
+            timings = {}
+        started = time.monotonic()
+        chunk_size = int(self.config["http"].get("chunk_size", 65536))
+        chunks = response.iter_content(chunk_size=chunk_size)
+        # 先读取足够识别格式的文件头
+        head = b""
+        for chunk in chunks:
+            head += chunk
+            if len(head) >= 16:
+                break
+        
+        kind = sniff_audio_format(head, response.headers.get("Content-Type", ""), expected_format)
+        if kind == "json":
+            error = self.store_audio_body(kind, head + b"".join(chunks), filename, timings)
+            if error:
+                return error
+        elif kind is None:
+            # 可能是错误消息
+            return f"❌ 无效响应: {head[:200].decode('utf-8', 'replace')}"
+        else:
+            timings["decode"] = 0.0
+            timings["audio_bytes"] = write_file_atomic(filename, itertools.chain([head], chunks), timings)
+        # 下载耗时为读取响应体的总时间扣除解码和写文件
+        timings["download"] = max(
+            0.0, time.monotonic() - started - timings["decode"] - timings.get("write", 0.0)
+        )
+        return None
+
+    def read_response_audio(self, response, expected_format, timings=None):
+        """完整读取音频响应体（不解码、不写文件），供流水线的写入阶段使用
+
+        返回 (错误信息, 类型, 响应体)，类型同 sniff_audio_format。
+        """
+        if timings is None:
+            timings = {}
+        started = time.monotonic()
+        chunk_size = int(self.config["http"].get("chunk_size", 65536))
+        body = b"".join(response.iter_content(chunk_size=chunk_size))
+        timings["download"] = time.monotonic() - started
+        kind = sniff_audio_format(body[:16], response.headers.get("Content-Type", ""), expected_format)
+        if kind is None:
+            return f"❌ 无效响应: {body[:200].decode('utf-8', 'replace')}", None, body
+        timings["audio_bytes"] = len(body)
+        return None, kind, body
+
+    def store_audio_body(self, kind, body, filename, timings=None):
+        """把已读取的响应体写入文件（JSON响应先做Base64解码），失败时返回错误信息"""
+        if timings is None:
+            timings = {}
+        decode_started = time.monotonic()
+        if kind == "json":
+            body, error = decode_json_audio(body)
+            if error:
+                return error
+        timings["decode"] = time.monotonic() - decode_started
+        timings["audio_bytes"] = write_file_atomic(filename, [body], timings)
+        return None
+
+    def resolve_output_file(self, text, format, output_name=None, output_file=None, content_key=None):
+        """确定输出文件路径：显式文件路径 > 指定输出路径名称 > 当前输出路径
+
+        自动生成的文件名会以独占方式创建空文件占位，并发生成同一文本也不会互相覆盖；
+        生成失败时调用方需用 discard_placeholder 清理。
+        """
+        if output_file:
+            output_dir = os.path.dirname(output_file)
+            if output_dir:
+                os.makedirs(output_dir, exist_ok=True)
+            return output_file
+        
+        if output_name is not None:
+            if output_name not in self.config["output_paths"]:
+                raise KeyError(f"输出路径 '{output_name}' 不存在")
+            output_dir = self.config["output_paths"][output_name]
+        else:
+            output_dir = self.config["output_paths"].get(self.current_output_path, "./")
+        if content_key is None:
+            content_key = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        output_dir = self.shard_dir(output_dir, content_key)
+        # 命令行模式不经过菜单启动时的目录创建，这里按需创建
+        os.makedirs(output_dir, exist_ok=True)
+        return create_exclusive(os.path.join(output_dir, self.format_filename(text, format, content_key)))
+
+    def retry_delay(self, attempt, retry_after=None):
+        """计算第attempt次失败后的等待秒数；返回None表示不再重试
+
+        默认使用带随机抖动的指数退避；服务端给出Retry-After时按其等待，
+        但超过 max_delay 时直接放弃，避免长时间占用工作线程。
+        """
+        retry_config = self.config["retry"]
+        if attempt >= retry_config.get("max_attempts", 3):
+            return None
+        max_delay = retry_config.get("max_delay", 30.0)
+        if retry_after is not None:
+            return retry_after if retry_after <= max_delay else None
+        backoff = min(max_delay, retry_config.get("base_delay", 0.5) * 2 ** (attempt - 1))
+        return random.uniform(backoff / 2, backoff)
+
+    def inflight_count(self):
+        """正在进行的上游请求数（合并后的）"""
+        with self._inflight_lock:
+            return len(self._inflight)
+
+    def fetch_audio(self, payload, filename, use_cache=True, profile_name=None):
+        """请求一段音频并写入文件（不记录历史），返回结构化结果
+
+        429、5xx、超时和连接错误会按 retry 配置重试；连续失败会触发熔断，
+        熔断期间直接返回 circuit_open，不再等待超时。
+        相同请求正在进行时不会重复请求上游，而是等待并共享其结果（coalesced=True）。
+        profile_name 仅用于性能统计的标签。
+        """
+        result = make_result(filename=filename)
+        
+        # 优先从磁盘缓存读取相同请求的音频（绕过缓存时仍会用新结果刷新缓存）
+        cache_enabled = self.config["cache"].get("enabled", True)
+        cache_key = AudioCache.make_key(payload)
+        if cache_enabled and use_cache:
+            cached_path = self.cache.get(cache_key, payload["format"])
+            if cached_path:
+                shutil.copyfile(cached_path, filename)
+                result.update(ok=True, status="ok", cached=True)
+                return result
+        
+        with self._inflight_lock:
+            call = self._inflight.get(cache_key)
+            leader = call is None
+            if leader:
+                call = self._inflight[cache_key] = InFlightCall()
+            else:
+                index = call.join(filename)
+        if not leader:
+            return call.wait(index)
+        
+        result = None
+        try:
+            result = self._request_audio(payload, filename, cache_key, profile_name)
+            return result
+        finally:
+            with self._inflight_lock:
+                del self._inflight[cache_key]
+            call.finish(result)
+
+    def _http_failure(self, result, route, status_code, error_msg, retry_after):
+        """处理非200响应（同步和异步客户端共用）：写入失败信息，返回 (outcome, 是否放弃重试)
+
+        outcome 含义见 EndpointRouter.release。
+        """
+        retry_statuses = self.config["retry"].get("retry_statuses", [429, 500, 502, 503, 504])
+        fail_result(result, f"❌ 请求失败 (状态码 {status_code}): {error_msg}", "http_error")
+        if status_code in KEY_REJECTED_STATUSES and self.router.has_spare_key(route):
+            # 密钥被拒绝时换用其他密钥重试
+            return "rejected", False
+        if status_code not in retry_statuses:
+            # 客户端错误说明服务可用，不计入熔断
+            return "ok", True
+        if status_code >= 500:
+            return "error", False
+        return ("throttled" if status_code == 429 else "ok"), False
+
+    def _release_attempt(self, route, limiter, outcome, latency, retry_after, timed_out=False):
+        """一次请求结束后归还路由和限流许可（limiter 为 None 表示未占用许可）
+
+        超时和429都说明服务端已拥塞，限流器据此降速。
+        """
+        self.router.release(route, outcome, latency, retry_after)
+        if limiter:
+            limiter.release(latency, timed_out or outcome == "throttled")
+
+    def _failure_delay(self, route, outcome, attempt, result, retry_after):
+        """一次失败后重试前的等待秒数，返回None表示放弃；可以换用其他地址或密钥时不必退避"""
+        if self.router.can_fail_over(route, outcome):
+            retry_after = 0.0
+        delay = self.retry_delay(attempt, retry_after)
+        if delay is not None:
+            logger.warning("第%d次请求失败（%s），%.2f秒后重试", attempt, result["error"], delay)
+        return delay
+
+    def _request_audio(self, payload, filename, cache_key, profile_name=None, store=None):
+        """向上游发起请求（含重试、熔断、限流和统计），成功后写入缓存
+
+        传入 store(response, timings) 时由它处理成功的响应（返回错误信息或None），
+        此时不写文件也不写缓存，由调用方负责。
+        """
+        import requests
+        from urllib3.exceptions import ReadTimeoutError
+        
+        result = make_result(filename=filename)
+        cache_enabled = self.config["cache"].get("enabled", True)
+        profile = profile_name or payload["reference_id"]
+        body = json.dumps(payload).encode("utf-8")
+        attempt = 0
+        read_timeouts = 0
+        while True:
+            route, wait = self.router.select()
+            if route is None:
+                if wait:
+                    # 所有密钥都在冷却或超出配额，等待最早可用的密钥
+                    time.sleep(wait)
+                    continue
+                return fail_result(
+                    result,
+                    f"❌ API暂时不可用，已熔断（约{self.router.retry_in():.0f}秒后重试）",
+                    "circuit_open"
+                )
+            
+            attempt += 1
+            result["attempts"] = attempt
+            retry_after = None
+            timings = {}
+            queued = time.monotonic()
+            limiter = self.limiter_for(route.key.key)
+            if limiter:
+                limiter.acquire()
+            latency = None
+            timed_out = False
+            succeeded = False
+            outcome = "error"
+            _connect_timing.seconds = 0.0
+            try:
+                # 发送请求到新的端点（流式读取响应体）
+                started = time.monotonic()
+                timings["queue"] = started - queued
+                with self.session.post(
+                    f"{route.endpoint.url}/tts",
+                    data=body,
+                    headers=self.get_headers(route.key.key),
+                    timeout=self.timeouts.for_request(payload["backend"], len(payload["text"]), read_timeouts),
+                    stream=self.config["http"].get("stream", True)
+                ) as response:
+                    latency = time.monotonic() - started
+                    timings["connect"] = _connect_timing.seconds
+                    timings["ttfb"] = latency - timings["connect"]
+                    result["status_code"] = response.status_code
+                    if response.status_code == 200:
+                        if store is None:
+                            error = self.save_response_audio(response, filename, payload["format"], timings)
+                        else:
+                            error = store(response, timings)
+                        outcome = "ok"
+                        if error:
+                            return fail_result(result, error, "invalid_response")
+                        self.timeouts.observe(payload["backend"], len(payload["text"]), timings["ttfb"])
+                        succeeded = True
+                        break
+                    
+                    # 处理非200响应
+                    try:
+                        error_msg = response.json().get("error", {})
+                    except (json.JSONDecodeError, AttributeError):
+                        error_msg = f"非JSON响应: {response.text[:200]}"
+                    retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                    outcome, give_up = self._http_failure(result, route, response.status_code, error_msg,
+                                                          retry_after)
+                    if give_up:
+                        return result
+            except requests.exceptions.RequestException as e:
+                # 流式读取响应体时的读超时不是 ReadTimeout，而是包装了 urllib3 ReadTimeoutError 的 ConnectionError
+                read_timeout = isinstance(e, requests.exceptions.ReadTimeout) or (
+                    isinstance(e, requests.exceptions.ConnectionError)
+                    and bool(e.args) and isinstance(e.args[0], ReadTimeoutError)
+                )
+                if read_timeout or isinstance(e, requests.exceptions.Timeout):
+                    timed_out = True
+                    if read_timeout:
+                        # 重试时放宽读超时，长文本不会每次都在同一时刻被中断
+                        read_timeouts += 1
+                    fail_result(result, f"❌ 请求超时: {str(e)}", "timeout")
+                else:
+                    fail_result(result, f"❌ 无法连接到API: {str(e)}", "connection_error")
+            finally:
+                self._release_attempt(route, limiter, outcome, latency, retry_after, timed_out)
+                timings["total"] = time.monotonic() - queued
+                self.metrics.record(
+                    profile, payload["backend"], "ok" if succeeded else result["status"],
+                    timings, len(body), timings.get("audio_bytes", 0)
+                )
+            
+            delay = self._failure_delay(route, outcome, attempt, result, retry_after)
+            if delay is None:
+                return result
+            time.sleep(delay)
+        
+        if cache_enabled and store is None:
+            self.cache.put_file(cache_key, payload["format"], filename)
+        result.update(ok=True, status="ok", message="", error=None)
+        return result
+
+    def synthesize(self, text, voice_profile_name=None, speed=1.0, use_cache=True,
+                   output_name=None, output_file=None):
+        """文字转语音，返回结构化结果字典（字段见 make_result）
+
+        output_name 指定输出路径名称，output_file 直接指定输出文件。
+        超过分块长度的长文本会自动按句切分并发生成（见 synthesize_segmented）。
+        """
+        profile_name, voice_profile = self.get_voice_profile(voice_profile_name)
+        if not voice_profile:
+            return fail_result(make_result(), "❌ 未找到声音配置", "not_found")
+        
+        if self._should_segment(text, voice_profile):
+            return self.synthesize_segmented(text, voice_profile_name, speed, use_cache,
+                                             output_name, output_file)
+        
+        result = make_result()
+        filename = None
+        try:
+            payload = self.build_payload(text, voice_profile, speed)
+            cache_key = AudioCache.make_key(payload)
+            filename = self.resolve_output_file(text, voice_profile["format"], output_name, output_file, cache_key)
+            
+            result = self.fetch_audio(payload, filename, use_cache, profile_name)
+            if not result["ok"]:
+                if not output_file:
+                    discard_placeholder(filename)
+                return result
+            
+            if not output_file:
+                filename = result["filename"] = self._archive_output(
+                    filename, text, profile_name, voice_profile, speed
+                )
+            self.add_history(text, profile_name, voice_profile, filename, speed)
+            
+            if result["cached"]:
+                result["message"] = f"🔊 语音生成成功（缓存命中）！保存为: {filename}"
+            else:
+                result["message"] = f"🔊 语音生成成功！保存为: {filename}"
+            return result
+        except Exception as e:
+            # 捕获所有异常
+            if not output_file:
+                discard_placeholder(filename)
+            return fail_result(result, f"❌ 发生错误: {str(e)}")
+
+    def synthesize_pipelined(self, pipeline, callback, text, voice_profile_name=None, speed=1.0,
+                             use_cache=True, output_name=None, output_file=None):
+        """synthesize 的流水线版本：本线程只负责网络请求
+
+        读完的响应体交给 pipeline（BoundedPipeline）的写入线程解码、写文件、
+        写缓存和记录历史，完成后以结果字典调用 callback。长文本分段、缓存命中
+        和请求失败在本线程直接完成并回调。
+        """
+        profile_name, voice_profile = self.get_voice_profile(voice_profile_name)
+        if not voice_profile or self._should_segment(text, voice_profile):
+            callback(self.synthesize(text, voice_profile_name, speed, use_cache, output_name, output_file))
+            return
+        
+        result = make_result()
+        filename = None
+        try:
+            payload = self.build_payload(text, voice_profile, speed)
+            cache_key = AudioCache.make_key(payload)
+            if use_cache and self.config["cache"].get("enabled", True):
+                # 命中时交给 synthesize 读取缓存并统计命中，这里只探测不计数
+                if self.cache.get(cache_key, payload["format"], count=False):
+                    callback(self.synthesize(text, voice_profile_name, speed, use_cache, output_name, output_file))
+                    return
+                self.cache.record_miss()
+            filename = self.resolve_output_file(text, voice_profile["format"], output_name, output_file, cache_key)
+            
+            response_body = {}
+            
+            def buffer(response, timings):
+                error, response_body["kind"], response_body["body"] = self.read_response_audio(
+                    response, payload["format"], timings
+                )
+                return error
+            
+            result = self._request_audio(payload, filename, cache_key, profile_name, store=buffer)
+        except Exception as e:
+            result = fail_result(result, f"❌ 发生错误: {str(e)}")
+        if not result["ok"]:
+            if not output_file:
+                discard_placeholder(filename)
+            callback(result)
+            return
+        
+        # 队列已满时在这里阻塞，网络线程不会无限制地积压响应体
+        pipeline.put(self._write_stage, result, response_body["kind"], response_body["body"],
+                     payload, cache_key, text, profile_name, voice_profile, speed, callback, not output_file)
+
+    def _write_stage(self, result, kind, body, payload, cache_key, text, profile_name, voice_profile,
+                     speed, callback, archive=True):
+        """流水线写入阶段：解码、写文件、写缓存、（按配置）移入归档、记录历史，然后回调"""
+        filename = result["filename"]
+        try:
+            error = self.store_audio_body(kind, body, filename)
+            if error:
+                if archive:
+                    discard_placeholder(filename)
+                fail_result(result, error, "invalid_response")
+            else:
+                if self.config["cache"].get("enabled", True):
+                    self.cache.put_file(cache_key, payload["format"], filename)
+                if archive:
+                    filename = result["filename"] = self._archive_output(
+                        filename, text, profile_name, voice_profile, speed
+                    )
+                self.add_history(text, profile_name, voice_profile, filename, speed)
+                result["message"] = f"🔊 语音生成成功！保存为: {filename}"
+        except Exception as e:
+            fail_result(result, f"❌ 发生错误: {str(e)}")
+        callback(result)
+
+    def _should_segment(self, text, voice_profile):
+        """判断是否需要在客户端按句切分长文本"""
+        segment_config = self.config["segment"]
+        return (
+            segment_config.get("enabled", True)
+            and voice_profile["format"] in JOINABLE_FORMATS
+            and len(text) > voice_profile["chunk_length"]
+        )
+
+    def synthesize_segmented(self, text, voice_profile_name=None, speed=1.0, use_cache=True,
+                             output_name=None, output_file=None, concurrency=None):
+        """长文本按句切分后并发生成，再按原顺序拼接为一个文件"""
+        result = make_result()
+        
+        profile_name, voice_profile = self.get_voice_profile(voice_profile_name)
+        if not voice_profile:
+            return fail_result(result, "❌ 未找到声音配置", "not_found")
+        
+        format = voice_profile["format"]
+        if format not in JOINABLE_FORMATS:
+            return fail_result(result, f"❌ {format} 格式不支持分段拼接")
+        if concurrency is None:
+            concurrency = self.config["segment"].get("concurrency", 4)
+        
+        segments = split_sentences(text, voice_profile["chunk_length"])
+        if not segments:
+            return fail_result(result, "❌ 文本为空")
+        
+        parts_dir = None
+        filename = None
+        try:
+            content_key = AudioCache.make_key(self.build_payload(text, voice_profile, speed))
+            filename = self.resolve_output_file(text, format, output_name, output_file, content_key)
+            parts_dir = tempfile.mkdtemp(prefix=".segments_", dir=os.path.dirname(filename) or ".")
+            part_files = [os.path.join(parts_dir, f"{i:05d}.{format}") for i in range(len(segments))]
+            
+            def fetch_segment(index):
+                payload = self.build_payload(segments[index], voice_profile, speed)
+                return self.fetch_audio(payload, part_files[index], use_cache, profile_name)
+            
+            with ThreadPoolExecutor(max_workers=max(1, int(concurrency))) as executor:
+                outcomes = list(executor.map(fetch_segment, range(len(segments))))
+            
+            result["attempts"] = sum(outcome["attempts"] for outcome in outcomes)
+            for index, outcome in enumerate(outcomes, 1):
+                if not outcome["ok"]:
+                    result["status_code"] = outcome["status_code"]
+                    return fail_result(result, f"❌ 第{index}/{len(segments)}段生成失败: {outcome['error']}",
+                                       outcome["status"])
+            
+            if self.config["postprocess"].get("enabled", False) and format in POSTPROCESS_FORMATS:
+                # 分段之间统一响度，并用补齐的静音替换各段首尾长短不一的静音
+                volume = voice_profile.get("prosody_volume", 0.0)
+                self.postprocess_files([(path, format, volume) for path in part_files])
+            join_audio_files(part_files, filename, format)
+            if not output_file:
+                filename = self._archive_output(filename, text, profile_name, voice_profile, speed)
+            self.add_history(text, profile_name, voice_profile, filename, speed)
+            
+            cached = all(outcome["cached"] for outcome in outcomes)
+            result.update(ok=True, status="ok", filename=filename, cached=cached, segments=len(segments),
+                          message=f"🔊 语音生成成功（共{len(segments)}段）！保存为: {filename}")
+            return result
+        except Exception as e:
+            return fail_result(result, f"❌ 发生错误: {str(e)}")
+        finally:
+            if parts_dir:
+                shutil.rmtree(parts_dir, ignore_errors=True)
+            if not result["ok"] and not output_file:
+                discard_placeholder(filename)
+
+    def postprocess_files(self, items):
+        """按 postprocess 配置处理一批音频文件，items 为 (路径, 格式, prosody_volume) 列表"""
+        return AudioPostProcessor(self.config["postprocess"]).process(items)
+
+    def synthesize_document(self, text, output_file, voice_profile_name=None, speed=1.0,
+                            concurrency=None):
+        """增量生成文档音频
+
+        每句按文本和声音参数计算指纹，分句音频保存在 <输出文件>.parts/ 目录，
+        清单保存在 <输出文件>.manifest.json。重新生成时只请求指纹变化的句子，
+        再用已有和新生成的分句音频重新拼接出完整文件。
+        """
+        result = make_result()
+        
+        profile_name, voice_profile = self.get_voice_profile(voice_profile_name)
+        if not voice_profile:
+            return fail_result(result, "❌ 未找到声音配置", "not_found")
+        
+        format = voice_profile["format"]
+        if format not in JOINABLE_FORMATS:
+            return fail_result(result, f"❌ {format} 格式不支持分段拼接")
+        if concurrency is None:
+            concurrency = self.config["segment"].get("concurrency", 4)
+        
+        sentences = split_sentences(text, voice_profile["chunk_length"], merge=False)
+        if not sentences:
+            return fail_result(result, "❌ 文本为空")
+        
+        try:
+            output_file = self.resolve_output_file(text, format, output_file=output_file)
+            parts_dir = f"{output_file}.parts"
+            manifest_path = f"{output_file}.manifest.json"
+            os.makedirs(parts_dir, exist_ok=True)
+            
+            entries = []
+            for sentence in sentences:
+                payload = self.build_payload(sentence, voice_profile, speed)
+                fingerprint = AudioCache.make_key(payload)
+                entries.append({
+                    "fingerprint": fingerprint,
+                    "text": sentence,
+                    "file": os.path.join(parts_dir, f"{fingerprint}.{format}"),
+                    "payload": payload
+                })
+            
+            # 只请求分句音频不存在的句子（同一文档中重复的句子只请求一次）
+            pending = {}
+            for entry in entries:
+                if not os.path.exists(entry["file"]):
+                    pending.setdefault(entry["fingerprint"], entry)
+            
+            def fetch_entry(entry):
+                return self.fetch_audio(entry["payload"], entry["file"], profile_name=profile_name)
+            
+            with ThreadPoolExecutor(max_workers=max(1, int(concurrency))) as executor:
+                outcomes = list(executor.map(fetch_entry, pending.values()))
+            result["attempts"] = sum(outcome["attempts"] for outcome in outcomes)
+            for outcome, entry in zip(outcomes, pending.values()):
+                if not outcome["ok"]:
+                    result["status_code"] = outcome["status_code"]
+                    return fail_result(result, f"❌ 句子生成失败「{entry['text'][:20]}」: {outcome['error']}",
+                                       outcome["status"])
+            
+            # 清理不再使用的分句音频
+            used = {os.path.basename(entry["file"]) for entry in entries}
+            for name in os.listdir(parts_dir):
+                if name not in used:
+                    try:
+                        os.remove(os.path.join(parts_dir, name))
+                    except OSError:
+                        pass
+            
+            join_audio_files([entry["file"] for entry in entries], output_file, format)
+            
+            manifest = {
+                "profile": profile_name,
+                "format": format,
+                "speed": speed,
+                "sentences": [
+                    {"fingerprint": entry["fingerprint"], "text": entry["text"]}
+                    for entry in entries
+                ]
+            }
+            write_file_atomic(manifest_path, [json.dumps(manifest, ensure_ascii=False, indent=2).encode("utf-8")])
+            
+            self.add_history(text, profile_name, voice_profile, output_file, speed)
+            
+            reused = len(entries) - len(pending)
+            result.update(ok=True, status="ok", filename=output_file, cached=not pending,
+                          sentences=len(entries), synthesized=len(pending), reused=reused,
+                          message=f"📄 文档生成成功！新生成 {len(pending)} 句，复用 {reused} 句，"
+                                  f"保存为: {output_file}")
+            return result
+        except Exception as e:
+            return fail_result(result, f"❌ 发生错误: {str(e)}")
+
+    def stream_speech(self, text, sink, voice_profile_name=None, speed=1.0, use_cache=True,
+                      concurrency=None):
+        """流式输出语音到 sink（可写的二进制文件对象，如标准输出或命名管道）
+
+        长文本按句切分：第一句边下载边写出，后续句子同时在后台生成，按顺序接在
+        后面，播放器在第一句到达时即可开始播放。流式输出不写文件、不记录历史，
+        但会读取磁盘缓存。返回的结果额外包含 ttfa（首个音频数据的耗时）、
+        elapsed、bytes 和 segments。
+        """
+        result = make_result(ttfa=None, elapsed=None, bytes=0, segments=0)
+        profile_name, voice_profile = self.get_voice_profile(voice_profile_name)
+        if not voice_profile:
+            return fail_result(result, "❌ 未找到声音配置", "not_found")
+        
+        format = voice_profile["format"]
+        if self.config["segment"].get("enabled", True) and format in JOINABLE_FORMATS:
+            segments = split_sentences(text, voice_profile["chunk_length"])
+        else:
+            segments = [text.strip()]
+        if not segments or not segments[0]:
+            return fail_result(result, "❌ 文本为空")
+        if concurrency is None:
+            concurrency = self.config["segment"].get("concurrency", 4)
+        
+        writer = AudioStreamWriter(sink, format)
+        payloads = [self.build_payload(segment, voice_profile, speed) for segment in segments]
+        # 第一句在当前线程流式输出，其余句子交给线程池提前生成
+        with ThreadPoolExecutor(max_workers=max(1, concurrency - 1)) as executor:
+            futures = [executor.submit(self._fetch_segment_audio, payload, use_cache, profile_name)
+                       for payload in payloads[1:]]
+            try:
+                segment_result = self._stream_segment(payloads[0], writer, use_cache, profile_name)
+                for future in futures:
+                    if not segment_result["ok"]:
+                        break
+                    segment_result, audio = future.result()
+                    if segment_result["ok"]:
+                        writer.write_segment([audio])
+            except (OSError, ValueError) as e:
+                segment_result = fail_result(make_result(), f"❌ 输出音频流失败: {str(e)}")
+            finally:
+                for future in futures:
+                    future.cancel()
+        
+        result.update(
+            ttfa=writer.ttfa, elapsed=time.monotonic() - writer.started,
+            bytes=writer.bytes_written, segments=writer.segments,
+            attempts=segment_result["attempts"], status_code=segment_result["status_code"]
+        )
+        if not segment_result["ok"]:
+            return fail_result(result, segment_result["message"], segment_result["status"])
+        result.update(ok=True, status="ok", message=f"🔊 流式输出完成（首段音频 {writer.ttfa or 0:.2f} 秒）")
+        return result
+
+    def _stream_segment(self, payload, writer, use_cache=True, profile_name=None):
+        """请求一段音频并边下载边写入 writer；缓存命中时直接输出缓存文件"""
+        cache_key = AudioCache.make_key(payload)
+        if use_cache and self.config["cache"].get("enabled", True):
+            cached_path = self.cache.get(cache_key, payload["format"])
+            if cached_path:
+                with open(cached_path, "rb") as f:
+                    writer.write_segment(iter(lambda: f.read(64 * 1024), b""))
+                return make_result(ok=True, status="ok", cached=True)
+        
+        def stream(response, timings):
+            started = time.monotonic()
+            chunks = response.iter_content(chunk_size=int(self.config["http"].get("chunk_size", 65536)))
+            head = b""
+            for chunk in chunks:
+                head += chunk
+                if len(head) >= 16:
+                    break
+            kind = sniff_audio_format(head, response.headers.get("Content-Type", ""), payload["format"])
+            if kind is None:
+                return f"❌ 无效响应: {head[:200].decode('utf-8', 'replace')}"
+            # 已经输出的数据无法撤回，此后的错误都不再重试
+            try:
+                if kind == "json":
+                    audio, error = decode_json_audio(head + b"".join(chunks))
+                    if error:
+                        return error
+                    writer.write_segment([audio])
+                else:
+                    writer.write_segment(itertools.chain([head], chunks))
+            except (OSError, ValueError) as e:
+                return f"❌ 音频流中断: {str(e)}"
+            timings["download"] = time.monotonic() - started
+            timings["audio_bytes"] = writer.bytes_written
+            return None
+        
+        return self._request_audio(payload, None, cache_key, profile_name, store=stream)
+
+    def _fetch_segment_audio(self, payload, use_cache=True, profile_name=None):
+        """请求一段音频并读入内存，返回 (结果, 音频数据)"""
+        cache_key = AudioCache.make_key(payload)
+        if use_cache and self.config["cache"].get("enabled", True):
+            cached_path = self.cache.get(cache_key, payload["format"])
+            if cached_path:
+                with open(cached_path, "rb") as f:
+                    return make_result(ok=True, status="ok", cached=True), f.read()
+        
+        response_body = {}
+        
+        def buffer(response, timings):
+            error, kind, body = self.read_response_audio(response, payload["format"], timings)
+            if not error and kind == "json":
+                body, error = decode_json_audio(body)
+            response_body["audio"] = body
+            return error
+        
+        result = self._request_audio(payload, None, cache_key, profile_name, store=buffer)
+        return result, response_body.get("audio")
+
+    def text_to_speech(self, text, voice_profile_name=None, speed=1.0, use_cache=True):
+        """文字转语音 - 使用最新API规范
+
+        use_cache=False 时跳过磁盘缓存，强制重新请求API
+        """
+        return self.synthesize(text, voice_profile_name, speed, use_cache)["message"]
+
+    def load_batch_manifest(self, path):
+        """读取批量任务清单
+
+        .jsonl 文件每行一个JSON对象（text 必填，可选 profile、speed、output_path、output），
+        字段类型不对的行带行号报错，不会等到执行时才让整批中断。
+        其他文件每个非空行作为一条文本。
+        """
+        items = []
+        is_jsonl = path.lower().endswith((".jsonl", ".ndjson"))
+        with open(path, "r", encoding="utf-8") as f:
+            for line_no, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                if not is_jsonl:
+                    items.append({"text": line})
+                    continue
+                try:
+                    item = json.loads(line)
+                except json.JSONDecodeError as e:
+                    raise ValueError(f"第{line_no}行不是有效的JSON: {e}")
+                if isinstance(item, str):
+                    item = {"text": item}
+                if not isinstance(item, dict) or not item.get("text"):
+                    raise ValueError(f"第{line_no}行缺少text字段")
+                if not isinstance(item["text"], str):
+                    raise ValueError(f"第{line_no}行的text必须是字符串")
+                for field in ("profile", "output_path", "output"):
+                    if item.get(field) is not None and not isinstance(item[field], str):
+                        raise ValueError(f"第{line_no}行的{field}必须是字符串")
+                if "speed" in item:
+                    try:
+                        speed = float(item["speed"])
+                    except (TypeError, ValueError):
+                        speed = None
+                    if isinstance(item["speed"], bool) or speed is None or not 0 < speed < float("inf"):
+                        raise ValueError(f"第{line_no}行的speed必须是正数: {item['speed']!r}")
+                    item["speed"] = speed
+                items.append(item)
+        return items
+
+    def _batch_jobs(self, items):
+        """为清单中的每条任务计算请求内容哈希和任务键（相同任务按出现次序区分）"""
+        jobs, seen = [], {}
+        for index, item in enumerate(items):
+            try:
+                voice_profile = self.get_voice_profile(item.get("profile"))[1]
+                payload_hash = AudioCache.make_key(
+                    self.build_payload(item["text"], voice_profile, float(item.get("speed", 1.0)))
+                )
+            except (KeyError, TypeError, ValueError):
+                # 配置无效的任务照常执行（会失败），只用文本区分
+                payload_hash = None
+            identity = json.dumps([payload_hash or item["text"], item.get("output_path"), item.get("output")],
+                                  ensure_ascii=False)
+            occurrence = seen[identity] = seen.get(identity, -1) + 1
+            job = hashlib.sha256(f"{identity}#{occurrence}".encode("utf-8")).hexdigest()
+            jobs.append({"job": job, "index": index, "payload_hash": payload_hash})
+        return jobs
+
+    def run_batch(self, manifest_path, concurrency=None, summary_path=None, show_progress=True,
+                  resume=True):
+        """并发执行批量语音生成，并写出逐条结果汇总（JSONL）
+
+        启用 pipeline 配置时，concurrency 个网络线程只负责请求，解码、写文件和
+        历史记录由独立的写入线程完成（见 synthesize_pipelined）。
+        启用 journal 配置时逐条记录任务状态，重新运行同一清单会跳过已完成且
+        输出文件完好的任务；resume=False 时丢弃旧记录重新生成全部任务。
+        """
+        items = self.load_batch_manifest(manifest_path)
+        if concurrency is None:
+            concurrency = self.config["batch"].get("concurrency", 4)
+        concurrency = max(1, int(concurrency))
+        if summary_path is None:
+            summary_path = os.path.splitext(manifest_path)[0] + ".summary.jsonl"
+        
+        total = len(items)
+        counts = {"done": 0, "ok": 0, "failed": 0, "resumed": 0}
+        records = [None] * total
+        progress_lock = threading.Lock()
+        journal = self.journal
+        run = os.path.abspath(manifest_path)
+        jobs = self._batch_jobs(items)
+        # 归档片段的大小要通过归档索引核对
+        pack = self.pack if self.config["pack"].get("enabled", False) else None
+        previous = {}
+        if journal is not None:
+            if not resume:
+                journal.reset(run)
+            previous = journal.begin(run, jobs)
+        pipeline_config = self.config["pipeline"]
+        pipeline = None
+        if pipeline_config.get("enabled", True):
+            pipeline = BoundedPipeline(pipeline_config.get("writers", 2), pipeline_config.get("queue_size", 8))
+        
+        def finish_item(index, item, started, result):
+            record = {
+                "index": index,
+                "text": item["text"],
+                "profile": item.get("profile") or self.current_voice,
+                "ok": result["ok"],
+                "status": result["status"],
+                "status_code": result["status_code"],
+                "attempts": result["attempts"],
+                "filename": result["filename"],
+                "cached": result["cached"],
+                "resumed": result.get("resumed", False),
+                "error": result["error"],
+                "elapsed": round(time.monotonic() - started, 3)
+            }
+            if journal is not None and not record["resumed"]:
+                if result["ok"]:
+                    journal.mark(run, jobs[index]["job"], "done", result["filename"],
+                                 JobJournal.output_size(result["filename"], pack))
+                else:
+                    journal.mark(run, jobs[index]["job"], "failed", error=result["error"])
+            with progress_lock:
+                records[index] = record
+                counts["done"] += 1
+                counts["ok" if result["ok"] else "failed"] += 1
+                counts["resumed"] += record["resumed"]
+                if show_progress:
+                    sys.stderr.write(f"\r批量生成进度: {counts['done']}/{total} "
+                                     f"(成功 {counts['ok']}, 失败 {counts['failed']})")
+                    sys.stderr.flush()
+        
+        def run_item(index, item):
+            started = time.monotonic()
+            row = previous.get(jobs[index]["job"])
+            if JobJournal.verify(row, pack):
+                finish_item(index, item, started, make_result(
+                    ok=True, status="ok", filename=row["output"], resumed=True,
+                    message=f"⏭️ 已完成，跳过: {row['output']}"
+                ))
+                return
+            if row is not None and row["state"] == "done":
+                logger.warning(f"任务输出已丢失或大小不符，重新生成: {row['output']}")
+            if journal is not None:
+                journal.mark(run, jobs[index]["job"], "inflight")
+            args = (item["text"], item.get("profile"), float(item.get("speed", 1.0)))
+            options = {"output_name": item.get("output_path"), "output_file": item.get("output")}
+            if pipeline is None:
+                finish_item(index, item, started, self.synthesize(*args, **options))
+            else:
+                self.synthesize_pipelined(
+                    pipeline, lambda result: finish_item(index, item, started, result), *args, **options
+                )
+        
+        started = time.monotonic()
+        try:
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                list(executor.map(lambda args: run_item(*args), enumerate(items)))
+        finally:
+            if pipeline is not None:
+                pipeline.close()
+        if show_progress and total:
+            sys.stderr.write("\n")
+        
+        postprocess = None
+        if self.config["postprocess"].get("enabled", False):
+            # 整批一起做响度归一化，各条之间音量一致
+            targets = []
+            for record in records:
+                # 已移入归档的片段无法原地处理；断点续跑跳过的文件上次已经处理过
+                if record["ok"] and not record["resumed"] and not parse_pack_locator(record["filename"]):
+                    voice_profile = self.get_voice_profile(record["profile"])[1]
+                    targets.append((record["filename"], voice_profile.get("format"),
+                                    voice_profile.get("prosody_volume", 0.0)))
+            try:
+                postprocess = self.postprocess_files(targets)
+            except (RuntimeError, ValueError, OSError, wave.Error) as e:
+                postprocess = {"error": str(e)}
+            if journal is not None:
+                # 后处理改变了文件大小，更新日志中的记录以便下次校验
+                for record in records:
+                    if record["ok"] and not record["resumed"] and not parse_pack_locator(record["filename"]):
+                        journal.mark(run, jobs[record["index"]]["job"], "done", record["filename"],
+                                     JobJournal.output_size(record["filename"], pack))
+        
+        with open(summary_path, "w", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        
         return {
-            "Authorization": f"Bearer {self.config['api_key']}",
-            "Content-Type": "application/json",
-            "User-Agent": "FishAudioTTS/2.0"
+            "total": total,
+            "ok": counts["ok"],
+            "failed": counts["failed"],
+            "resumed": counts["resumed"],
+            "elapsed": round(time.monotonic() - started, 3),
+            "summary_path": summary_path,
+            "pipeline": pipeline.stats() if pipeline is not None else None,
+            "postprocess": postprocess
         }
-    
-    def set_api_key(self, key):
-        """设置API密钥"""
-        self.config["api_key"] = key
-        self.save_config()
-        return "🔑 API密钥已保存！"
-    
-    def create_voice_profile(self, name, voice_id="default", backend="speech-1.6", format="mp3", temperature=0.7, 
-                            top_p=0.7, chunk_length=200, normalize=True, 
-                            prosody_volume=0.0):
-        """创建自定义声音配置"""
-        # 检查名称是否已存在
-        if name in self.config["voices"]:
-            return "⚠️ 配置名称已存在！"
+
+    def fanout_variants(self, profiles=None, grid=None, speed=1.0):
+        """展开对比变体：每个声音配置 × 参数网格（FANOUT_PARAMS 的笛卡尔积）
+
+        profiles 省略时使用当前配置；grid 形如 {"temperature": [0.5, 0.7], "speed": [1.0, 1.2]}。
+        """
+        grid = grid or {}
+        unknown = set(grid) - set(FANOUT_PARAMS)
+        if unknown:
+            raise ValueError(f"不支持的网格参数: {', '.join(sorted(unknown))}（可用: {', '.join(FANOUT_PARAMS)}）")
+        keys = [key for key in FANOUT_PARAMS if grid.get(key)]
+        variants = []
+        for name in profiles or [self.current_voice]:
+            voice_profile = self.config["voices"].get(name)
+            if not voice_profile:
+                raise ValueError(f"未找到声音配置: {name}")
+            for values in itertools.product(*(grid[key] for key in keys)):
+                params = dict(zip(keys, values))
+                variant_speed = float(params.pop("speed", speed))
+                variants.append({
+                    "label": "_".join([name] + [f"{key}={value}" for key, value in zip(keys, values)]),
+                    "profile": name,
+                    "voice_profile": dict(voice_profile, **params),
+                    "speed": variant_speed
+                })
+        return variants
+
+    def synthesize_fanout(self, text, profiles=None, grid=None, speed=1.0, output_dir=None,
+                          use_cache=True, concurrency=None):
+        """同一段文本按多个声音配置或参数组合并发生成，用于对比试听
+
+        所有变体的请求体一次构造完成，内容相同的变体只请求一次（结果复制给其余变体）。
+        音频按序号和标签保存在同一目录，并写出对比清单 manifest.json。
+        """
+        variants = self.fanout_variants(profiles, grid, speed)
+        if concurrency is None:
+            concurrency = self.config["batch"].get("concurrency", 4)
         
-        self.config["voices"][name] = {
-            "voice_id": voice_id,
-            "backend": backend,
-            "format": format,
-            "temperature": temperature,
-            "top_p": top_p,
-            "chunk_length": chunk_length,
-            "normalize": normalize,
-            "prosody_volume": prosody_volume
-        }
-        self.save_config()
-        return f"🎶 声音配置 '{name}' 已创建！"
-    
-    def edit_voice_profile(self, name, voice_id=None, backend=None, format=None, temperature=None, 
-                          top_p=None, chunk_length=None, normalize=None, 
-                          prosody_volume=None):
-        """编辑现有声音配置"""
-        if name not in self.config["voices"]:
-            return "⚠️ 配置不存在"
+        unique = OrderedDict()
+        for index, variant in enumerate(variants, 1):
+            payload = self.build_payload(text, variant["voice_profile"], variant["speed"])
+            variant.update(index=index, payload_hash=AudioCache.make_key(payload), format=payload["format"])
+            unique.setdefault(variant["payload_hash"], (variant, payload))
         
-        profile = self.config["voices"][name]
-        if voice_id: profile["voice_id"] = voice_id
-        if backend: profile["backend"] = backend
-        if format: profile["format"] = format
-        if temperature: profile["temperature"] = temperature
-        if top_p: profile["top_p"] = top_p
-        if chunk_length: profile["chunk_length"] = chunk_length
-        if normalize is not None: profile["normalize"] = normalize
-        if prosody_volume: profile["prosody_volume"] = prosody_volume
+        if output_dir is None:
+            base_dir = self.config["output_paths"].get(self.current_output_path, "./")
+            name = os.path.splitext(self.format_filename(text, "json"))[0]
+            # 同一秒内对同一文本的多次对比不能写进同一个目录
+            output_dir = create_exclusive_dir(os.path.join(base_dir, f"fanout_{name}"))
+        else:
+            os.makedirs(output_dir, exist_ok=True)
+        width = len(str(len(variants)))
+        for variant in variants:
+            label = re.sub(r"[^\w.=-]", "_", variant["label"])
+            variant["file"] = os.path.join(output_dir, f"{variant['index']:0{width}d}_{label}.{variant['format']}")
         
-        self.save_config()
-        return f"🎛️ 声音配置 '{name}' 已更新！"
-    
-    def delete_voice_profile(self, name):
-        """删除声音配置"""
-        if name == "default":
-            return "❌ 不能删除默认配置"
-            
-        if name in self.config["voices"]:
-            del self.config["voices"][name]
-            # 如果删除的是当前配置，重置为默认
-            if self.current_voice == name:
-                self.current_voice = "default"
-            self.save_config()
-            return f"🗑️ 声音配置 '{name}' 已删除！"
-        return "⚠️ 配置不存在"
-    
-    def add_output_path(self, name, path):
-        """添加输出路径配置"""
-        if name in self.config["output_paths"]:
-            return "⚠️ 路径名称已存在"
+        def fetch(item):
+            variant, payload = item
+            started = time.monotonic()
+            outcome = self.fetch_audio(payload, variant["file"], use_cache, variant["profile"])
+            outcome["elapsed"] = round(time.monotonic() - started, 3)
+            if outcome["ok"]:
+                self.add_history(text, variant["profile"], variant["voice_profile"], variant["file"], variant["speed"])
+            return outcome
         
-        # 创建目录
-        os.makedirs(path, exist_ok=True)
-        self.config["output_paths"][name] = path
-        self.save_config()
-        return f"📁 输出路径 '{name}' 已添加"
-    
-    def clear_history(self):
-        """清空历史记录"""
-        self.config["history"] = []
-        self.save_config()
-        return "✅ 历史记录已清空！"
-    
-    def select_from_menu(self, title, options, current_value=None):
-        """显示选择菜单并获取用户选择"""
-        print(f"\n\033[1;36m{title}:\033[0m")
-        for i, option in enumerate(options, 1):
-            indicator = " (当前)" if current_value == option else ""
-            print(f"{i}. {option}{indicator}")
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=max(1, int(concurrency))) as executor:
+            outcomes = dict(zip(unique, executor.map(fetch, unique.values())))
         
-        choice = input("\n请选择: ")
-        if choice.strip() == "":
-            return current_value
-            
+        entries = []
+        for variant in variants:
+            leader = unique[variant["payload_hash"]][0]
+            outcome = outcomes[variant["payload_hash"]]
+            if variant is not leader and outcome["ok"]:
+                shutil.copyfile(leader["file"], variant["file"])
+            voice_profile = variant["voice_profile"]
+            entries.append({
+                "index": variant["index"],
+                "label": variant["label"],
+                "profile": variant["profile"],
+                "voice_id": voice_profile["voice_id"],
+                "backend": voice_profile["backend"],
+                "temperature": voice_profile["temperature"],
+                "top_p": voice_profile["top_p"],
+                "speed": variant["speed"],
+                "payload_hash": variant["payload_hash"],
+                "file": os.path.basename(variant["file"]) if outcome["ok"] else None,
+                "ok": outcome["ok"],
+                "cached": outcome["cached"],
+                "duplicate_of": leader["index"] if variant is not leader else None,
+                "error": outcome["error"],
+                "elapsed": outcome["elapsed"] if variant is leader else 0.0
+            })
+        
+        manifest_path = os.path.join(output_dir, "manifest.json")
+        manifest = {
+            "text": text,
+            "created": datetime.now().isoformat(),
+            "grid": grid or {},
+            "variants": entries
+        }
+        write_file_atomic(manifest_path, [json.dumps(manifest, ensure_ascii=False, indent=2).encode("utf-8")])
+        
+        ok = sum(entry["ok"] for entry in entries)
+        return {
+            "output_dir": output_dir,
+            "manifest": manifest_path,
+            "variants": len(entries),
+            "requests": len(unique),
+            "ok": ok,
+            "failed": len(entries) - ok,
+            "elapsed": round(time.monotonic() - started, 3)
+        }
+
+class AsyncTTSClient:
+    """TTSManager 的 asyncio 版本
+
+    复用管理器的声音配置、输出路径和磁盘缓存，通过 aiohttp 发起请求，
+    用信号量限制同时进行的请求数，文件写入交给线程池执行，不阻塞事件循环。
+    与同步接口共用进行中请求的合并、归档输出和长文本分段（分段在线程池中
+    走同步实现），同一段文本无论通过哪个接口生成，结果的形式都相同。
+    """
+
+    def __init__(self, manager, concurrency=None):
+        self.manager = manager
+        if concurrency is None:
+            concurrency = manager.config["async"].get("concurrency", 32)
+        self.concurrency = max(1, int(concurrency))
+        import asyncio
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def _get_session(self):
+        """获取共享的 aiohttp 会话（懒加载）"""
+        if self._session is None or self._session.closed:
+            try:
+                import aiohttp
+            except ImportError:
+                raise RuntimeError("异步客户端需要安装 aiohttp: pip install aiohttp")
+            connector = aiohttp.TCPConnector(limit=self.concurrency)
+            # 读超时按每个请求的文本长度单独设置（见 AdaptiveTimeouts）
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=self.manager.timeouts.connect)
+            )
+        return self._session
+
+    async def close(self):
+        """关闭 aiohttp 会话"""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _write_file_atomic(self, path, chunks):
+        """异步版 write_file_atomic：逐块写入临时文件后原子重命名"""
+        import asyncio
+        loop = asyncio.get_running_loop()
+        tmp_path = f"{path}.{os.getpid()}.{id(chunks)}.part"
+        f = await loop.run_in_executor(None, open, tmp_path, "wb")
         try:
-            index = int(choice) - 1
-            if 0 <= index < len(options):
-                return options[index]
-        except:
-            pass
-        return current_value if current_value else options[0]
+            async for chunk in chunks:
+                if chunk:
+                    await loop.run_in_executor(None, f.write, chunk)
+            await loop.run_in_executor(None, f.close)
+            await loop.run_in_executor(None, os.replace, tmp_path, path)
+        except BaseException:
+            f.close()
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
 
-    def format_filename(self, text, format):
-        """根据文本生成文件名（去掉voice_id前缀）"""
-        # 提取前20个字符作为文件名
-        clean_text = re.sub(r'[^a-zA-Z0-9\u4e00-\u9fa5]', '_', text[:20])
-        if not clean_text:
-            clean_text = "tts_audio"
-        timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-        return f"{clean_text}_{timestamp}.{format}"
+    async def _save_response_audio(self, response, filename, expected_format):
+        """把音频响应写入文件，失败时返回错误信息"""
+        chunk_size = int(self.manager.config["http"].get("chunk_size", 65536))
+        chunks = response.content.iter_chunked(chunk_size)
+        # 先读取足够识别格式的文件头
+        head = b""
+        async for chunk in chunks:
+            head += chunk
+            if len(head) >= 16:
+                break
+        
+        kind = sniff_audio_format(head, response.headers.get("Content-Type", ""), expected_format)
+        if kind == "json":
+            audio_data, error = decode_json_audio(head + await response.content.read())
+            if error:
+                return error
+            
+            async def audio_chunks():
+                yield audio_data
+        elif kind is None:
+            return f"❌ 无效响应: {head[:200].decode('utf-8', 'replace')}"
+        else:
+            async def audio_chunks():
+                yield head
+                async for chunk in chunks:
+                    yield chunk
+        
+        await self._write_file_atomic(filename, audio_chunks())
+        return None
 
-    def test_api_connection(self):
-        """测试API连接状态"""
-        print("\n测试API连接...")
+    async def fetch_audio(self, payload, filename, use_cache=True, profile_name=None):
+        """异步版 TTSManager.fetch_audio：共享缓存、重试配置、熔断器和性能统计
+
+        与同步接口共用进行中请求表，相同请求只向上游发送一次（coalesced=True）。
+        """
+        import asyncio
+        manager = self.manager
+        loop = asyncio.get_running_loop()
+        result = make_result(filename=filename)
+        
+        cache_enabled = manager.config["cache"].get("enabled", True)
+        cache_key = AudioCache.make_key(payload)
+        if cache_enabled and use_cache:
+            cached_path = manager.cache.get(cache_key, payload["format"])
+            if cached_path:
+                await loop.run_in_executor(None, shutil.copyfile, cached_path, filename)
+                result.update(ok=True, status="ok", cached=True)
+                return result
+        
+        with manager._inflight_lock:
+            call = manager._inflight.get(cache_key)
+            leader = call is None
+            if leader:
+                call = manager._inflight[cache_key] = InFlightCall()
+            else:
+                index = call.join(filename)
+        if not leader:
+            # 首个调用方可能是同步接口的线程，在线程池中等待
+            return await loop.run_in_executor(None, call.wait, index)
+        
+        result = None
         try:
-            response = requests.head(
-                f"{API_BASE_URL}/voices",
-                headers=self.get_headers(),
-                timeout=5
-            )
-            if response.status_code == 200:
-                return True
+            result = await self._request_audio(payload, filename, cache_key, profile_name)
+            return result
+        finally:
+            with manager._inflight_lock:
+                del manager._inflight[cache_key]
+            if result is not None and result["ok"] and call.followers:
+                # 要给等待方复制文件；即使本协程被取消，线程池中的 finish 也会执行完
+                await loop.run_in_executor(None, call.finish, result)
             else:
-                print(f"❌ API响应异常 (状态码 {response.status_code})")
-                return False
-        except Exception as e:
-            print(f"❌ 无法连接到API: {str(e)}")
-            return False
+                call.finish(result)
 
-    def text_to_speech(self, text, voice_profile_name=None, speed=1.0):
-        """文字转语音 - 使用最新API规范"""
-        # 如果没有指定声音配置，使用当前配置
-        if voice_profile_name is None:
-            voice_profile = self.config["voices"].get(self.current_voice, {})
-            profile_name = self.current_voice
-        else:
-            voice_profile = self.config["voices"].get(voice_profile_name, {})
-            profile_name = voice_profile_name
+    async def _request_audio(self, payload, filename, cache_key, profile_name=None):
+        """向上游发起请求（含重试、熔断、限流和统计），成功后写入缓存"""
+        import asyncio
+        manager = self.manager
+        loop = asyncio.get_running_loop()
+        result = make_result(filename=filename)
+        cache_enabled = manager.config["cache"].get("enabled", True)
+        
+        session = self._get_session()
+        import aiohttp
+        
+        profile = profile_name or payload["reference_id"]
+        body = json.dumps(payload).encode("utf-8")
+        attempt = 0
+        read_timeouts = 0
+        while True:
+            route, wait = manager.router.select()
+            if route is None:
+                if wait:
+                    await asyncio.sleep(wait)
+                    continue
+                return fail_result(
+                    result,
+                    f"❌ API暂时不可用，已熔断（约{manager.router.retry_in():.0f}秒后重试）",
+                    "circuit_open"
+                )
+            
+            attempt += 1
+            result["attempts"] = attempt
+            retry_after = None
+            limiter = manager.limiter_for(route.key.key)
+            timings = {}
+            queued = time.monotonic()
+            latency = None
+            timed_out = False
+            acquired = False
+            succeeded = False
+            outcome = "error"
+            try:
+                async with self._semaphore:
+                    # 限流器是线程共享的，这里轮询许可以免阻塞事件循环
+                    while limiter and not acquired:
+                        wait = limiter.try_acquire()
+                        if wait:
+                            await asyncio.sleep(wait)
+                        else:
+                            acquired = True
+                    started = time.monotonic()
+                    timings["queue"] = started - queued
+                    connect_timeout, read_timeout = manager.timeouts.for_request(
+                        payload["backend"], len(payload["text"]), read_timeouts
+                    )
+                    async with session.post(
+                        f"{route.endpoint.url}/tts",
+                        data=body,
+                        headers=manager.get_headers(route.key.key),
+                        timeout=aiohttp.ClientTimeout(total=None, sock_connect=connect_timeout,
+                                                      sock_read=read_timeout)
+                    ) as response:
+                        latency = time.monotonic() - started
+                        # aiohttp不单独暴露建连耗时，计入ttfb
+                        timings["ttfb"] = latency
+                        result["status_code"] = response.status
+                        if response.status == 200:
+                            error = await self._save_response_audio(response, filename, payload["format"])
+                            outcome = "ok"
+                            if error:
+                                return fail_result(result, error, "invalid_response")
+                            manager.timeouts.observe(payload["backend"], len(payload["text"]), latency)
+                            timings["download"] = time.monotonic() - started - latency
+                            succeeded = True
+                            break
+                        
+                        # 错误响应体单独保存，body 是重试时还要发送的请求体
+                        error_body = await response.read()
+                        try:
+                            error_msg = json.loads(error_body).get("error", {})
+                        except (ValueError, AttributeError):
+                            error_msg = f"非JSON响应: {error_body[:200].decode('utf-8', 'replace')}"
+                        retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                        outcome, give_up = manager._http_failure(result, route, response.status, error_msg,
+                                                                 retry_after)
+                        if give_up:
+                            return result
+            except asyncio.TimeoutError as e:
+                timed_out = True
+                read_timeouts += 1
+                fail_result(result, f"❌ 请求超时: {str(e)}", "timeout")
+            except aiohttp.ClientError as e:
+                fail_result(result, f"❌ 无法连接到API: {str(e)}", "connection_error")
+            finally:
+                manager._release_attempt(route, limiter if acquired else None, outcome, latency, retry_after,
+                                         timed_out)
+                timings["total"] = time.monotonic() - queued
+                audio_bytes = os.path.getsize(filename) if succeeded else 0
+                manager.metrics.record(profile, payload["backend"], "ok" if succeeded else result["status"],
+                                       timings, len(body), audio_bytes)
+            
+            delay = manager._failure_delay(route, outcome, attempt, result, retry_after)
+            if delay is None:
+                return result
+            await asyncio.sleep(delay)
+        
+        if cache_enabled:
+            await loop.run_in_executor(None, manager.cache.put_file, cache_key, payload["format"], filename)
+        result.update(ok=True, status="ok", message="", error=None)
+        return result
+
+    async def synthesize(self, text, voice_profile_name=None, speed=1.0, use_cache=True,
+                         output_name=None, output_file=None):
+        """异步文字转语音，返回与 TTSManager.synthesize 相同结构的结果字典"""
+        import asyncio
+        manager = self.manager
+        loop = asyncio.get_running_loop()
         
+        profile_name, voice_profile = manager.get_voice_profile(voice_profile_name)
         if not voice_profile:
-            return "❌ 未找到声音配置"
+            return fail_result(make_result(), "❌ 未找到声音配置", "not_found")
+        
+        if manager._should_segment(text, voice_profile):
+            return await loop.run_in_executor(
+                None, manager.synthesize_segmented, text, voice_profile_name, speed, use_cache,
+                output_name, output_file
+            )
         
+        result = make_result()
+        filename = None
         try:
-            # 根据文档构造请求体
-            payload = {
-                "text": text,
-                "reference_id": voice_profile["voice_id"],
-                "backend": voice_profile["backend"],
-                "format": voice_profile["format"],
-                "temperature": voice_profile["temperature"],
-                "top_p": voice_profile["top_p"],
-                "chunk_length": voice_profile["chunk_length"],
-                "normalize": voice_profile["normalize"],
-                "speed": speed,
-                "volume": voice_profile["prosody_volume"]
-            }
-            
-            # 发送请求到新的端点
-            response = requests.post(
-                f"{API_BASE_URL}/tts",
-                json=payload,
-                headers=self.get_headers(),
-                timeout=30
+            payload = manager.build_payload(text, voice_profile, speed)
+            filename = manager.resolve_output_file(
+                text, voice_profile["format"], output_name, output_file, AudioCache.make_key(payload)
             )
             
-            if response.status_code == 200:
-                # 尝试解析JSON响应
-                try:
-                    data = response.json()
-                except json.JSONDecodeError:
-                    # 不是JSON响应 - 可能是音频二进制数据
-                    audio_data = response.content
-                    # 检查音频文件签名
-                    if audio_data.startswith(b'RIFF') or audio_data.startswith(b'\xFF\xFB'):
-                        data = {"audio": base64.b64encode(audio_data).decode('utf-8')}
-                    else:
-                        # 可能是错误消息
-                        return f"❌ 无效响应: {response.text[:200]}"
-                
-                # 获取音频数据
-                if "audio" in data:
-                    audio_content = data["audio"]
-                else:
-                    return "❌ 响应中未包含音频数据"
-                    
-                # 获取输出路径
-                output_dir = self.config["output_paths"].get(self.current_output_path, "./")
-                # 使用新的文件名格式（去掉voice_id）
-                filename = os.path.join(
-                    output_dir, 
-                    self.format_filename(text, voice_profile["format"])
+            result = await self.fetch_audio(payload, filename, use_cache, profile_name)
+            if not result["ok"]:
+                if not output_file:
+                    discard_placeholder(filename)
+                return result
+            
+            if not output_file:
+                filename = result["filename"] = await loop.run_in_executor(
+                    None, manager._archive_output, filename, text, profile_name, voice_profile, speed
                 )
-                
-                # 保存音频文件（Base64解码）
-                try:
-                    audio_data = base64.b64decode(audio_content)
-                except base64.binascii.Error:
-                    # 如果已经是原始二进制数据
-                    audio_data = audio_content
-                
-                with open(filename, "wb") as f:
-                    f.write(audio_data)
-                
-                # 保存历史记录 - 使用配置名称而不是声音ID
-                self.config["history"].insert(0, {
-                    "text": text,
-                    "voice_profile": profile_name,  # 使用配置名称
-                    "backend": voice_profile["backend"],
-                    "timestamp": datetime.now().isoformat(),
-                    "filename": filename,
-                    "speed": speed
-                })
-                # 只保留最近的20条记录
-                self.config["history"] = self.config["history"][:20]
-                self.save_config()
-                
-                return f"🔊 语音生成成功！保存为: {filename}"
+            await loop.run_in_executor(
+                None, manager.add_history, text, profile_name, voice_profile, filename, speed
+            )
+            
+            if result["cached"]:
+                result["message"] = f"🔊 语音生成成功（缓存命中）！保存为: {filename}"
             else:
-                # 处理非200响应
-                try:
-                    error_msg = response.json().get("error", {})
-                except json.JSONDecodeError:
-                    error_msg = f"非JSON响应: {response.text[:200]}"
-                
-                return f"❌ 请求失败 (状态码 {response.status_code}): {error_msg}"
+                result["message"] = f"🔊 语音生成成功！保存为: {filename}"
+            return result
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            # 捕获所有异常
-            return f"❌ 发生错误: {str(e)}"
+            return fail_result(result, f"❌ 发生错误: {str(e)}")
+
+    async def text_to_speech(self, text, voice_profile_name=None, speed=1.0, use_cache=True):
+        """异步文字转语音，返回与 TTSManager.text_to_speech 相同的提示信息"""
+        result = await self.synthesize(text, voice_profile_name, speed, use_cache)
+        return result["message"]
 
 def print_menu():
     """打印菜单 - 优化样式"""
@@ -338,7 +3996,10 @@ def print_menu():
         "4. 查看历史记录 📜 ",
         "5. 管理输出路径 📁 ",
         "6. 测试API连接 📶 ",
-        "7. 退出 🚪 "
+        "7. 批量生成 📦 ",
+        "8. 文档增量生成 📄 ",
+        "9. 性能统计 📊 ",
+        "10. 退出 🚪 "
     ]
     
     for item in menu_items:
@@ -500,8 +4161,6 @@ def manage_voice_profiles(manager):
         
         elif choice == "6":
             break
-        
-        time.sleep(1)
 
 def manage_output_paths(manager):
     """管理输出路径配置"""
@@ -583,25 +4242,146 @@ def manage_output_paths(manager):
         
         elif choice == "5":
             break
+
+def _parse_date_range(since, until):
+    """把用户输入的日期（YYYY-MM-DD）转换为查询用的时间范围，结束日期包含当天"""
+    if since:
+        since = datetime.strptime(since, "%Y-%m-%d").isoformat()
+    if until:
+        until = (datetime.strptime(until, "%Y-%m-%d") + timedelta(days=1)).isoformat()
+    return since, until
+
+def view_history(manager, page_size=10):
+    """分页查看和搜索历史记录"""
+    filters = {}
+    page = 1
+    while True:
+        total = manager.history.count(**filters)
+        pages = max(1, (total + page_size - 1) // page_size)
+        page = min(page, pages)
+        
+        print(f"\n历史记录 (第{page}/{pages}页，共{total}条):")
+        if filters:
+            print(f"搜索条件: {filters}")
+        records = manager.history.search(page=page, page_size=page_size, **filters)
+        if not records:
+            print("暂无历史记录")
+        for i, record in enumerate(records, (page - 1) * page_size + 1):
+            print(f"{i}. [{record['timestamp'][:19]}]")
+            print(f"   文本: {record['text'][:40]}")
+            # 使用配置名称而不是声音ID
+            print(f"   配置: {record['voice_profile']}")
+            print(f"   后端: {record['backend']}")
+            print(f"   语速: {record['speed']}")
+            print(f"   文件: {record['filename']}")
+            print("-" * 40)
+        
+        print("\n操作选项:")
+        print("1. 下一页")
+        print("2. 上一页")
+        print("3. 搜索")
+        print("4. 清除搜索条件")
+        print("5. 清空历史记录")
+        print("6. 返回主菜单")
+        
+        action = input("\n请选择操作: ")
         
-        time.sleep(1)
+        if action == "1":
+            if page < pages:
+                page += 1
+            else:
+                print("已经是最后一页")
+        elif action == "2":
+            if page > 1:
+                page -= 1
+            else:
+                print("已经是第一页")
+        elif action == "3":
+            text = input("\n文本包含（回车跳过）: ").strip()
+            profile = input("声音配置名称（回车跳过）: ").strip()
+            backend = input("后端模型（回车跳过）: ").strip()
+            since = input("开始日期 YYYY-MM-DD（回车跳过）: ").strip()
+            until = input("结束日期 YYYY-MM-DD（回车跳过）: ").strip()
+            try:
+                since, until = _parse_date_range(since, until)
+            except ValueError:
+                print("❌ 日期格式无效")
+                continue
+            filters = {key: value for key, value in {
+                "text": text, "profile": profile, "backend": backend,
+                "since": since, "until": until
+            }.items() if value}
+            page = 1
+        elif action == "4":
+            filters = {}
+            page = 1
+        elif action == "5":
+            confirm = input("\n确定要清空所有历史记录吗? (y/n): ").lower()
+            if confirm == "y":
+                print(manager.clear_history())
+        elif action == "6":
+            break
+        else:
+            print("❌ 请选择有效的选项")
 
-def main():
-    # 设置基本的日志格式
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.StreamHandler()
-        ]
-    )
+def show_stats(manager):
+    """显示请求耗时分位数、缓存和限流状态，并可导出统计"""
+    snapshot = manager.metrics.snapshot()
     
-    manager = TTSManager()
+    print("\n\033[1;36m请求耗时 (秒，最近样本):\033[0m")
+    if not snapshot["phases"]:
+        print("暂无请求数据")
+    else:
+        print(f"{'配置':<12}{'后端':<12}{'阶段':<10}{'样本':>6}{'p50':>9}{'p95':>9}{'p99':>9}")
+        for entry in snapshot["phases"]:
+            print(f"{entry['profile'][:11]:<12}{entry['backend']:<12}{entry['phase']:<10}"
+                  f"{entry['count']:>6}{entry['p50']:>9.3f}{entry['p95']:>9.3f}{entry['p99']:>9.3f}")
     
+    metrics = manager.metrics
+    print("\n\033[1;36m累计:\033[0m")
+    print(f"请求数: {metrics.count('requests')} (成功 {metrics.count('requests', status='ok')})")
+    print(f"请求体字节: {metrics.count('payload_bytes')}")
+    print(f"音频字节: {metrics.count('audio_bytes')}")
+    
+    cache = manager.cache.stats()
+    print(f"\n缓存: {cache['entries']}个文件, {cache['bytes'] / 1024 / 1024:.1f}MB, "
+          f"命中率 {cache['hit_rate']:.0%} ({cache['hits']}/{cache['hits'] + cache['misses']})")
+    print(f"熔断器: {manager.router.state}")
+    routing = manager.router.snapshot()
+    if len(routing["endpoints"]) > 1 or len(routing["api_keys"]) > 1:
+        for endpoint in routing["endpoints"]:
+            latency = f"{endpoint['latency']:.3f}s" if endpoint["latency"] is not None else "-"
+            print(f"  {endpoint['url']}: {endpoint['state']}, 延迟 {latency}, "
+                  f"错误率 {endpoint['error_rate']:.0%}, 请求 {endpoint['requests']}次")
+        for key in routing["api_keys"]:
+            print(f"  密钥 {key['key']}: 请求 {key['requests']}次"
+                  + (f", 冷却中 {key['wait']:.0f}秒" if key["wait"] else ""))
+    limiter = manager.rate_limit_state()
+    if limiter:
+        print(f"限流器: {limiter['rate']}次/秒, 并发上限 {limiter['concurrency_limit']}, "
+              f"进行中 {limiter['in_flight']}, 被限流 {limiter['throttled']}次")
+    for backend, observed in manager.timeouts.snapshot().items():
+        _, read_timeout = manager.timeouts.for_request(backend, 200)
+        print(f"超时估算 {backend}: 开销 {observed['overhead']:.2f}秒 + {observed['seconds_per_char'] * 1000:.1f}毫秒/字, "
+              f"200字读超时 {read_timeout:.1f}秒 ({observed['samples']}个样本)")
+
+    default_path = manager.config["metrics"].get("export_path", "Fish_tts_metrics.prom")
+    path = input(f"\n导出统计文件路径（.json或.prom，回车跳过，输入y导出到{default_path}）: ").strip()
+    if path.lower() == "y":
+        path = default_path
+    if path:
+        print(f"📊 统计已导出: {manager.metrics.export(path)}")
+
+def run_menu(manager):
+    """交互式菜单"""
     # 确保输出目录存在
     for path in manager.config["output_paths"].values():
         os.makedirs(path, exist_ok=True)
     
+    # 后台预热连接池，不阻塞菜单显示
+    if manager.config["http"].get("warm_up", False):
+        threading.Thread(target=manager.warm_up, daemon=True).start()
+    
     while True:
         print_menu()
         choice = input("\n请选择操作: ")
@@ -669,36 +4449,7 @@ def main():
             print(manager.set_api_key(key))
         
         elif choice == "4":
-            print("\n历史记录:")
-            if not manager.config["history"]:
-                print("暂无历史记录")
-            else:
-                for i, record in enumerate(manager.config["history"], 1):
-                    print(f"{i}. [{record['timestamp'][:19]}]")
-                    # 使用配置名称而不是声音ID
-                    print(f"   配置: {record['voice_profile']}")
-                    print(f"   后端: {record['backend']}")
-                    print(f"   语速: {record['speed']}")
-                    print(f"   文件: {record['filename']}")
-                    print("-" * 40)
-            
-            if manager.config["history"]:
-                print("\n操作选项:")
-                print("1. 清空历史记录")
-                print("2. 返回主菜单")
-                
-                action = input("\n请选择操作: ")
-                
-                if action == "1":
-                    confirm = input("\n确定要清空所有历史记录吗? (y/n): ").lower()
-                    if confirm == "y":
-                        print(manager.clear_history())
-                elif action == "2":
-                    continue
-                else:
-                    print("❌ 请选择有效的选项")
-            else:
-                input("\n按回车键返回主菜单...")
+            view_history(manager)
         
         elif choice == "5":
             manage_output_paths(manager)
@@ -710,13 +4461,371 @@ def main():
                 print("❌ 无法连接到API，请检查API密钥和网络连接")
         
         elif choice == "7":
+            manifest_path = input("\n请输入任务清单路径 (.txt 或 .jsonl): ").strip()
+            if not os.path.isfile(manifest_path):
+                print("❌ 文件不存在")
+                continue
+            default_concurrency = manager.config["batch"].get("concurrency", 4)
+            try:
+                concurrency = int(input(f"并发数 (默认{default_concurrency}): ") or default_concurrency)
+            except ValueError:
+                print("❌ 输入无效，使用默认并发数")
+                concurrency = default_concurrency
+            
+            print("\n批量生成中...")
+            try:
+                summary = manager.run_batch(manifest_path, concurrency)
+            except (OSError, ValueError) as e:
+                print(f"❌ 读取任务清单失败: {e}")
+            else:
+                print(f"\n📦 批量生成完成: 成功 {summary['ok']}/{summary['total']}，"
+                      f"耗时 {summary['elapsed']} 秒")
+                print(f"结果汇总: {summary['summary_path']}")
+        
+        elif choice == "8":
+            document_path = input("\n请输入文档路径: ").strip()
+            if not os.path.isfile(document_path):
+                print("❌ 文件不存在")
+                continue
+            profile = manager.config["voices"].get(manager.current_voice, {})
+            default_output = os.path.splitext(document_path)[0] + "." + profile.get("format", "mp3")
+            output_file = input(f"输出文件 (默认{default_output}): ").strip() or default_output
+            
+            with open(document_path, "r", encoding="utf-8") as f:
+                text = f.read()
+            
+            print("\n生成中...")
+            result = manager.synthesize_document(text, output_file)
+            print(f"\n{result['message']}")
+        
+        elif choice == "9":
+            show_stats(manager)
+        
+        elif choice == "10":
+            manager.close()
             print("\n感谢使用，再见！")
             break
         
         else:
             print("❌ 请选择有效的选项")
-        
-        time.sleep(1)
+
+def read_text_argument(text):
+    """读取命令行文本参数，为 - 或省略时从标准输入读取"""
+    if text is None or text == "-":
+        return sys.stdin.read()
+    return text
+
+def cmd_synth(manager, args):
+    """synth 子命令：生成一段语音，成功时把文件路径输出到标准输出"""
+    text = read_text_argument(args.text).strip()
+    if not text:
+        print("❌ 文本为空", file=sys.stderr)
+        return 1
+    if args.stream:
+        return stream_to_target(manager, text, args)
+    if args.document:
+        if not args.output:
+            print("❌ 文档模式需要指定 --output", file=sys.stderr)
+            return 1
+        result = manager.synthesize_document(text, args.output, args.profile, args.speed)
+    else:
+        result = manager.synthesize(text, args.profile, args.speed, use_cache=not args.no_cache,
+                                    output_name=args.output_path, output_file=args.output)
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False))
+    elif result["ok"]:
+        print(result["filename"])
+    if not result["ok"]:
+        print(result["message"], file=sys.stderr)
+        return 1
+    return 0
+
+def stream_to_target(manager, text, args):
+    """流式输出到标准输出或命名管道，耗时信息输出到标准错误"""
+    if not args.output or args.output == "-":
+        result = manager.stream_speech(text, sys.stdout.buffer, args.profile, args.speed,
+                                       use_cache=not args.no_cache)
+    else:
+        # 打开命名管道会阻塞到播放器开始读取
+        with open(args.output, "wb") as sink:
+            result = manager.stream_speech(text, sink, args.profile, args.speed,
+                                           use_cache=not args.no_cache)
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False), file=sys.stderr)
+    elif result["ok"]:
+        print(f"⏱️ 首段音频 {result['ttfa']:.3f} 秒，总耗时 {result['elapsed']:.3f} 秒，"
+              f"{result['segments']}段 {result['bytes']}字节", file=sys.stderr)
+    if not result["ok"]:
+        print(result["message"], file=sys.stderr)
+        return 1
+    return 0
+
+def cmd_batch(manager, args):
+    """batch 子命令：按任务清单批量生成"""
+    try:
+        summary = manager.run_batch(args.manifest, args.concurrency, args.summary,
+                                    show_progress=not args.quiet, resume=not args.restart)
+    except (OSError, ValueError) as e:
+        print(f"❌ 读取任务清单失败: {e}", file=sys.stderr)
+        return 1
+    print(json.dumps(summary, ensure_ascii=False))
+    return 0 if summary["failed"] == 0 else 1
+
+def parse_grid(specs):
+    """解析 --grid 参数，如 ["temperature=0.5,0.7", "speed=1.0,1.2"]"""
+    grid = {}
+    for spec in specs or []:
+        name, sep, values = spec.partition("=")
+        if not sep:
+            raise ValueError(f"网格参数格式应为 名称=值1,值2: {spec}")
+        grid[name.strip()] = [float(value) for value in values.split(",") if value.strip()]
+    return grid
+
+def cmd_fanout(manager, args):
+    """fanout 子命令：同一文本按多个配置或参数组合生成，便于对比"""
+    text = read_text_argument(args.text).strip()
+    if not text:
+        print("❌ 文本为空", file=sys.stderr)
+        return 1
+    try:
+        profiles = [name.strip() for name in args.profiles.split(",") if name.strip()] if args.profiles else None
+        summary = manager.synthesize_fanout(text, profiles, parse_grid(args.grid), args.speed, args.output,
+                                            use_cache=not args.no_cache, concurrency=args.concurrency)
+    except (OSError, ValueError) as e:
+        print(f"❌ {e}", file=sys.stderr)
+        return 1
+    print(json.dumps(summary, ensure_ascii=False))
+    return 0 if summary["failed"] == 0 else 1
+
+def cmd_postprocess(manager, args):
+    """postprocess 子命令：对已有的WAV/PCM文件做批量后处理"""
+    settings = dict(manager.config["postprocess"])
+    if args.target_dbfs is not None:
+        settings["target_dbfs"] = args.target_dbfs
+    if args.batch_loudness:
+        settings["target_dbfs"] = None
+    if args.sample_rate is not None:
+        settings["sample_rate"] = args.sample_rate
+    if args.pad_ms is not None:
+        settings["pad_ms"] = args.pad_ms
+    if args.no_trim:
+        settings["trim_silence"] = False
+    volume = manager.get_voice_profile(args.profile)[1].get("prosody_volume", 0.0)
+    items = [(path, os.path.splitext(path)[1].lstrip(".").lower(), volume) for path in args.files]
+    try:
+        summary = AudioPostProcessor(settings).process(items)
+    except (RuntimeError, ValueError, OSError, wave.Error) as e:
+        print(f"❌ 后处理失败: {e}", file=sys.stderr)
+        return 1
+    print(json.dumps(summary, ensure_ascii=False))
+    return 0
+
+def cmd_pack(manager, args):
+    """pack 子命令：查看、读取、导出和压缩片段归档"""
+    pack = manager.pack
+    if args.action in (None, "stats"):
+        print(json.dumps(pack.stats(), ensure_ascii=False))
+    elif args.action == "list":
+        for entry in pack.entries():
+            print(f"{entry['key']}\t{entry['format']}\t{entry['offset']}\t{entry['length']}\t"
+                  f"{entry['meta'].get('text', '')[:40]}")
+    elif args.action == "cat":
+        try:
+            sys.stdout.buffer.write(manager.read_clip(args.target))
+        except (KeyError, OSError, ValueError) as e:
+            print(f"❌ 读取失败: {e}", file=sys.stderr)
+            return 1
+    elif args.action == "extract":
+        entries = pack.entries() if args.target is None else [pack.get(args.target)]
+        if entries == [None]:
+            print("⚠️ 归档中没有该片段", file=sys.stderr)
+            return 1
+        for entry in entries:
+            print(pack.extract(entry["key"], os.path.join(args.output, f"{entry['key']}.{entry['format']}")))
+    elif args.action == "remove":
+        if not pack.remove(args.target):
+            print("⚠️ 归档中没有该片段", file=sys.stderr)
+            return 1
+    elif args.action == "compact":
+        print(f"🗜️ 已回收 {pack.compact()} 字节", file=sys.stderr)
+    return 0
+
+def cmd_profiles(manager, args):
+    """profiles 子命令：列出、查看、切换或删除声音配置"""
+    voices = manager.config["voices"]
+    if args.action in (None, "list"):
+        if args.json:
+            print(json.dumps({"current": manager.current_voice, "profiles": voices}, ensure_ascii=False))
+        else:
+            for name, profile in voices.items():
+                marker = "*" if name == manager.current_voice else " "
+                print(f"{marker} {name}\t{profile.get('backend')}\t{profile.get('format')}\t{profile.get('voice_id')}")
+        return 0
+    
+    if args.name not in voices:
+        print("⚠️ 配置不存在", file=sys.stderr)
+        return 1
+    if args.action == "show":
+        print(json.dumps(voices[args.name], ensure_ascii=False, indent=None if args.json else 2))
+    elif args.action == "use":
+        manager.current_voice = args.name
+        manager.save_config()
+        print(f"✅ 当前配置已切换为: {args.name}", file=sys.stderr)
+    elif args.action == "delete":
+        message = manager.delete_voice_profile(args.name)
+        print(message, file=sys.stderr)
+        return 0 if args.name not in voices else 1
+    return 0
+
+def cmd_history(manager, args):
+    """history 子命令：搜索或清空历史记录"""
+    if args.clear:
+        print(manager.clear_history(), file=sys.stderr)
+        return 0
+    try:
+        since, until = _parse_date_range(args.since, args.until)
+    except ValueError:
+        print("❌ 日期格式无效，应为 YYYY-MM-DD", file=sys.stderr)
+        return 1
+    filters = {key: value for key, value in {
+        "text": args.search, "profile": args.profile, "backend": args.backend,
+        "since": since, "until": until
+    }.items() if value}
+    records = manager.history.search(page=args.page, page_size=args.page_size, **filters)
+    if args.json:
+        print(json.dumps({"total": manager.history.count(**filters), "records": records}, ensure_ascii=False))
+    else:
+        for record in records:
+            print(f"{record['timestamp'][:19]}\t{record['voice_profile']}\t{record['backend']}\t"
+                  f"{record['filename']}\t{record['text'][:40]}")
+    return 0
+
+def cmd_ping(manager, args):
+    """ping 子命令：测试API连接，输出往返耗时"""
+    started = time.monotonic()
+    if manager.test_api_connection():
+        print(f"✅ API连接正常 ({(time.monotonic() - started) * 1000:.0f} ms)")
+        return 0
+    return 1
+
+def cmd_serve(manager, args):
+    """serve 子命令：以本地HTTP服务运行"""
+    from Fish_TTS_Server import serve
+    serve(manager, args.host, args.port)
+    return 0
+
+def build_parser():
+    """构造命令行参数解析器"""
+    parser = argparse.ArgumentParser(
+        description="Fish Audio 文字转语音工具，不带子命令时进入交互菜单"
+    )
+    parser.add_argument("-v", "--verbose", action="store_true", help="输出请求日志，包括每个请求的分阶段耗时")
+    commands = parser.add_subparsers(dest="command")
+    
+    synth = commands.add_parser("synth", help="生成一段语音")
+    synth.add_argument("text", nargs="?", default="-", help="要转换的文本，省略或为 - 时从标准输入读取")
+    synth.add_argument("-p", "--profile", help="声音配置名称（默认当前配置）")
+    synth.add_argument("-s", "--speed", type=float, default=1.0, help="语速 (0.5-2.0)")
+    synth.add_argument("-o", "--output", help="输出文件路径")
+    synth.add_argument("--output-path", help="输出路径名称（见交互菜单中的输出路径管理）")
+    synth.add_argument("--no-cache", action="store_true", help="不读取磁盘缓存")
+    synth.add_argument("--document", action="store_true", help="文档模式：分段生成并支持断点续传，需要 --output")
+    synth.add_argument("--stream", action="store_true",
+                       help="边生成边输出音频到标准输出（或 --output 指定的命名管道），不保存文件")
+    synth.add_argument("--json", action="store_true", help="以JSON输出完整结果")
+    synth.set_defaults(handler=cmd_synth)
+    
+    batch = commands.add_parser("batch", help="按任务清单批量生成")
+    batch.add_argument("manifest", help="任务清单 (.txt 或 .jsonl)")
+    batch.add_argument("-c", "--concurrency", type=int, help="并发数")
+    batch.add_argument("--summary", help="结果汇总文件路径")
+    batch.add_argument("-q", "--quiet", action="store_true", help="不显示进度")
+    batch.add_argument("--restart", action="store_true", help="忽略任务日志中已完成的记录，全部重新生成")
+    batch.set_defaults(handler=cmd_batch)
+    
+    fanout = commands.add_parser("fanout", help="同一文本按多个声音配置或参数组合生成，输出对比清单")
+    fanout.add_argument("text", nargs="?", default="-", help="要转换的文本，省略或为 - 时从标准输入读取")
+    fanout.add_argument("-p", "--profiles", help="逗号分隔的声音配置名称（默认当前配置）")
+    fanout.add_argument("-g", "--grid", action="append",
+                        help="参数网格，如 temperature=0.5,0.7；可重复，支持 temperature、top_p、speed")
+    fanout.add_argument("-s", "--speed", type=float, default=1.0, help="网格中不含 speed 时使用的语速")
+    fanout.add_argument("-o", "--output", help="输出目录（默认在当前输出路径下新建）")
+    fanout.add_argument("-c", "--concurrency", type=int, help="并发数")
+    fanout.add_argument("--no-cache", action="store_true", help="不读取磁盘缓存")
+    fanout.set_defaults(handler=cmd_fanout)
+    
+    postprocess = commands.add_parser("postprocess", help="批量后处理WAV/PCM文件（需要 numpy）")
+    postprocess.add_argument("files", nargs="+", help="音频文件")
+    postprocess.add_argument("--target-dbfs", type=float, help="目标响度 (dBFS)")
+    postprocess.add_argument("--batch-loudness", action="store_true", help="以这批文件的响度中位数为目标")
+    postprocess.add_argument("--sample-rate", type=int, help="重采样到指定采样率")
+    postprocess.add_argument("--pad-ms", type=int, help="首尾补静音的毫秒数")
+    postprocess.add_argument("--no-trim", action="store_true", help="不裁剪首尾静音")
+    postprocess.add_argument("-p", "--profile", help="按该声音配置的 prosody_volume 调整目标响度")
+    postprocess.set_defaults(handler=cmd_postprocess)
+    
+    pack = commands.add_parser("pack", help="管理片段归档（pack.enabled 时生成结果写入归档）")
+    pack.add_argument("action", nargs="?", choices=("stats", "list", "cat", "extract", "remove", "compact"),
+                      help="默认为 stats")
+    pack.add_argument("target", nargs="?", help="片段key；cat 也接受历史记录中的归档位置；extract 省略时导出全部")
+    pack.add_argument("-o", "--output", default=".", help="extract 的导出目录")
+    pack.set_defaults(handler=cmd_pack)
+    
+    profiles = commands.add_parser("profiles", help="管理声音配置")
+    profiles.add_argument("action", nargs="?", choices=("list", "show", "use", "delete"), help="默认为 list")
+    profiles.add_argument("name", nargs="?", help="配置名称")
+    profiles.add_argument("--json", action="store_true", help="以JSON输出")
+    profiles.set_defaults(handler=cmd_profiles)
+    
+    history = commands.add_parser("history", help="搜索历史记录")
+    history.add_argument("--search", help="文本包含")
+    history.add_argument("--profile", help="声音配置名称")
+    history.add_argument("--backend", help="后端模型")
+    history.add_argument("--since", help="开始日期 YYYY-MM-DD")
+    history.add_argument("--until", help="结束日期 YYYY-MM-DD（包含当天）")
+    history.add_argument("--page", type=int, default=1)
+    history.add_argument("--page-size", type=int, default=20)
+    history.add_argument("--json", action="store_true", help="以JSON输出")
+    history.add_argument("--clear", action="store_true", help="清空历史记录")
+    history.set_defaults(handler=cmd_history)
+    
+    ping = commands.add_parser("ping", help="测试API连接")
+    ping.set_defaults(handler=cmd_ping)
+    
+    server = commands.add_parser("serve", help="以本地HTTP服务运行（相同的并发请求只调用一次API）")
+    server.add_argument("--host", default="127.0.0.1", help="监听地址")
+    server.add_argument("--port", type=int, default=8765, help="监听端口")
+    server.set_defaults(handler=cmd_serve)
+    return parser
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.command == "profiles" and args.action not in (None, "list") and not args.name:
+        parser.error("profiles show/use/delete 需要配置名称")
+    if args.command == "pack" and args.action in ("cat", "remove") and not args.target:
+        parser.error(f"pack {args.action} 需要片段key")
+    
+    # 设置基本的日志格式；子命令默认只输出警告，避免干扰管道
+    logging.basicConfig(
+        level=logging.INFO if args.command is None or args.verbose else logging.WARNING,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.StreamHandler()
+        ]
+    )
+    if args.verbose:
+        # 逐请求的耗时明细以DEBUG级别记录（见 RequestMetrics.record），只对本程序的日志开启
+        logger.setLevel(logging.DEBUG)
+    
+    manager = TTSManager()
+    if args.command is None:
+        run_menu(manager)
+        return 0
+    try:
+        return args.handler(manager, args)
+    finally:
+        manager.close()
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,354 @@
+"""Fish TTS 性能基准测试
+
+在本地启动一个模拟 /v1/tts 的服务（子进程），用 TTSManager 分别以
+单条、批量、并发（以及可选的异步）模式生成音频，统计吞吐量、延迟分位数、
+峰值内存和数据量。每个模式在单独的子进程中运行，峰值内存互不累计。
+全程离线运行，可用于部署前发现性能回退：
+
+    python Fish_TTS_Bench.py --clips 200 --json bench.json
+    python Fish_TTS_Bench.py --baseline bench.json --tolerance 0.2
+"""
+import argparse
+import base64
+import importlib.util
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import random
+import resource
+import struct
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import Fish_AI_TTS_Pro as tts
+
+# 一个 MPEG1 Layer III 128kbps 44.1kHz 的静音帧（417字节）
+MP3_FRAME = b"\xff\xfb\x90\x00" + b"\x00" * 413
+
+def make_audio(format, size):
+    """生成指定格式、约size字节的音频数据"""
+    if format == "mp3":
+        return b"ID3\x03\x00\x00\x00\x00\x00\x00" + MP3_FRAME * max(1, size // len(MP3_FRAME))
+    if format == "wav":
+        pcm = b"\x00" * size
+        header = b"RIFF" + struct.pack("<I", 36 + len(pcm)) + b"WAVE"
+        header += b"fmt " + struct.pack("<IHHIIHH", 16, 1, 1, 44100, 88200, 2, 16)
+        return header + b"data" + struct.pack("<I", len(pcm)) + pcm
+    return b"\x00" * size
+
+class MockTTSHandler(BaseHTTPRequestHandler):
+    """模拟 /v1/tts 接口，支持JSON(Base64)和原始二进制两种响应"""
+
+    protocol_version = "HTTP/1.1"
+    options = {}
+    bodies = {}
+    stats = {"requests": 0, "errors": 0, "bytes_sent": 0}
+    stats_lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        with self.stats_lock:
+            self.stats["bytes_sent"] += len(body)
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        if self.path.endswith("/stats"):
+            with self.stats_lock:
+                body = json.dumps(self.stats).encode("utf-8")
+            self._send(200, body, "application/json")
+        else:
+            self._send(404, b"{}", "application/json")
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        raw = self.rfile.read(length)
+        options = self.options
+        with self.stats_lock:
+            self.stats["requests"] += 1
+        # 与真实接口一样校验请求体，客户端发错请求时基准测试应当失败
+        try:
+            payload = json.loads(raw)
+        except ValueError:
+            payload = None
+        if not isinstance(payload, dict) or not payload.get("text") or not payload.get("format"):
+            with self.stats_lock:
+                self.stats["errors"] += 1
+            self._send(400, b'{"error": "text and format are required"}', "application/json")
+            return
+
+        delay = options["latency"] + random.uniform(0, options["jitter"])
+        if delay > 0:
+            time.sleep(delay)
+
+        if random.random() < options["error_rate"]:
+            with self.stats_lock:
+                self.stats["errors"] += 1
+            self._send(503, b'{"error": "mock overloaded"}', "application/json")
+            return
+
+        shape = options["shape"]
+        if shape == "both":
+            shape = random.choice(("raw", "json"))
+        body, content_type = self.bodies[(payload["format"], shape)]
+        self._send(200, body, content_type)
+
+def run_mock_server(options, port_queue):
+    """子进程入口：启动模拟服务并把端口号传回父进程"""
+    MockTTSHandler.options = options
+    for format in ("mp3", "wav", "pcm", "ogg", "flac"):
+        audio = make_audio(format, options["payload_bytes"])
+        MockTTSHandler.bodies[(format, "raw")] = (audio, "application/octet-stream")
+        encoded = json.dumps({"audio": base64.b64encode(audio).decode("ascii")}).encode("utf-8")
+        MockTTSHandler.bodies[(format, "json")] = (encoded, "application/json")
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockTTSHandler)
+    server.daemon_threads = True
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+class MockServer:
+    """在子进程中运行模拟服务，避免其内存和GIL占用干扰测量"""
+
+    def __init__(self, **options):
+        self.options = options
+        self.process = None
+        self.base_url = None
+
+    def __enter__(self):
+        port_queue = multiprocessing.Queue()
+        self.process = multiprocessing.Process(
+            target=run_mock_server, args=(self.options, port_queue), daemon=True
+        )
+        self.process.start()
+        self.base_url = f"http://127.0.0.1:{port_queue.get(timeout=10)}/v1"
+        return self
+
+    def __exit__(self, *exc_info):
+        self.process.terminate()
+        self.process.join()
+
+    def stats(self):
+        import requests
+        return requests.get(f"{self.base_url}/stats", timeout=5).json()
+
+def peak_rss_mb():
+    """当前进程的峰值常驻内存（MB）；每个模式在各自的子进程中调用"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux以KB为单位，macOS以字节为单位
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+def summarize(mode, latencies, results, elapsed, server_before, server_after, manager):
+    """汇总单个模式的测量结果"""
+    latencies = sorted(latencies)
+    ok = sum(1 for result in results if result["ok"])
+    return {
+        "mode": mode,
+        "clips": len(results),
+        "ok": ok,
+        "failed": len(results) - ok,
+        "elapsed": round(elapsed, 3),
+        "clips_per_sec": round(ok / elapsed, 2) if elapsed else 0.0,
+        "p50": round(tts.percentile(latencies, 50) or 0, 4),
+        "p95": round(tts.percentile(latencies, 95) or 0, 4),
+        "p99": round(tts.percentile(latencies, 99) or 0, 4),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "bytes_received": server_after["bytes_sent"] - server_before["bytes_sent"],
+        "bytes_written": manager.metrics.count("audio_bytes"),
+        "requests": server_after["requests"] - server_before["requests"]
+    }
+
+def timed_synthesize(manager, text, output_file):
+    started = time.monotonic()
+    result = manager.synthesize(text, output_file=output_file)
+    return time.monotonic() - started, result
+
+def bench_single(manager, texts, output_dir):
+    """逐条顺序生成"""
+    outcomes = [timed_synthesize(manager, text, os.path.join(output_dir, f"single_{i}.mp3"))
+                for i, text in enumerate(texts)]
+    return [latency for latency, _ in outcomes], [result for _, result in outcomes]
+
+def bench_concurrent(manager, texts, output_dir, concurrency):
+    """线程池并发调用 synthesize"""
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(executor.map(
+            lambda item: timed_synthesize(manager, item[1], os.path.join(output_dir, f"concurrent_{item[0]}.mp3")),
+            enumerate(texts)
+        ))
+    return [latency for latency, _ in outcomes], [result for _, result in outcomes]
+
+def bench_batch(manager, texts, output_dir, concurrency):
+    """通过 run_batch 执行JSONL任务清单"""
+    manifest_path = os.path.join(output_dir, "bench_manifest.jsonl")
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        for i, text in enumerate(texts):
+            f.write(json.dumps({"text": text, "output": os.path.join(output_dir, f"batch_{i}.mp3")},
+                               ensure_ascii=False) + "\n")
+    summary = manager.run_batch(manifest_path, concurrency, show_progress=False)
+    with open(summary["summary_path"], "r", encoding="utf-8") as f:
+        records = [json.loads(line) for line in f]
+    return [record["elapsed"] for record in records], records
+
+def bench_async(manager, texts, output_dir, concurrency):
+    """AsyncTTSClient 并发生成"""
+    import asyncio
+
+    async def run():
+        async with tts.AsyncTTSClient(manager, concurrency) as client:
+            async def one(index, text):
+                started = time.monotonic()
+                result = await client.synthesize(text, output_file=os.path.join(output_dir, f"async_{index}.mp3"))
+                return time.monotonic() - started, result
+            return await asyncio.gather(*(one(i, text) for i, text in enumerate(texts)))
+
+    outcomes = asyncio.run(run())
+    return [latency for latency, _ in outcomes], [result for _, result in outcomes]
+
+def configure_manager(manager, args):
+    """基准测试关闭缓存，按参数设置限流和重试"""
+    manager.config["cache"]["enabled"] = False
+    manager.config["segment"]["enabled"] = False
+    manager.config["rate_limit"]["enabled"] = args.rate_limit
+    manager.config["retry"]["base_delay"] = 0.01
+    manager.config["http"]["pool_size"] = max(args.concurrency, 10)
+
+def run_mode(mode, args, base_url, workdir, report_queue):
+    """子进程入口：运行单个模式并把结果传回父进程"""
+    logging.getLogger("FishTTS").setLevel(logging.INFO if args.verbose else logging.ERROR)
+    tts.API_BASE_URL = base_url
+    # 配置、历史数据库和缓存都放在临时目录中，不影响正式配置
+    os.chdir(workdir)
+    server = MockServer()
+    server.base_url = base_url
+    manager = tts.TTSManager()
+    configure_manager(manager, args)
+    output_dir = os.path.join(workdir, mode)
+    os.makedirs(output_dir, exist_ok=True)
+    texts = [f"基准测试第{i}条文本 benchmark clip {i}" for i in range(args.clips)]
+
+    before = server.stats()
+    started = time.monotonic()
+    if mode == "single":
+        latencies, results = bench_single(manager, texts, output_dir)
+    elif mode == "batch":
+        latencies, results = bench_batch(manager, texts, output_dir, args.concurrency)
+    elif mode == "concurrent":
+        latencies, results = bench_concurrent(manager, texts, output_dir, args.concurrency)
+    elif mode == "async":
+        latencies, results = bench_async(manager, texts, output_dir, args.concurrency)
+    else:
+        raise ValueError(f"未知模式: {mode}")
+    elapsed = time.monotonic() - started
+
+    report_queue.put(summarize(mode, latencies, results, elapsed, before, server.stats(), manager))
+    manager.close()
+
+def run_benchmarks(args):
+    """启动模拟服务，每个模式在新的子进程中运行（峰值内存按模式单独统计），返回结果列表"""
+    modes = [mode.strip() for mode in args.modes.split(",") if mode.strip()]
+    if "async" in modes and importlib.util.find_spec("aiohttp") is None:
+        print("⚠️ 未安装 aiohttp，跳过 async 模式")
+        modes.remove("async")
+    reports = []
+    workdir = tempfile.mkdtemp(prefix="fish_tts_bench_")
+    # spawn 启动的子进程不继承父进程已占用的内存
+    context = multiprocessing.get_context("spawn")
+    with MockServer(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                    payload_bytes=args.payload_kb * 1024, shape=args.shape) as server:
+        for mode in modes:
+            report_queue = context.Queue()
+            process = context.Process(target=run_mode, args=(mode, args, server.base_url, workdir, report_queue))
+            process.start()
+            try:
+                while True:
+                    try:
+                        reports.append(report_queue.get(timeout=1))
+                        break
+                    except queue.Empty:
+                        if not process.is_alive():
+                            raise RuntimeError(f"{mode} 模式的子进程异常退出 (退出码 {process.exitcode})")
+            finally:
+                process.join()
+    return reports
+
+def print_reports(reports):
+    print(f"\n{'模式':<12}{'成功':>8}{'失败':>6}{'条/秒':>10}{'p50':>9}{'p95':>9}{'p99':>9}"
+          f"{'峰值MB':>9}{'接收MB':>9}{'写入MB':>9}")
+    for report in reports:
+        print(f"{report['mode']:<12}{report['ok']:>8}{report['failed']:>6}{report['clips_per_sec']:>10.2f}"
+              f"{report['p50']:>9.3f}{report['p95']:>9.3f}{report['p99']:>9.3f}"
+              f"{report['peak_rss_mb']:>9.1f}{report['bytes_received'] / 1048576:>9.2f}"
+              f"{report['bytes_written'] / 1048576:>9.2f}")
+
+def compare_with_baseline(reports, baseline_path, tolerance):
+    """与基线结果比较吞吐量和p95延迟，返回发现的回退"""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = {report["mode"]: report for report in json.load(f)["reports"]}
+    regressions = []
+    for report in reports:
+        base = baseline.get(report["mode"])
+        if not base:
+            continue
+        if report["clips_per_sec"] < base["clips_per_sec"] * (1 - tolerance):
+            regressions.append(f"{report['mode']}: 吞吐量 {base['clips_per_sec']} -> {report['clips_per_sec']} 条/秒")
+        if base["p95"] and report["p95"] > base["p95"] * (1 + tolerance):
+            regressions.append(f"{report['mode']}: p95延迟 {base['p95']} -> {report['p95']} 秒")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fish TTS 离线性能基准测试")
+    parser.add_argument("--clips", type=int, default=100, help="每个模式生成的条数")
+    parser.add_argument("--modes", default="single,batch,concurrent",
+                        help="逗号分隔的模式: single,batch,concurrent,async")
+    parser.add_argument("--concurrency", type=int, default=8, help="批量/并发模式的并发数")
+    parser.add_argument("--latency", type=float, default=0.05, help="模拟服务的基础延迟（秒）")
+    parser.add_argument("--jitter", type=float, default=0.02, help="模拟服务的随机附加延迟上限（秒）")
+    parser.add_argument("--payload-kb", type=int, default=64, help="每条音频的大小（KB）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回503的概率")
+    parser.add_argument("--shape", choices=("raw", "json", "both"), default="raw",
+                        help="响应形式：原始二进制、JSON(Base64)或随机混合")
+    parser.add_argument("--rate-limit", action="store_true", help="启用客户端自适应限流")
+    parser.add_argument("--json", dest="json_path", help="把结果写入JSON文件")
+    parser.add_argument("--baseline", help="与之前保存的JSON结果比较")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="允许的性能回退比例")
+    parser.add_argument("--verbose", action="store_true", help="输出重试等请求日志")
+    args = parser.parse_args(argv)
+    logging.getLogger("FishTTS").setLevel(logging.INFO if args.verbose else logging.ERROR)
+
+    reports = run_benchmarks(args)
+    print_reports(reports)
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "reports": reports}, f, ensure_ascii=False, indent=2)
+
+    if args.baseline:
+        regressions = compare_with_baseline(reports, args.baseline, args.tolerance)
+        if regressions:
+            print("\n❌ 发现性能回退:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print("\n✅ 未发现性能回退")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
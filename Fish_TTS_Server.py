@@ -0,0 +1,189 @@
+"""Fish TTS 本地合成服务
+
+把一个常驻的 TTSManager 包装成本地HTTP服务，整个进程只加载一次配置、
+共用一个连接池；相同内容的并发请求由 TTSManager.fetch_audio 合并为一次上游调用。
+请求经 TTSManager.scheduler 排队，interactive 请求优先于 bulk 请求。
+
+    python Fish_AI_TTS_Pro.py serve --port 8765
+
+接口：
+    POST /synthesize  {"text": ..., "profile": ..., "speed": 1.0, "output_name": ...,
+                       "use_cache": true, "response": "audio" | "json",
+                       "priority": "interactive" | "bulk", "deadline": 秒数}
+                      默认返回音频数据，response 为 json 时返回结果字典
+    GET  /health      熔断器、各上游地址和密钥、限流器和调度队列状态
+    GET  /metrics     Prometheus 文本格式的请求统计
+"""
+import json
+import logging
+import os
+import shutil
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from Fish_AI_TTS_Pro import parse_pack_locator
+
+logger = logging.getLogger("FishTTS")
+
+# 失败结果状态对应的HTTP状态码
+STATUS_CODES = {
+    "not_found": 404,
+    "http_error": 502,
+    "invalid_response": 502,
+    "connection_error": 502,
+    "circuit_open": 503,
+    "deadline_exceeded": 503,
+    "timeout": 504
+}
+
+AUDIO_CONTENT_TYPES = {
+    "mp3": "audio/mpeg",
+    "wav": "audio/wav",
+    "ogg": "audio/ogg",
+    "flac": "audio/flac",
+    "pcm": "application/octet-stream"
+}
+
+class TTSRequestHandler(BaseHTTPRequestHandler):
+    """处理合成请求；所有请求共用服务器上的同一个 TTSManager"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+    def _send_json(self, status, data):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status, message):
+        self._send_json(status, {"ok": False, "error": message})
+
+    def do_GET(self):
+        manager = self.server.manager
+        if self.path == "/health":
+            self._send_json(200, {
+                "status": "ok",
+                "circuit_breaker": manager.router.state,
+                "routing": manager.router.snapshot(),
+                "rate_limit": manager.rate_limit_state(),
+                "inflight": manager.inflight_count(),
+                "scheduler": manager.scheduler.stats()
+            })
+        elif self.path == "/metrics":
+            body = manager.metrics.to_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self._send_error(404, "未知路径")
+
+    def do_POST(self):
+        if self.path != "/synthesize":
+            self._send_error(404, "未知路径")
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError as e:
+            logger.debug(f"请求体无法解析: {e}")
+            self._send_error(400, "请求体不是有效的JSON")
+            return
+        if not isinstance(request, dict):
+            self._send_error(400, "请求体必须是JSON对象")
+            return
+        # 出错时只告诉客户端是哪个字段，异常详情只写调试日志
+        field = "text"
+        try:
+            text = request["text"].strip()
+            field = "speed"
+            speed = float(request.get("speed", 1.0))
+            field = "deadline"
+            deadline = request.get("deadline")
+            deadline = float(deadline) if deadline is not None else None
+            for field in ("profile", "output_name", "priority"):
+                if request.get(field) is not None and not isinstance(request[field], str):
+                    raise TypeError(f"{field} 不是字符串")
+            field = "use_cache"
+            if not isinstance(request.get("use_cache", True), bool):
+                raise TypeError("use_cache 不是布尔值")
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            logger.debug(f"请求字段 {field} 无效: {e!r}")
+            self._send_error(400, f"请求字段无效: {field}")
+            return
+        if not text:
+            self._send_error(400, "文本为空")
+            return
+
+        manager = self.server.manager
+        try:
+            future = manager.scheduler.submit(
+                text, request.get("priority", "interactive"), deadline,
+                voice_profile_name=request.get("profile"), speed=speed,
+                use_cache=request.get("use_cache", True),
+                output_name=request.get("output_name")
+            )
+            result = future.result()
+        except (KeyError, ValueError) as e:
+            self._send_error(400, str(e))
+            return
+
+        if not result["ok"]:
+            self._send_json(STATUS_CODES.get(result["status"], 500), result)
+        elif request.get("response") == "json":
+            self._send_json(200, result)
+        else:
+            format = manager.get_voice_profile(request.get("profile"))[1].get("format", "mp3")
+            self._send_audio(result, format)
+
+    def _send_audio_headers(self, result, format, length):
+        self.send_response(200)
+        self.send_header("Content-Type", AUDIO_CONTENT_TYPES.get(format, "application/octet-stream"))
+        self.send_header("Content-Length", str(length))
+        self.send_header("X-TTS-Filename", os.path.basename(result["filename"]))
+        self.send_header("X-TTS-Cached", str(result["cached"]).lower())
+        self.send_header("X-TTS-Coalesced", str(result["coalesced"]).lower())
+        self.end_headers()
+
+    def _send_audio(self, result, format):
+        """直接返回音频内容（文件或归档中的片段），结果信息放在响应头中"""
+        filename = result["filename"]
+        if parse_pack_locator(filename):
+            data = self.server.manager.read_clip(filename)
+            self._send_audio_headers(result, format, len(data))
+            self.wfile.write(data)
+            return
+        with open(filename, "rb") as f:
+            self._send_audio_headers(result, format, os.fstat(f.fileno()).st_size)
+            shutil.copyfileobj(f, self.wfile, 64 * 1024)
+
+class TTSServer(ThreadingHTTPServer):
+    """多线程合成服务，持有进程内唯一的 TTSManager"""
+
+    daemon_threads = True
+    # 默认的监听队列只有5，突发请求多出来的连接要等客户端重传SYN（约1秒）
+    request_queue_size = 128
+
+    def __init__(self, address, manager):
+        super().__init__(address, TTSRequestHandler)
+        self.manager = manager
+
+def serve(manager, host="127.0.0.1", port=8765):
+    """启动服务并阻塞运行，直到收到 Ctrl+C"""
+    server = TTSServer((host, port), manager)
+    if manager.config["http"].get("warm_up", False):
+        threading.Thread(target=manager.warm_up, daemon=True).start()
+    print("🌐 TTS服务已启动: http://%s:%d" % server.server_address[:2], file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,217 @@
+"""解析、切分和拼接等纯函数的单元测试
+
+    python -m pytest tests
+    python -m unittest discover tests
+"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import wave
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Fish_AI_TTS_Pro as tts
+
+# MPEG1 Layer III 128kbps 44.1kHz 无填充的帧（417字节）
+MP3_FRAME = b"\xff\xfb\x90\x00" + b"\x01" * 413
+# 带 Xing 信息帧标记的首帧
+XING_FRAME = b"\xff\xfb\x90\x00" + b"\x00" * 32 + b"Xing" + b"\x00" * 377
+
+class SplitSentencesTest(unittest.TestCase):
+    def test_empty_text(self):
+        self.assertEqual(tts.split_sentences(""), [])
+        self.assertEqual(tts.split_sentences("   \n "), [])
+
+    def test_segments_respect_max_length_and_keep_text(self):
+        text = "第一句话。第二句话比较长，中间有逗号！第三句？" * 20 + "The end. Really the end."
+        for max_length in (1, 5, 17, 50, 200):
+            segments = tts.split_sentences(text, max_length)
+            self.assertTrue(all(0 < len(segment) <= max_length for segment in segments))
+            self.assertEqual("".join(segments).replace(" ", ""), text.replace(" ", ""))
+
+    def test_punctuation_stays_with_sentence(self):
+        self.assertEqual(tts.split_sentences("你好。再见！", 3), ["你好。", "再见！"])
+
+    def test_long_sentence_without_punctuation_is_hard_split(self):
+        self.assertEqual(tts.split_sentences("a" * 25, 10), ["a" * 10, "a" * 10, "a" * 5])
+
+    def test_merge_packs_short_sentences(self):
+        self.assertEqual(tts.split_sentences("一。二。三。", 100), ["一。二。三。"])
+        self.assertEqual(tts.split_sentences("一。二。三。", 100, merge=False), ["一。", "二。", "三。"])
+
+    def test_invalid_max_length_is_clamped(self):
+        self.assertEqual(tts.split_sentences("ab", 0), ["a", "b"])
+
+class Mp3FrameTest(unittest.TestCase):
+    def test_frame_length(self):
+        self.assertEqual(tts.mp3_frame_length(b"\xff\xfb\x90\x00"), 417)
+        # 填充位
+        self.assertEqual(tts.mp3_frame_length(b"\xff\xfb\x92\x00"), 418)
+        # MPEG2 Layer III 80kbps 22.05kHz
+        self.assertEqual(tts.mp3_frame_length(b"\xff\xf3\x90\x00"), 261)
+
+    def test_invalid_headers(self):
+        self.assertIsNone(tts.mp3_frame_length(b"\xff\xfb\x90"))
+        self.assertIsNone(tts.mp3_frame_length(b"ID3\x03"))
+        # 保留的比特率和采样率
+        self.assertIsNone(tts.mp3_frame_length(b"\xff\xfb\xf0\x00"))
+        self.assertIsNone(tts.mp3_frame_length(b"\xff\xfb\x9c\x00"))
+        # 保留的版本号
+        self.assertIsNone(tts.mp3_frame_length(b"\xff\xeb\x90\x00"))
+
+    def test_id3v2_length(self):
+        self.assertIsNone(tts.id3v2_length(b"ID3"))
+        self.assertEqual(tts.id3v2_length(MP3_FRAME[:10]), 0)
+        # 同步安全整数：0x01 0x00 表示 128 字节
+        self.assertEqual(tts.id3v2_length(b"ID3\x03\x00\x00\x00\x00\x01\x00"), 138)
+        # 带页脚
+        self.assertEqual(tts.id3v2_length(b"ID3\x04\x00\x10\x00\x00\x00\x05"), 25)
+
+class JoinAudioTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, data):
+        path = os.path.join(self.dir, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def write_wav(self, name, frames, rate=16000):
+        path = os.path.join(self.dir, name)
+        with wave.open(path, "wb") as out:
+            out.setnchannels(1)
+            out.setsampwidth(2)
+            out.setframerate(rate)
+            out.writeframes(frames)
+        return path
+
+    def test_mp3_join_keeps_only_audio_frames(self):
+        id3 = b"ID3\x03\x00\x00\x00\x00\x00\x05" + b"\x00" * 5
+        tag = b"TAG" + b"\x00" * 125
+        first = self.write("a.mp3", id3 + XING_FRAME + MP3_FRAME * 2 + tag)
+        # 帧前有杂散字节时从第一个完整帧开始
+        second = self.write("b.mp3", b"\x00\x00" + MP3_FRAME * 3)
+        output = os.path.join(self.dir, "out.mp3")
+        tts.join_audio_files([first, second], output, "mp3")
+        with open(output, "rb") as f:
+            self.assertEqual(f.read(), MP3_FRAME * 5)
+
+    def test_mp3_without_frames_is_rejected(self):
+        path = self.write("bad.mp3", b"not audio" * 10)
+        output = os.path.join(self.dir, "out.mp3")
+        with self.assertRaises(ValueError):
+            tts.join_audio_files([path], output, "mp3")
+        self.assertEqual(os.listdir(self.dir), ["bad.mp3"])
+
+    def test_wav_join_rewrites_header(self):
+        first = self.write_wav("a.wav", b"\x01\x00" * 100)
+        second = self.write_wav("b.wav", b"\x02\x00" * 50)
+        output = os.path.join(self.dir, "out.wav")
+        tts.join_audio_files([first, second], output, "wav")
+        with wave.open(output, "rb") as joined:
+            self.assertEqual(joined.getnframes(), 150)
+            self.assertEqual(joined.readframes(150), b"\x01\x00" * 100 + b"\x02\x00" * 50)
+
+    def test_wav_join_rejects_mismatched_params(self):
+        first = self.write_wav("a.wav", b"\x00\x00" * 10, 16000)
+        second = self.write_wav("b.wav", b"\x00\x00" * 10, 44100)
+        with self.assertRaises(ValueError):
+            tts.join_audio_files([first, second], os.path.join(self.dir, "out.wav"), "wav")
+
+    def test_wav_data_offset(self):
+        with open(self.write_wav("a.wav", b"\x00\x00" * 4), "rb") as f:
+            head = f.read()
+        self.assertEqual(tts.wav_data_offset(head), 44)
+        self.assertIsNone(tts.wav_data_offset(head[:30]))
+        with self.assertRaises(ValueError):
+            tts.wav_data_offset(b"RIFX" + head[4:])
+
+class PackLocatorTest(unittest.TestCase):
+    KEY = "0123456789abcdef" * 4
+
+    def test_round_trip(self):
+        locator = tts.pack_locator("clips/a#b.pack", self.KEY)
+        self.assertEqual(tts.parse_pack_locator(locator), ("clips/a#b.pack", self.KEY))
+
+    def test_plain_paths_are_not_locators(self):
+        for value in (None, "", "out/a.mp3", "out/a#b.mp3", "x.pack#", "x.pack#123:456",
+                      "x.pack#" + self.KEY.upper(), "x.pack#" + self.KEY[:-1], "#" + self.KEY):
+            self.assertIsNone(tts.parse_pack_locator(value), value)
+
+class RetryAfterTest(unittest.TestCase):
+    def test_seconds(self):
+        self.assertEqual(tts.parse_retry_after("5"), 5.0)
+        self.assertEqual(tts.parse_retry_after(" 1.5 "), 1.5)
+        self.assertEqual(tts.parse_retry_after("-3"), 0.0)
+
+    def test_http_date(self):
+        future = datetime.now(timezone.utc) + timedelta(seconds=30)
+        self.assertAlmostEqual(tts.parse_retry_after(format_datetime(future, usegmt=True)), 30, delta=2)
+        past = datetime.now(timezone.utc) - timedelta(hours=1)
+        self.assertEqual(tts.parse_retry_after(format_datetime(past, usegmt=True)), 0.0)
+
+    def test_missing_or_invalid(self):
+        for value in (None, "", "soon", "Mon, 99 Foo 2024"):
+            self.assertIsNone(tts.parse_retry_after(value), value)
+
+class AdaptiveTimeoutsTest(unittest.TestCase):
+    def make(self, **settings):
+        options = dict(tts.DEFAULT_CONFIG["timeouts"])
+        options.update(settings)
+        return tts.AdaptiveTimeouts(options)
+
+    def test_read_timeout_scales_with_text_length(self):
+        timeouts = self.make()
+        connect, short = timeouts.for_request("speech-1.6", 10)
+        _, long = timeouts.for_request("speech-1.6", 2000)
+        self.assertEqual(connect, 3.05)
+        # 3 × (1.0 + 0.02 × 2000) + 5
+        self.assertEqual(long, 128.0)
+        self.assertLess(short, long)
+
+    def test_bounds(self):
+        timeouts = self.make(read_min=7.0, read_max=60.0)
+        self.assertEqual(timeouts.for_request("s1", 0)[1], 9.5)
+        self.assertEqual(timeouts.for_request("s1", 100000)[1], 60.0)
+        self.assertEqual(self.make(read_min=20.0).for_request("s1", 0)[1], 20.0)
+
+    def test_retry_growth_is_capped(self):
+        timeouts = self.make(read_max=30.0)
+        reads = [timeouts.for_request("speech-1.6", 100, retries)[1] for retries in range(5)]
+        self.assertEqual(reads[:2], [14.0, 21.0])
+        self.assertEqual(reads[-1], 30.0)
+        self.assertEqual(reads, sorted(reads))
+
+    def test_unknown_backend_uses_default_prior(self):
+        self.assertEqual(self.make().for_request("unknown", 100)[1], 17.0)
+
+    def test_observations_move_the_estimate(self):
+        timeouts = self.make(alpha=0.5)
+        before = timeouts.expected("speech-1.6", 500)
+        timeouts.observe("speech-1.6", 5, 3.0)
+        timeouts.observe("speech-1.6", 500, 40.0)
+        self.assertGreater(timeouts.expected("speech-1.6", 500), before)
+        self.assertEqual(timeouts.snapshot()["speech-1.6"]["samples"], 2)
+
+    def test_state_file_round_trip(self):
+        path = os.path.join(tempfile.mkdtemp(), "timeouts.json")
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        timeouts = self.make()
+        self.assertFalse(timeouts.save(path))
+        timeouts.observe("s1", 5, 2.0)
+        self.assertTrue(timeouts.save(path))
+        self.assertFalse(timeouts.save(path))
+        restored = self.make()
+        restored.load(path)
+        self.assertEqual(restored.snapshot(), timeouts.snapshot())
+
+if __name__ == "__main__":
+    unittest.main()